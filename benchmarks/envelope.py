@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compares the job bodies written with job_encoding = json and with
+job_encoding = zlib (the PW1 envelope): the bytes each job takes in
+beanstalk, and the time to pack a tweet into a job body and to unpack it
+again, as tweets-client and the workers do.
+
+PYTHONPATH=$PYTHONPATH:`pwd`/lib ./benchmarks/envelope.py
+"""
+
+import sys
+import json
+import argparse
+import functools
+
+from politwoops import codec, envelope
+
+import tweets
+from timing import measure
+
+
+
+def main(args):
+    print("{0} messages, best of {1}, microseconds per job".format(args.count, args.repeat))
+    print("{0:<6} {1:<8} {2:>10} {3:>8} {4:>8}".format('corpus', 'encoding', 'bytes/job', 'encode', 'decode'))
+    for (corpus, emoji) in (('ascii', False), ('emoji', True)):
+        objects = [json.loads(data) for data in tweets.messages(args.count, emoji=emoji)]
+        for encoding in ('json', 'zlib'):
+            bodies = [envelope.pack(obj, encoding) for obj in objects]
+            assert envelope.unpack(bodies[1]) == codec.deserialize(codec.serialize(objects[1]))
+            size = sum(len(body) for body in bodies) / float(len(bodies))
+            encode = measure(functools.partial(envelope.pack, encoding=encoding), objects, args.repeat)
+            decode = measure(envelope.unpack, bodies, args.repeat)
+            print("{0:<6} {1:<8} {2:>10.0f} {3:>8.1f} {4:>8.1f}".format(
+                corpus, encoding, size, encode * 1e6, decode * 1e6))
+    return 0
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser(description=__doc__,
+                                          formatter_class=argparse.RawDescriptionHelpFormatter)
+    args_parser.add_argument('--count', type=int, default=5000,
+                             help='Messages per corpus (default: 5000)')
+    args_parser.add_argument('--repeat', type=int, default=5,
+                             help='Runs per measurement, the fastest is reported (default: 5)')
+    args = args_parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Times politwoops.utils.replace_highpoints against the re.sub call it
+replaced, on the strings the worker sanitizes for each new tweet: the
+tweet text and the serialized tweet, plus the tweet as UTF-8 JSON for a
+string that is not ASCII throughout.
+
+PYTHONPATH=$PYTHONPATH:`pwd`/lib ./benchmarks/highpoints.py
+"""
+
+import re
+import sys
+import json
+import argparse
+import functools
+
+from politwoops import codec
+from politwoops.utils import replace_highpoints
+
+import tweets
+from timing import measure
+
+
+def replace_highpoints_re_sub(subject, replacement=u'\ufffd'):
+    # The previous implementation, which passed re.U as the count.
+    return re.sub(u'[\U00010000-\U0010ffff]', replacement, subject, re.U)
+
+
+
+def main(args):
+    print("{0} tweets, best of {1}, microseconds per string".format(args.count, args.repeat))
+    print("{0:<6} {1:<12} {2:>6} {3:>8} {4:>8} {5:>8}".format('corpus', 'string', 'chars', 're.sub', 'current', 'speedup'))
+    for (corpus, emoji) in (('ascii', False), ('emoji', True)):
+        statuses = [tweets.status(i, emoji=emoji) for i in range(args.count)]
+        strings = (('text', [status['text'] for status in statuses]),
+                   ('serialized', [codec.serialize(status) for status in statuses]),
+                   ('utf-8 json', [json.dumps(status, ensure_ascii=False) for status in statuses]))
+        for (name, items) in strings:
+            for item in items[:100]:
+                assert replace_highpoints(item, u'') == re.sub(u'[\U00010000-\U0010ffff]', u'', item)
+            before = measure(functools.partial(replace_highpoints_re_sub, replacement=u''), items, args.repeat)
+            after = measure(functools.partial(replace_highpoints, replacement=u''), items, args.repeat)
+            chars = sum(len(item) for item in items) // len(items)
+            print("{0:<6} {1:<12} {2:>6} {3:>8.2f} {4:>8.2f} {5:>7.1f}x".format(
+                corpus, name, chars, before * 1e6, after * 1e6, before / after))
+    return 0
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser(description=__doc__,
+                                          formatter_class=argparse.RawDescriptionHelpFormatter)
+    args_parser.add_argument('--count', type=int, default=5000,
+                             help='Tweets per corpus (default: 5000)')
+    args_parser.add_argument('--repeat', type=int, default=5,
+                             help='Runs per measurement, the fastest is reported (default: 5)')
+    args = args_parser.parse_args()
+    sys.exit(main(args))
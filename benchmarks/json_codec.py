@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Times politwoops.codec with each installed backend against calling the
+standard library json module directly, decoding stream messages and
+serializing them again. A backend shown as orjson/json decodes with orjson
+and encodes with the json module.
+
+PYTHONPATH=$PYTHONPATH:`pwd`/lib ./benchmarks/json_codec.py
+"""
+
+import sys
+import json
+import argparse
+
+from politwoops import codec
+
+import tweets
+from timing import measure
+
+
+
+def main(args):
+    baseline = ('json.loads/dumps', json.loads, lambda obj: json.dumps(obj, separators=(',', ':')))
+    candidates = [baseline]
+    for name in ('orjson', 'ujson', 'json'):
+        try:
+            label = codec.use(name)
+        except ImportError:
+            continue
+        candidates.append(('codec ' + label, codec.deserialize, codec.serialize))
+
+    print("{0} messages, best of {1}, microseconds per message".format(args.count, args.repeat))
+    print("{0:<18} {1:<6} {2:>8} {3:>10}".format('', 'corpus', 'decode', 'serialize'))
+    for (corpus, emoji) in (('ascii', False), ('emoji', True)):
+        messages = tweets.messages(args.count, emoji=emoji)
+        objects = [json.loads(data) for data in messages]
+        for (name, loads, dumps) in candidates:
+            if name.startswith('codec '):
+                codec.use(name.split()[1].split('/')[0])
+            decode = measure(loads, messages, args.repeat)
+            encode = measure(dumps, objects, args.repeat)
+            print("{0:<18} {1:<6} {2:>8.1f} {3:>10.1f}".format(name, corpus, decode * 1e6, encode * 1e6))
+    return 0
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser(description=__doc__,
+                                          formatter_class=argparse.RawDescriptionHelpFormatter)
+    args_parser.add_argument('--count', type=int, default=5000,
+                             help='Messages per corpus (default: 5000)')
+    args_parser.add_argument('--repeat', type=int, default=5,
+                             help='Runs per measurement, the fastest is reported (default: 5)')
+    args = args_parser.parse_args()
+    sys.exit(main(args))
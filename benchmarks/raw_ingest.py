@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compares the per-message cost of the two ways tweets-client turns a stream
+message into a job: decoding it and serializing it again, or with
+raw_ingest picking the routing fields out of the text and queueing it
+unchanged. Delete notices take the decoding path in both modes, as they do
+in TweetListener.on_data.
+
+By default it runs on synthetic ASCII-only and emoji-heavy messages. Given
+a recording made with record_file, it runs on the recorded messages
+instead, following the accounts listed with --follow or, without it,
+every author in the recording.
+
+PYTHONPATH=$PYTHONPATH:`pwd`/lib ./benchmarks/raw_ingest.py [stream.20180101-120000.gz]
+"""
+
+import os
+import sys
+import argparse
+import importlib.util
+
+from politwoops import codec
+from politwoops import recording
+
+import tweets
+from timing import measure
+
+_bin = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bin')
+_spec = importlib.util.spec_from_file_location('tweets_client', os.path.join(_bin, 'tweets-client.py'))
+tweets_client = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(tweets_client)
+
+
+def decode_path(data, users):
+    tweet = codec.deserialize(data)
+    if 'delete' in tweet or tweet['user']['id'] in users:
+        return codec.serialize(tweet)
+
+
+def raw_path(data, users):
+    status = tweets_client.peek_status(data)
+    if status is None:
+        return decode_path(data, users)
+    if status.user_id in users:
+        return data
+
+
+
+def recorded_corpus(path, follow):
+    """
+    Returns the messages of a recording as the str on_data receives, and
+    the accounts to follow: `follow`, or every author in the recording.
+    """
+    messages = [data.decode('utf-8') for (_, data) in recording.read_recording(path)]
+    if follow:
+        users = set(follow)
+    else:
+        users = set(codec.deserialize(data)['user']['id'] for data in messages
+                    if '"user":' in data and not data.startswith('{"delete"'))
+    return messages, users
+
+
+def main(args):
+    if args.backend:
+        codec.use(args.backend)
+    if args.recording:
+        messages, users = recorded_corpus(args.recording, args.follow)
+        print("Recording: {0}, following {1} accounts".format(args.recording, len(users)))
+        corpora = [('recorded', messages, users)]
+    else:
+        users = set(range(100000, 100500))
+        corpora = [(corpus, tweets.messages(args.count, emoji=emoji), users)
+                   for (corpus, emoji) in (('ascii', False), ('emoji', True))]
+    print("JSON backend: {0}, best of {1}".format(codec.backend_name(), args.repeat))
+    print("{0:<8} {1:>8} {2:>14} {3:>14} {4:>12} {5:>12} {6:>9}".format(
+        'corpus', 'messages', 'decode us/msg', 'raw us/msg', 'decode msg/s', 'raw msg/s', 'speedup'))
+    for (corpus, messages, users) in corpora:
+        for data in messages:
+            (raw, decoded) = (raw_path(data, users), decode_path(data, users))
+            assert (raw is None) == (decoded is None)
+            if raw is not None:
+                assert codec.deserialize(raw) == codec.deserialize(decoded)
+        decode = measure(lambda data: decode_path(data, users), messages, args.repeat)
+        raw = measure(lambda data: raw_path(data, users), messages, args.repeat)
+        print("{0:<8} {1:>8} {2:>14.1f} {3:>14.1f} {4:>12.0f} {5:>12.0f} {6:>8.1f}x".format(
+            corpus, len(messages), decode * 1e6, raw * 1e6, 1 / decode, 1 / raw, decode / raw))
+    return 0
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser(description=__doc__,
+                                          formatter_class=argparse.RawDescriptionHelpFormatter)
+    args_parser.add_argument('recording', metavar='FILE', type=str, nargs='?',
+                             help='Recording to run on instead of synthetic messages')
+    args_parser.add_argument('--follow', metavar='ID', type=int, nargs='+',
+                             help='Accounts followed while replaying a recording (default: every author in it)')
+    args_parser.add_argument('--count', type=int, default=5000,
+                             help='Synthetic messages per corpus (default: 5000)')
+    args_parser.add_argument('--repeat', type=int, default=5,
+                             help='Runs per measurement, the fastest is reported (default: 5)')
+    args_parser.add_argument('--backend', choices=('orjson', 'ujson', 'json'),
+                             help='JSON backend (default: the fastest installed)')
+    args = args_parser.parse_args()
+    sys.exit(main(args))
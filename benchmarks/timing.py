@@ -0,0 +1,21 @@
+# encoding: utf-8
+"""
+Timing shared by the benchmarks in this directory.
+"""
+
+import time
+
+
+def measure(fn, items, repeat):
+    """
+    Calls fn on every item, `repeat` times over, and returns the seconds
+    per item of the fastest run.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(items)
@@ -0,0 +1,106 @@
+# encoding: utf-8
+"""
+Synthetic stream messages for the benchmarks in this directory, shaped like
+what the Twitter streaming API delivers for a followed account: statuses
+with the full user object and extended_tweet, retweets, replies and delete
+notices, serialized as compact UTF-8 JSON.
+"""
+
+import json
+import random
+
+ASCII_TEXT = ("Today I voted to fund our schools and protect healthcare for millions "
+              "of families across the state. Read more about the bill here")
+EMOJI_TEXT = (u"Happy 4th! \U0001F1FA\U0001F1F8\U0001F386\U0001F389 Celebrating with family "
+              u"\U0001F468‍\U0001F469‍\U0001F467 and friends \U0001F525\U0001F525 "
+              u"#July4th \U0001F44F\U0001F3FD Café “quoted” \U0001F600")
+
+
+def user(i, emoji=False):
+    name = u"Rep. Person {0}{1}".format(i, u" \U0001F1FA\U0001F1F8" if emoji else u"")
+    return {
+        "id": 100000 + i, "id_str": str(100000 + i), "name": name,
+        "screen_name": "RepPerson{0}".format(i), "location": "Washington, DC",
+        "url": "https://t.co/abcdEFGH{0}".format(i),
+        "description": "Proudly serving the people of the great state. Official account. "
+                       "Retweets are not endorsements.",
+        "translator_type": "none", "protected": False, "verified": True,
+        "followers_count": 1000 + i * 37, "friends_count": 1234, "listed_count": 2345,
+        "favourites_count": 345, "statuses_count": 12345,
+        "created_at": "Tue Mar 03 18:00:00 +0000 2009", "utc_offset": None, "time_zone": None,
+        "geo_enabled": False, "lang": None, "contributors_enabled": False,
+        "is_translator": False, "profile_background_color": "C0DEED",
+        "profile_background_image_url": "http://abs.twimg.com/images/themes/theme1/bg.png",
+        "profile_background_image_url_https": "https://abs.twimg.com/images/themes/theme1/bg.png",
+        "profile_background_tile": False, "profile_link_color": "1DA1F2",
+        "profile_sidebar_border_color": "C0DEED", "profile_sidebar_fill_color": "DDEEF6",
+        "profile_text_color": "333333", "profile_use_background_image": True,
+        "profile_image_url": "http://pbs.twimg.com/profile_images/{0}/abc_normal.jpg".format(i),
+        "profile_image_url_https": "https://pbs.twimg.com/profile_images/{0}/abc_normal.jpg".format(i),
+        "default_profile": False, "default_profile_image": False,
+        "following": None, "follow_request_sent": None, "notifications": None,
+    }
+
+
+def status(i, emoji=False, reply_to=None, retweeted=None):
+    text = EMOJI_TEXT if emoji else ASCII_TEXT
+    url = "https://t.co/xYz{0}".format(i)
+    message = {
+        "created_at": "Mon Jan 01 12:00:00 +0000 2018",
+        "id": 950000000000000000 + i, "id_str": str(950000000000000000 + i),
+        "text": u"{0} {1}".format(text[:110], url),
+        "display_text_range": [0, 140],
+        "source": "<a href=\"http://twitter.com/download/iphone\" rel=\"nofollow\">Twitter for iPhone</a>",
+        "truncated": True,
+        "in_reply_to_status_id": reply_to,
+        "in_reply_to_status_id_str": None if reply_to is None else str(reply_to),
+        "in_reply_to_user_id": None, "in_reply_to_user_id_str": None,
+        "in_reply_to_screen_name": None,
+        "user": user(i % 500, emoji),
+        "geo": None, "coordinates": None, "place": None, "contributors": None,
+        "is_quote_status": False,
+        "extended_tweet": {
+            "full_text": u"{0} {1}".format(text, url),
+            "display_text_range": [0, len(text)],
+            "entities": {"hashtags": [], "user_mentions": [], "symbols": [],
+                         "urls": [{"url": url, "expanded_url": "https://house.gov/news/{0}".format(i),
+                                   "display_url": "house.gov/news/{0}".format(i),
+                                   "indices": [len(text) + 1, len(text) + 24]}]},
+        },
+        "quote_count": 0, "reply_count": 3, "retweet_count": 12, "favorite_count": 40,
+        "entities": {"hashtags": [], "user_mentions": [], "symbols": [],
+                     "urls": [{"url": url, "expanded_url": "https://twitter.com/i/web/status/{0}".format(i),
+                               "display_url": u"twitter.com/i/web/status/1…", "indices": [117, 140]}]},
+        "favorited": False, "retweeted": False, "filter_level": "low", "lang": "en",
+        "timestamp_ms": str(1514808000000 + i),
+    }
+    if retweeted is not None:
+        message["retweeted_status"] = retweeted
+    return message
+
+
+def delete(i):
+    return {"delete": {"status": {"id": 950000000000000000 + i, "id_str": str(950000000000000000 + i),
+                                  "user_id": 100000 + i % 500, "user_id_str": str(100000 + i % 500)},
+                       "timestamp_ms": str(1514808000000 + i)}}
+
+
+def messages(count, emoji=False, seed=0):
+    """
+    Returns count stream messages as JSON text: mostly statuses, with a
+    retweet every third, a reply every seventh and a delete notice every
+    tenth message.
+    """
+    rng = random.Random(seed)
+    result = []
+    for i in range(count):
+        if i % 10 == 0:
+            message = delete(i)
+        elif i % 3 == 0:
+            message = status(i, emoji, retweeted=status(i + count, emoji))
+        elif i % 7 == 0:
+            message = status(i, emoji, reply_to=940000000000000000 + rng.randrange(10 ** 6))
+        else:
+            message = status(i, emoji)
+        result.append(json.dumps(message, ensure_ascii=False, separators=(',', ':')))
+    return result
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Times politwoops-worker.py handling jobs one at a time with handle_tweet and
+in batches of worker_batch_size with handle_batch, against the stand-in
+database of tests/stubdb.py with a round-trip latency added to every
+statement, and reports jobs per second.
+
+PYTHONPATH=$PYTHONPATH:`pwd`/lib ./benchmarks/worker_batch.py
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import logbook
+
+import tweets
+
+# The stand-in database is shared with the tests.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tests'))
+import stubdb
+
+worker_module = stubdb.load_worker()
+
+
+def worker(database):
+    worker = worker_module.DeletedTweetsWorker.__new__(worker_module.DeletedTweetsWorker)
+    worker.images = False
+    worker.tweet_locks = None
+    worker.users = {}
+    worker.politicians = {}
+    for i in range(500):
+        user = tweets.user(i)
+        database.add_politician(i + 1, user['id'], user['screen_name'])
+        worker.users[user['id']] = i + 1
+        worker.politicians[user['id']] = user['screen_name']
+    # Buffered, as with the default metrics_flush_interval.
+    worker.metrics = worker_module.MetricsBuffer()
+    worker.database = database.connect()
+    return worker
+
+
+def run(jobs, latency, batch_size):
+    """
+    Returns the seconds taken to handle jobs in batches of batch_size, or
+    one at a time with handle_tweet if batch_size is None.
+    """
+    w = worker(stubdb.Database(latency))
+    started = time.perf_counter()
+    if batch_size is None:
+        for tweet in jobs:
+            w.handle_tweet(tweet)
+    else:
+        for start in range(0, len(jobs), batch_size):
+            w.handle_batch(jobs[start:start + batch_size])
+    return time.perf_counter() - started
+
+
+def main(args):
+    jobs = [json.loads(data) for data in tweets.messages(args.count)]
+    print("{0} jobs, {1:g} ms per database round trip".format(len(jobs), args.latency_ms))
+    print("{0:<14} {1:>8} {2:>10}".format('', 'seconds', 'jobs/s'))
+    with logbook.NullHandler().applicationbound():
+        for batch_size in [None] + args.sizes:
+            seconds = run(jobs, args.latency_ms / 1000.0, batch_size)
+            label = 'handle_tweet' if batch_size is None else 'batch of {0}'.format(batch_size)
+            print("{0:<14} {1:>8.2f} {2:>10.0f}".format(label, seconds, len(jobs) / seconds))
+    return 0
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser(description=__doc__,
+                                          formatter_class=argparse.RawDescriptionHelpFormatter)
+    args_parser.add_argument('--count', type=int, default=2000,
+                             help='Jobs per run (default: 2000)')
+    args_parser.add_argument('--latency-ms', type=float, default=1.0,
+                             help='Round-trip latency of each statement (default: 1)')
+    args_parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 50, 100],
+                             help='Batch sizes (default: 1 10 50 100)')
+    args = args_parser.parse_args()
+    sys.exit(main(args))
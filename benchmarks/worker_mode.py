@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Times politwoops-worker.py draining a tube of jobs with worker_mode=sync,
+DeletedTweetsWorker, and with worker_mode=asyncio, AsyncDeletedTweetsWorker,
+on worker_connections database connections. The database is the stand-in
+of tests/stubdb.py with a round-trip latency added to every statement, and
+the tube an in-process stand-in for beanstalkd, so only the database round
+trips are slow.
+
+PYTHONPATH=$PYTHONPATH:`pwd`/lib ./benchmarks/worker_mode.py
+"""
+
+import os
+import sys
+import time
+import argparse
+import datetime
+import threading
+import collections
+
+import logbook
+
+import tweets
+
+# The stand-in database is shared with the tests.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tests'))
+import stubdb
+
+worker_module = stubdb.load_worker()
+
+import tweetsclient
+import politwoops
+
+
+class Drained(Exception):
+    """
+    Raised by a reserve that would wait on an empty tube, to stop the worker.
+    """
+
+
+class Tube(object):
+    """
+    Stands in for a beanstalk connection watching a tube of `bodies`, and
+    notes when the first job was reserved and the last one deleted.
+    """
+    def __init__(self, bodies):
+        self.ready = collections.deque(enumerate(bodies, 1))
+        self.lock = threading.Lock()
+        self.deleted = 0
+        self.first_reserved = self.last_deleted = None
+
+    def reserve(self, timeout=None):
+        with self.lock:
+            if not self.ready:
+                if timeout is None or timeout >= 1:
+                    raise Drained()
+                return None
+            if self.first_reserved is None:
+                self.first_reserved = time.perf_counter()
+            (job_id, body) = self.ready.popleft()
+        return Job(self, job_id, body)
+
+    def delete(self, job):
+        with self.lock:
+            self.deleted += 1
+            self.last_deleted = time.perf_counter()
+
+    def release(self, job):
+        with self.lock:
+            self.ready.append((job.job_id, job.body))
+
+    def elapsed(self):
+        return self.last_deleted - self.first_reserved
+
+
+class Job(object):
+    def __init__(self, tube, job_id, body):
+        self.tube = tube
+        self.job_id = job_id
+        self.body = body
+
+    def delete(self):
+        self.tube.delete(self)
+
+    def release(self, priority=None, delay=0):
+        self.tube.release(self)
+
+
+class AsyncTube(object):
+    """
+    Stands in for a politwoops.aiobeanstalk.Connection to a Tube.
+    """
+    def __init__(self, tube):
+        self.tube = tube
+
+    async def connect(self):
+        return self
+
+    async def watch(self, tube):
+        pass
+
+    async def reserve(self, timeout=None):
+        job = self.tube.reserve(timeout)
+        return None if job is None else AsyncJob(job)
+
+    def close(self):
+        pass
+
+
+class AsyncJob(object):
+    def __init__(self, job):
+        self.job = job
+        self.job_id = job.job_id
+        self.body = job.body
+
+    async def delete(self):
+        self.job.delete()
+
+    async def release(self, priority=None, delay=0):
+        self.job.release()
+
+
+class Heart(object):
+    interval = datetime.timedelta(seconds=60)
+
+    def sleep(self):
+        time.sleep(self.interval.total_seconds())
+
+    def beat(self):
+        return False
+
+
+class SyncWorker(worker_module.DeletedTweetsWorker):
+    def init_beanstalk(self):
+        self.beanstalk = self.tube
+
+
+def configure(database):
+    config = tweetsclient.Config().get()
+    settings = {
+        'beanstalk': {'host': 'localhost', 'port': '11300', 'tweets_tube': 'tweets',
+                      'screenshot_tube': 'screenshots', 'job_encoding': 'json'},
+        'tweets-client': {'worker_batch_size': '1', 'tweet_index': 'no',
+                          'latency_directory': '', 'latency_port': ''},
+    }
+    for (section, values) in settings.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for (key, value) in values.items():
+            config.set(section, key, value)
+    # Every connection the workers' pools open is to the stand-in.
+    politwoops.database.connect = lambda config=None: database.connect()
+
+
+def run(bodies, latency, connections):
+    """
+    Drains a tube of bodies with the sync worker, or with the asyncio worker
+    on `connections` connections, and returns the seconds from the first
+    reserve to the last delete.
+    """
+    database = stubdb.Database(latency)
+    for i in range(500):
+        user = tweets.user(i)
+        database.add_politician(i + 1, user['id'], user['screen_name'])
+    configure(database)
+    tube = Tube(bodies)
+    if connections is None:
+        worker = SyncWorker(Heart(), False)
+        worker.tube = tube
+    else:
+        politwoops.aiobeanstalk.Connection = lambda host, port: AsyncTube(tube)
+        worker = worker_module.AsyncDeletedTweetsWorker(Heart(), False, connections=connections)
+    try:
+        worker.run()
+    except Drained:
+        pass
+    assert tube.deleted == len(bodies)
+    return tube.elapsed()
+
+
+def main(args):
+    bodies = tweets.messages(args.count)
+    print("{0} jobs, {1:g} ms per database round trip".format(len(bodies), args.latency_ms))
+    print("{0:<24} {1:>8} {2:>10}".format('', 'seconds', 'jobs/s'))
+    with logbook.NullHandler().applicationbound():
+        for connections in [None] + args.connections:
+            seconds = run(bodies, args.latency_ms / 1000.0, connections)
+            if connections is None:
+                label = 'sync'
+            else:
+                label = 'asyncio, {0} connection{1}'.format(connections, '' if connections == 1 else 's')
+            print("{0:<24} {1:>8.2f} {2:>10.0f}".format(label, seconds, len(bodies) / seconds))
+    return 0
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser(description=__doc__,
+                                          formatter_class=argparse.RawDescriptionHelpFormatter)
+    args_parser.add_argument('--count', type=int, default=2000,
+                             help='Jobs per run (default: 2000)')
+    args_parser.add_argument('--latency-ms', type=float, default=1.0,
+                             help='Round-trip latency of each statement (default: 1)')
+    args_parser.add_argument('--connections', type=int, nargs='+', default=[1, 4, 8, 16],
+                             help='worker_connections of the asyncio runs (default: 1 4 8 16)')
+    args = args_parser.parse_args()
+    sys.exit(main(args))
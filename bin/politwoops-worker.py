@@ -13,9 +13,14 @@ import time
 import mimetypes
 import argparse
 import MySQLdb
-import anyjson
 import smtplib
 import signal
+import asyncio
+import threading
+import contextlib
+import collections
+import concurrent.futures
+import tempfile
 import pytz
 import tweepy
 from email.mime.text import MIMEText
@@ -25,15 +30,13 @@ import socket
 # disable buffering
 #socket._fileobject.default_bufsize = 0
 
-import http.client
-http.client.HTTPConnection.debuglevel = 1
-
 from urllib.request import urlopen
 import MySQLdb
-import anyjson
+import MySQLdb.cursors
 import logbook
 import tweetsclient
 import politwoops
+from politwoops import codec
 replace_highpoints = politwoops.utils.replace_highpoints
 
 _script_ = (os.path.basename(__file__)
@@ -41,34 +44,146 @@ _script_ = (os.path.basename(__file__)
             else __name__)
 log = logbook.Logger(_script_)
 
+_insert_tweet_sql = """INSERT INTO `tweets` (`id`, `user_name`, `politician_id`, `content`, `created`, `modified`, `tweet`, retweeted_id, retweeted_content, retweeted_user_name) VALUES(%s, %s, %s, %s, NOW(), NOW(), %s, %s, %s, %s)"""
+
+_update_tweet_sql = """UPDATE `tweets` SET `user_name` = %s, `politician_id` = %s, `content` = %s, `tweet`=%s, `retweeted_id`=%s, `retweeted_content`=%s, `retweeted_user_name`=%s, `modified`= NOW() WHERE id = %s"""
+
+# On a duplicate key, LAST_INSERT_ID(expr) makes the connection's insert id
+# the row's deleted flag, 0 or 1, where an insert would report the tweet id.
+# MySQL reports one affected row for an insert and two for an update.
+_upsert_tweet_sql = _insert_tweet_sql + """ ON DUPLICATE KEY UPDATE `user_name` = VALUES(`user_name`), `politician_id` = VALUES(`politician_id`), `content` = VALUES(`content`), `tweet` = VALUES(`tweet`), `retweeted_id` = VALUES(`retweeted_id`), `retweeted_content` = VALUES(`retweeted_content`), `retweeted_user_name` = VALUES(`retweeted_user_name`), `modified` = NOW(), `deleted` = LAST_INSERT_ID(`deleted`)"""
+
+_delete_tweet_sql = """INSERT INTO `tweets` (`id`, `deleted`, `modified`, `created`) VALUES (%s, 1, NOW(), NOW()) ON DUPLICATE KEY UPDATE `deleted` = 1, `modified` = NOW()"""
+
+_metrics_sql = """INSERT INTO `twitter_metrics` (`politician_id`, `date`, `followers_count`, `tweets_count`, `created_at`, `updated_at`) VALUES (%s, CURDATE(), %s, %s, NOW(), NOW()) ON DUPLICATE KEY UPDATE followers_count = VALUES(followers_count), tweets_count = VALUES(tweets_count)"""
+
+# Buffered metrics are written with one multi-row statement, which MySQLdb
+# only builds when every value is a parameter, so flush_metrics reads the
+# day and the time from the server and passes them in.
+_metrics_flush_sql = _metrics_sql.replace('CURDATE()', '%s').replace('NOW()', '%s')
+
+
 class Usage(Exception):
     def __init__(self, msg):
         self.msg = msg
 
 
+class MetricsBuffer(object):
+    """
+    Keeps the latest followers and statuses counts of each politician, so
+    that twitter_metrics is written once per flush instead of once per new
+    tweet. Counts can be added from any thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = collections.OrderedDict()
+        self.added = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, politician_id, followers_count, statuses_count):
+        with self.lock:
+            self.rows[politician_id] = (followers_count, statuses_count)
+            self.added += 1
+
+    def take(self):
+        """
+        Empties the buffer. Returns (politician_id, followers_count,
+        statuses_count) rows and the number of counts they replace.
+        """
+        with self.lock:
+            (rows, added) = (self.rows, self.added)
+            self.rows = collections.OrderedDict()
+            self.added = 0
+        return ([(politician_id,) + counts for (politician_id, counts) in rows.items()], added)
+
+    def restore(self, rows, added):
+        """
+        Puts back rows that could not be written, unless newer counts have
+        been added since.
+        """
+        with self.lock:
+            for (politician_id, followers_count, statuses_count) in rows:
+                self.rows.setdefault(politician_id, (followers_count, statuses_count))
+            self.added += added
+
+
 class DeletedTweetsWorker(object):
-    def __init__(self, heart, images):
+    """
+    With --workers, each worker process runs one of these. `tweet_locks`
+    (politwoops.pool.TweetLocks) keeps them from handling the same tweet at
+    once, on_jobs(n) is called after each n jobs are done and `index` is the
+    worker's number.
+    """
+    # A MetricsBuffer when metrics_flush_interval is set.
+    metrics = None
+    # A politwoops.tweetindex.TweetIndex when tweet_index is on.
+    tweet_index = None
+    def __init__(self, heart, images, tweet_locks=None, on_jobs=None, index=None):
         self.heart = heart
         self.images = images
+        self.tweet_locks = tweet_locks
+        self.on_jobs = on_jobs
+        self.index = index
         self.get_config()
 
-    def init_database(self):
-        log.debug("Making DB connection")
-        self.database = MySQLdb.connect(
-            host=self.config.get('database', 'host'),
-            port=int(self.config.get('database', 'port')),
-            db=self.config.get('database', 'database'),
-            user=self.config.get('database', 'username'),
-            passwd=self.config.get('database', 'password'),
-            charset="utf8mb4",
-            use_unicode=True
-        )
-        self.database.autocommit(True) # needed if you're using InnoDB
-        self.database.cursor().execute('SET NAMES UTF8MB4')
+    def init_database(self, size=1):
+        self.pool = politwoops.database.ConnectionPool(size, self.config)
+        self.database = None
+        self.retry_seconds = self.config.getint('database', 'retry_seconds', fallback=30)
+        self.retry_delay = self.config.getint('database', 'retry_delay', fallback=60)
+
+    @contextlib.contextmanager
+    def using_database(self):
+        """
+        Binds self.database to a connection from the pool for the duration
+        of the block.
+        """
+        with self.pool.connection() as database:
+            self.database = database
+            try:
+                yield database
+            finally:
+                self.database = None
+
+    def with_retries(self, fn, *args):
+        """
+        Calls fn(*args) with self.database bound. After a transient database
+        error, fn is called again from the start on a connection from the
+        pool, which replaces one the server has dropped, until it succeeds
+        or retry_seconds have passed. The handlers can be replayed this way
+        because a batch is a single transaction and the single-tweet
+        statements are upserts.
+        """
+        deadline = time.time() + self.retry_seconds
+        delay = 0
+        while True:
+            try:
+                with self.using_database():
+                    return fn(*args)
+            except MySQLdb.Error as e:
+                if not politwoops.database.transient(e) or time.time() + delay > deadline:
+                    raise
+                log.warning("Transient database error in {fn}, retrying in {delay:.2f} s: {error}",
+                            fn=fn.__name__, delay=delay, error=e)
+            time.sleep(delay)
+            delay = min(max(delay * 2, 0.05), 2)
+
+    def database_unavailable(self, error, what):
+        """
+        Logs a transient error that outlasted with_retries, or raises any
+        other error.
+        """
+        if not politwoops.database.transient(error):
+            raise error
+        log.error("Database unavailable for {sec} s, {what}: {error}",
+                  sec=self.retry_seconds, what=what, error=error)
 
     def init_beanstalk(self):
         tweets_tube = self.config.get('beanstalk', 'tweets_tube')
         screenshot_tube = self.config.get('beanstalk', 'screenshot_tube')
+        self.job_encoding = self.config.get('beanstalk', 'job_encoding', fallback='json')
 
         log.info("Initiating beanstalk connection. Watching {watch}.", watch=tweets_tube)
         if self.images:
@@ -79,13 +194,6 @@ class DeletedTweetsWorker(object):
                                                     watch=tweets_tube,
                                                     use=screenshot_tube)
 
-    def _database_keepalive(self):
-        cur = self.database.cursor()
-        cur.execute("""SELECT id FROM tweets LIMIT 1""")
-        cur.fetchone()
-        cur.close()
-        log.info("Executed database connection keepalive query.")
-
     def get_config(self):
         log.debug("Reading config ...")
         self.config = tweetsclient.Config().get()
@@ -103,24 +211,285 @@ class DeletedTweetsWorker(object):
         log.info("Found politicians: {politicians}", politicians=politicians)
         return ids, politicians
 
+    def refresh_users(self):
+        users, politicians = self.get_users()
+        added = set(users) - set(self.users)
+        removed = set(self.users) - set(users)
+        if added or removed:
+            log.notice("Politicians changed: {added} added, {removed} removed",
+                       added=sorted(added), removed=sorted(removed))
+        self.users, self.politicians = users, politicians
+        self.users_refreshed = time.time()
+
     def run(self):
         mimetypes.init()
         self.init_database()
         self.init_beanstalk()
-        self.users, self.politicians = self.get_users()
-
+        self.users, self.politicians = self.with_retries(self.get_users)
+        self.users_refreshed = time.time()
+        refresh_interval = self.config.getint('tweets-client', 'refresh_interval', fallback=300)
+        batch_size = self.config.getint('tweets-client', 'worker_batch_size', fallback=1)
+        batch_wait = self.config.getint('tweets-client', 'worker_batch_wait_ms', fallback=200) / 1000.0
+        if batch_size > 1:
+            log.notice("Handling up to {n} jobs per transaction.", n=batch_size)
+        self.with_retries(self.init_tweet_index, batch_size)
+        self.init_pipeline_latency()
+        self.start_housekeeping_thread()
+        self.init_metrics()
+
+        try:
+            self.work(refresh_interval, batch_size, batch_wait)
+        finally:
+            if self.metrics:
+                self.with_retries(self.flush_metrics)
+
+    def work(self, refresh_interval, batch_size, batch_wait):
         while True:
-            time.sleep(0.2)
-            if self.heart.beat():
-                self._database_keepalive()
-            reserve_timeout = max(self.heart.interval.total_seconds() * 0.1, 2)
-            job = self.beanstalk.reserve(timeout=reserve_timeout)
-            if job:
-                self.handle_tweet(job.body)
-                job.delete()
-
-    def handle_tweet(self, job_body):
-        tweet = anyjson.deserialize(job_body)
+            if refresh_interval and time.time() - self.users_refreshed >= refresh_interval:
+                try:
+                    self.with_retries(self.refresh_users)
+                except MySQLdb.Error as e:
+                    self.database_unavailable(e, "keeping the politicians")
+                    self.users_refreshed = time.time()
+            if self.metrics_due():
+                try:
+                    self.with_retries(self.flush_metrics)
+                except MySQLdb.Error as e:
+                    self.database_unavailable(e, "keeping the metrics for the next flush")
+            # Block until a job arrives, the users are due to be refreshed
+            # or buffered metrics are due to be written.
+            if refresh_interval:
+                reserve_timeout = max(int(self.users_refreshed + refresh_interval - time.time()), 1)
+            else:
+                reserve_timeout = 60
+            if self.metrics:
+                reserve_timeout = min(reserve_timeout,
+                                      max(int(self.metrics_flushed + self.metrics_flush_interval - time.time()), 1))
+            # tweets-client queues delete notices at a more urgent priority
+            # than statuses, so they are reserved first.
+            if batch_size > 1:
+                jobs = self.reserve_batch(reserve_timeout, batch_size, batch_wait)
+                if jobs:
+                    tweets = [politwoops.envelope.unpack(job.body) for job in jobs]
+                    try:
+                        with self.holding(tweets):
+                            self.with_retries(self.handle_batch, tweets)
+                    except MySQLdb.Error as e:
+                        self.release_jobs(jobs, e)
+                    else:
+                        self.record_pipeline(jobs, tweets)
+                        for job in jobs:
+                            job.delete()
+                        if self.on_jobs:
+                            self.on_jobs(len(jobs))
+            else:
+                job = self.beanstalk.reserve(timeout=reserve_timeout)
+                if job:
+                    job.reserved_at = time.monotonic()
+                    tweet = politwoops.envelope.unpack(job.body)
+                    try:
+                        with self.holding([tweet]):
+                            self.with_retries(self.handle_tweet, tweet)
+                    except MySQLdb.Error as e:
+                        self.release_jobs([job], e)
+                    else:
+                        self.record_pipeline([job], [tweet])
+                        job.delete()
+                        if self.on_jobs:
+                            self.on_jobs(1)
+            self.log_latency()
+
+    def release_jobs(self, jobs, error):
+        """
+        Puts jobs that could not be handled back in the tube for another
+        try in retry_delay seconds, or raises a non-transient error.
+        """
+        self.database_unavailable(error, "releasing {0} jobs for {1} s".format(len(jobs), self.retry_delay))
+        for job in jobs:
+            job.release(priority=politwoops.utils.job_priority(job), delay=self.retry_delay)
+
+    def init_pipeline_latency(self):
+        """
+        Starts the pipeline latency histograms, written to
+        latency_directory if it is set and served over HTTP on localhost if
+        latency_port is set; worker N of a pool serves them on
+        latency_port + 1 + N.
+        """
+        self.pipeline = politwoops.latency.PipelineLatency()
+        self.latency_interval = self.config.getint('tweets-client', 'latency_interval', fallback=60)
+        self.pipeline_written = self.pipeline_logged = time.time()
+        self.pipeline_path = None
+        directory = self.config.get('tweets-client', 'latency_directory', fallback='')
+        if directory:
+            # Named like the heartbeat file: politwoops-worker.py.latency, or
+            # politwoops-worker.py.N.latency for worker N of a pool.
+            name = _script_ if self.index is None else '{0}.{1}'.format(_script_, self.index)
+            self.pipeline_path = os.path.join(directory, name + '.latency')
+        port = self.config.get('tweets-client', 'latency_port', fallback='')
+        if port:
+            port = int(port)
+            if self.index is not None:
+                port += 1 + self.index
+            try:
+                self.pipeline.serve(port)
+            except OSError as e:
+                log.error("Unable to serve pipeline latency on port {port}: {e}", port=port, e=e)
+
+    def record_pipeline(self, jobs, tweets):
+        """
+        Records the pipeline latency of the jobs just committed that were
+        about politicians' tweets.
+        """
+        committed = time.monotonic()
+        for (job, tweet) in zip(jobs, tweets):
+            if 'delete' in tweet:
+                tracked = tweet['delete']['status']['user_id'] in self.users
+            else:
+                tracked = 'user' in tweet and tweet['user']['id'] in self.users
+            if tracked:
+                self.pipeline.record(tweet, job.body, job.reserved_at, committed)
+
+    def log_latency(self):
+        """
+        Logs the latency from Twitter to the database every
+        latency_interval seconds.
+        """
+        if time.time() - self.pipeline_logged < self.latency_interval:
+            return
+        self.pipeline_logged = time.time()
+        self.pipeline.log_summary(log)
+
+    def write_pipeline_latency(self):
+        """
+        Writes the pipeline latency to latency_directory every
+        latency_interval seconds.
+        """
+        if self.pipeline_path is None or time.time() - self.pipeline_written < self.latency_interval:
+            return
+        self.pipeline_written = time.time()
+        try:
+            self.pipeline.write(self.pipeline_path)
+        except (IOError, OSError) as e:
+            log.error("Unable to write pipeline latency: {0}", e)
+
+    def init_tweet_index(self, batch_size):
+        """
+        Loads the ids and deleted flags of the tweets table, if tweet_index
+        is on, so batches need not look up which of their tweets are stored.
+        Single jobs are upserts that need no lookup, so without batches the
+        index is not loaded.
+        """
+        if not self.config.getboolean('tweets-client', 'tweet_index', fallback=False):
+            return
+        if batch_size <= 1:
+            log.warning("The tweet index is only used with a worker_batch_size above 1.")
+            return
+        if self.tweet_locks is not None:
+            # Other processes write to the table too, which would leave the
+            # index out of date.
+            log.warning("The tweet index is not used with --workers.")
+            return
+        started = time.time()
+        self.tweet_index = politwoops.tweetindex.TweetIndex()
+        cursor = self.database.cursor(MySQLdb.cursors.SSCursor)
+        cursor.execute("SELECT `id`, `deleted` FROM `tweets` ORDER BY `id`")
+        self.tweet_index.load(cursor)
+        cursor.close()
+        log.notice("Loaded {n} tweets into the tweet index in {sec:.1f} s.",
+                   n=len(self.tweet_index), sec=time.time() - started)
+
+    def init_metrics(self):
+        self.metrics_flush_interval = self.config.getint('tweets-client', 'metrics_flush_interval', fallback=60)
+        self.metrics = MetricsBuffer() if self.metrics_flush_interval else None
+        self.metrics_flushed = time.time()
+
+    def metrics_due(self):
+        return (self.metrics is not None and
+                time.time() - self.metrics_flushed >= self.metrics_flush_interval)
+
+    def record_metrics(self, cursor, metrics):
+        """
+        Writes the twitter_metrics rows of new tweets, given as
+        (politician_id, followers_count, statuses_count), or buffers them
+        until the next flush_metrics.
+        """
+        if self.metrics is None:
+            cursor.executemany(_metrics_sql, metrics)
+        else:
+            for row in metrics:
+                self.metrics.add(*row)
+
+    def flush_metrics(self):
+        """
+        Writes the buffered metrics with a single multi-row upsert. They are
+        dated by the server's CURDATE() at the time of the flush, like
+        unbuffered metrics are at the time of the insert.
+        """
+        self.metrics_flushed = time.time()
+        (rows, added) = self.metrics.take()
+        if not rows:
+            return
+        try:
+            cursor = self.database.cursor()
+            cursor.execute("SELECT CURDATE(), NOW()")
+            (today, now) = cursor.fetchone()
+            cursor.executemany(_metrics_flush_sql, [(politician_id, today, followers_count, statuses_count, now, now)
+                                                    for (politician_id, followers_count, statuses_count) in rows])
+        except:
+            self.metrics.restore(rows, added)
+            raise
+        log.notice("Wrote {rows} twitter_metrics rows for {added} new tweets, coalescing {coalesced} writes.",
+                   rows=len(rows), added=added, coalesced=added - len(rows))
+
+    def holding(self, tweets):
+        """
+        Locks the tweets against other worker processes, if there are any.
+        """
+        if self.tweet_locks is None:
+            return contextlib.nullcontext()
+        return self.tweet_locks.holding(politwoops.utils.message_tweet_id(tweet)
+                                        for tweet in tweets)
+
+    def start_housekeeping_thread(self):
+        """
+        Beats the heart and pings the idle database connection from a
+        background thread, so neither ever holds up a reserved job.
+        """
+        def _housekeeping():
+            while True:
+                self.heart.sleep()
+                if not self.heart.beat():
+                    continue
+                self.pool.ping_idle()
+                self.write_pipeline_latency()
+
+        housekeeping = threading.Thread(target=_housekeeping, name='housekeeping')
+        # This causes the housekeeping thread to die with the main thread
+        housekeeping.daemon = True
+        housekeeping.start()
+
+    def reserve_batch(self, timeout, batch_size, batch_wait):
+        """
+        Waits up to timeout seconds for a job, then collects up to
+        batch_size jobs for no longer than batch_wait seconds. beanstalkd
+        waits in whole seconds, so once less than a second is left only
+        jobs that are already ready are added.
+        """
+        job = self.beanstalk.reserve(timeout=timeout)
+        if not job:
+            return []
+        job.reserved_at = time.monotonic()
+        jobs = [job]
+        deadline = time.time() + batch_wait
+        while len(jobs) < batch_size:
+            job = self.beanstalk.reserve(timeout=max(int(deadline - time.time()), 0))
+            if not job:
+                break
+            job.reserved_at = time.monotonic()
+            jobs.append(job)
+        return jobs
+
+    def handle_tweet(self, tweet):
         if 'delete' in tweet:
             if tweet['delete']['status']['user_id'] in self.users.keys():
                 self.handle_deletion(tweet)
@@ -131,23 +500,111 @@ class DeletedTweetsWorker(object):
 #                if self.images and 'entities' in tweet:
 #                    # Queue the tweet for screenshots and/or image mirroring
 #                    log.notice("Queued tweet {0} for entity archiving.", tweet['id'])
-#                    self.beanstalk.put(anyjson.serialize(tweet))
-
+#                    self.beanstalk.put(politwoops.envelope.pack(tweet, self.job_encoding))
+
+
+    def handle_batch(self, tweets):
+        """
+        Applies a batch of decoded jobs in a single transaction, using multi-row
+        statements. The result is the same as handling the jobs one at a
+        time, whichever order a tweet and its deletion come in.
+        """
+        new_tweets = collections.OrderedDict()
+        deletions = collections.OrderedDict()
+        # Tweets whose deletion came first, which one at a time would have
+        # been updates of the deleted row rather than inserts.
+        deleted_first = set()
+        for tweet in tweets:
+            if 'delete' in tweet:
+                if tweet['delete']['status']['user_id'] in self.users.keys():
+                    deletions[tweet['delete']['status']['id']] = tweet
+            elif 'user' in tweet and (tweet['user']['id'] in self.users.keys()):
+                if tweet['id'] in deletions and tweet['id'] not in new_tweets:
+                    deleted_first.add(tweet['id'])
+                new_tweets[tweet['id']] = tweet
+        if not new_tweets and not deletions:
+            return
+
+        # Renames are undone in the cache if the transaction is rolled back.
+        names = dict((tweet['user']['id'], self.politicians[tweet['user']['id']])
+                     for tweet in new_tweets.values())
+        cursor = self.database.cursor()
+        cursor.execute("START TRANSACTION")
+        try:
+            ids = list(set(new_tweets) | set(deletions))
+            if self.tweet_index is not None:
+                previous = self.tweet_index.lookup(ids)
+            else:
+                cursor.execute("SELECT `id`, `deleted` FROM `tweets` WHERE `id` IN ({0})".format(
+                    ', '.join(['%s'] * len(ids))), ids)
+                previous = dict((row[0], row[1]) for row in cursor.fetchall())
+
+            inserts, updates, metrics = [], [], []
+            for tweet in new_tweets.values():
+                values = self.new_tweet_values(tweet)
+                self.handle_possible_rename(tweet)
+                if tweet['id'] in previous:
+                    updates.append(values + (tweet['id'],))
+                else:
+                    inserts.append((tweet['id'],) + values)
+                    if tweet['id'] not in deleted_first:
+                        metrics.append((self.users[tweet['user']['id']],
+                                        tweet['user']['followers_count'],
+                                        tweet['user']['statuses_count']))
+            if inserts:
+                cursor.executemany(_insert_tweet_sql, inserts)
+            if updates:
+                cursor.executemany(_update_tweet_sql, updates)
+            if metrics:
+                self.record_metrics(cursor, metrics)
+
+            deleted = [tweet_id for tweet_id in new_tweets if previous.get(tweet_id) == 1]
+            for tweet_id in deleted:
+                log.warn("Tweet deleted {0} before it came!", tweet_id)
+            for tweet_id in deletions:
+                log.notice("Deleted tweet {0}", tweet_id)
+            existing = [tweet_id for tweet_id in deletions
+                        if tweet_id in previous or tweet_id in new_tweets]
+            missing = [(tweet_id,) for tweet_id in deletions
+                       if tweet_id not in previous and tweet_id not in new_tweets]
+            if existing:
+                cursor.execute("UPDATE `tweets` SET `modified` = NOW(), `deleted` = 1 WHERE `id` IN ({0})".format(
+                    ', '.join(['%s'] * len(existing))), existing)
+            if missing:
+                cursor.executemany(_delete_tweet_sql, missing)
+            deleted.extend(deletions)
+            if deleted:
+                cursor.execute("REPLACE INTO `deleted_tweets` SELECT * FROM `tweets` WHERE `id` IN ({0}) AND `content` IS NOT NULL".format(
+                    ', '.join(['%s'] * len(deleted))), deleted)
+            self.database.commit()
+        except:
+            self.politicians.update(names)
+            self.database.rollback()
+            raise
+
+        if self.tweet_index is not None:
+            for tweet_id in new_tweets:
+                self.tweet_index.set(tweet_id, previous.get(tweet_id) == 1)
+            for tweet_id in deletions:
+                self.tweet_index.set(tweet_id, 1)
 
     def handle_deletion(self, tweet):
         log.notice("Deleted tweet {0}", tweet['delete']['status']['id'])
         cursor = self.database.cursor()
-        cursor.execute("""SELECT COUNT(*) FROM `tweets` WHERE `id` = %s""", (tweet['delete']['status']['id'],))
-        num_previous = cursor.fetchone()[0]
-        if num_previous > 0:
-            cursor.execute("""UPDATE `tweets` SET `modified` = NOW(), `deleted` = 1 WHERE id = %s""", (tweet['delete']['status']['id'],))
-        else:
-            cursor.execute("""REPLACE INTO `tweets` (`id`, `deleted`, `modified`, `created`) VALUES (%s, 1, NOW(), NOW())""", (tweet['delete']['status']['id'],))
-        self.copy_tweet_to_deleted_table(tweet['delete']['status']['id'])
-
-    def handle_new(self, tweet):
+        cursor.execute(_delete_tweet_sql, (tweet['delete']['status']['id'],))
+        if self.tweet_index is not None:
+            self.tweet_index.set(tweet['delete']['status']['id'], 1)
+        # A row that was only just inserted has no content to copy.
+        if cursor.rowcount != 1:
+            self.copy_tweet_to_deleted_table(tweet['delete']['status']['id'])
+
+    def new_tweet_values(self, tweet):
+        """
+        Logs a new tweet and returns its user_name, politician_id, content,
+        tweet, retweeted_id, retweeted_content and retweeted_user_name.
+        """
         if 'extended_tweet' in tweet:
-            log.info("Extended tweet {0}", tweet.get('extended_tweet'))
+            log.debug("Extended tweet {0}", tweet.get('extended_tweet'))
             tweet_text = tweet.get('extended_tweet', {}).get('full_text')
         else:
             tweet_text = tweet.get('text')
@@ -155,17 +612,7 @@ class DeletedTweetsWorker(object):
                   tweet=tweet.get('id'),
                   user_id=tweet.get('user', {}).get('id'),
                   screen_name=tweet.get('user', {}).get('screen_name'))
-        log.notice("Full text: {0}", tweet_text)
-        self.handle_possible_rename(tweet)
-        cursor = self.database.cursor()
-        cursor.execute("""SELECT COUNT(*), `deleted` FROM `tweets` WHERE `id` = %s""", (tweet['id'],))
-
-        info = cursor.fetchone()
-        num_previous = info[0]
-        if info[1] is not None:
-            was_deleted = (int(info[1]) == 1)
-        else:
-            was_deleted = False
+        log.info("Full text: {0}", tweet_text)
 
         retweeted_id = None
         retweeted_content = None
@@ -176,50 +623,65 @@ class DeletedTweetsWorker(object):
             retweeted_content = replace_highpoints(tweet['retweeted_status']['text'])
             retweeted_user_name = tweet['retweeted_status']['user']['screen_name']
 
-        if num_previous > 0:
-            cursor.execute("""UPDATE `tweets` SET `user_name` = %s, `politician_id` = %s, `content` = %s, `tweet`=%s, `retweeted_id`=%s, `retweeted_content`=%s, `retweeted_user_name`=%s, `modified`= NOW() WHERE id = %s""",
-                           (tweet['user']['screen_name'],
-                            self.users[tweet['user']['id']],
-                            replace_highpoints(tweet_text,""),
-                            replace_highpoints(anyjson.serialize(tweet),""),
-                            retweeted_id,
-                            retweeted_content,
-                            retweeted_user_name,
-                            tweet['id']))
-            log.info("Updated tweet {0}", tweet.get('id'))
-        else:
-            cursor.execute("""INSERT INTO `tweets` (`id`, `user_name`, `politician_id`, `content`, `created`, `modified`, `tweet`, retweeted_id, retweeted_content, retweeted_user_name) VALUES(%s, %s, %s, %s, NOW(), NOW(), %s, %s, %s, %s)""",
-                           (tweet['id'],
-                            tweet['user']['screen_name'],
-                            self.users[tweet['user']['id']],
-                            replace_highpoints(tweet_text,""),
-                            replace_highpoints(anyjson.serialize(tweet),""),
-                            retweeted_id,
-                            retweeted_content,
-                            retweeted_user_name))
-            log.info("Inserted new tweet {0}", tweet.get('id'))
-
-            cursor.execute("""INSERT INTO `twitter_metrics` (`politician_id`, `date`, `followers_count`, `tweets_count`, `created_at`, `updated_at`) VALUES (%s, CURDATE(), %s, %s, NOW(), NOW()) ON DUPLICATE KEY UPDATE followers_count = VALUES(followers_count), tweets_count = VALUES(tweets_count)""",
-                (self.users[tweet['user']['id']],
-                tweet['user']['followers_count'],
-                tweet['user']['statuses_count']))
-
-        if was_deleted:
-            log.warn("Tweet deleted {0} before it came!", tweet.get('id'))
-            self.copy_tweet_to_deleted_table(tweet['id'])
+        return (tweet['user']['screen_name'],
+                self.users[tweet['user']['id']],
+                replace_highpoints(tweet_text,""),
+                replace_highpoints(codec.serialize(tweet),""),
+                retweeted_id,
+                retweeted_content,
+                retweeted_user_name)
+
+    def handle_new(self, tweet):
+        values = self.new_tweet_values(tweet)
+        # Unbuffered metrics are written in one transaction with the tweet.
+        # Were the upsert committed on its own and the connection lost
+        # before the metrics, the replay would find the row already there
+        # and never write them.
+        transaction = self.metrics is None
+        names = {tweet['user']['id']: self.politicians[tweet['user']['id']]}
+        cursor = self.database.cursor()
+        if transaction:
+            cursor.execute("START TRANSACTION")
+        try:
+            self.handle_possible_rename(tweet)
+            cursor.execute(_upsert_tweet_sql, (tweet['id'],) + values)
+            inserted = cursor.rowcount == 1
+            # If the row was already there, _upsert_tweet_sql passes its
+            # deleted flag back as the insert id.
+            deleted_first = not inserted and cursor.lastrowid == 1
+            if inserted:
+                log.info("Inserted new tweet {0}", tweet.get('id'))
+
+                self.record_metrics(cursor, [(self.users[tweet['user']['id']],
+                                              tweet['user']['followers_count'],
+                                              tweet['user']['statuses_count'])])
+            else:
+                log.info("Updated tweet {0}", tweet.get('id'))
+                if deleted_first:
+                    log.warn("Tweet deleted {0} before it came!", tweet.get('id'))
+                    self.copy_tweet_to_deleted_table(tweet['id'])
+            if transaction:
+                self.database.commit()
+        except:
+            if transaction:
+                self.politicians.update(names)
+                self.database.rollback()
+            raise
+        if self.tweet_index is not None:
+            self.tweet_index.set(tweet['id'], deleted_first)
 
     def copy_tweet_to_deleted_table(self, tweet_id):
         cursor = self.database.cursor()
-        cursor.execute("""REPLACE INTO `deleted_tweets` SELECT * FROM `tweets` WHERE `id` = %s AND `content` IS NOT NULL""" % (tweet_id))
+        cursor.execute("""REPLACE INTO `deleted_tweets` SELECT * FROM `tweets` WHERE `id` = %s AND `content` IS NOT NULL""", (tweet_id,))
 
     def handle_possible_rename(self, tweet):
         tweet_user_name = tweet['user']['screen_name']
         tweet_user_id = tweet['user']['id']
         current_user_name = self.politicians[tweet_user_id]
         if current_user_name != tweet_user_name:
-            self.politicians[tweet_user_id] = tweet_user_name
             cursor= self.database.cursor()
             cursor.execute("""UPDATE `politicians` SET `user_name` = %s WHERE `id` = %s""", (tweet_user_name, self.users[tweet_user_id]))
+            self.politicians[tweet_user_id] = tweet_user_name
 
 
     def send_alert(self, username, created, text):
@@ -264,9 +726,16 @@ class DeletedTweetsWorker(object):
 
 
 def main(args):
-    signal.signal(signal.SIGHUP, politwoops.utils.restart_process)
-
-    log_handler = politwoops.utils.configure_log_handler(_script_, args.loglevel, args.output)
+    # Restarts unwind the main thread like SIGTERM does, so a pool stops its
+    # workers before the process is replaced.
+    signal.signal(signal.SIGHUP, politwoops.utils.request_restart)
+    # Exit through the finally blocks, which write buffered metrics.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    log_handler = politwoops.utils.configure_log_handler(_script_, args.loglevel, args.output,
+                                                         http_debug=args.http_debug,
+                                                         loggers=[log])
+    restart = False
     with logbook.NullHandler():
         with log_handler.applicationbound():
             try:
@@ -275,9 +744,12 @@ def main(args):
                 if args.images:
                     log.notice("Screenshot support enabled.")
 
+                if args.workers > 1:
+                    return run_pool(args)
+
                 with politwoops.utils.Heart() as heart:
                     politwoops.utils.start_watchdog_thread(heart)
-                    app = DeletedTweetsWorker(heart, args.images)
+                    app = create_worker(heart, args.images)
                     if args.restart:
                         return politwoops.utils.run_with_restart(app.run)
                     else:
@@ -292,6 +764,228 @@ def main(args):
 
             except KeyboardInterrupt:
                 log.notice("Killed by CTRL-C")
+            except politwoops.utils.Restart:
+                log.notice("Restarting on SIGHUP")
+                restart = True
+            finally:
+                log_handler.close()
+    if restart:
+        politwoops.utils.restart_process()
+
+
+class AsyncDeletedTweetsWorker(DeletedTweetsWorker):
+    """
+    Keeps up to two jobs per database connection in flight. An asyncio loop
+    reserves and deletes jobs while the handlers run on `connections`
+    threads, sharing a pool of as many database connections. Jobs for the
+    same tweet are handled one after another, in the order they were
+    reserved.
+    """
+    def __init__(self, heart, images, connections=8, **kwargs):
+        super(AsyncDeletedTweetsWorker, self).__init__(heart, images, **kwargs)
+        self.connections = connections
+        self._thread = threading.local()
+        self.failure = None
+
+    # The handlers use whichever connection belongs to the thread they run on.
+    @property
+    def database(self):
+        return self._thread.database
+
+    @database.setter
+    def database(self, connection):
+        self._thread.database = connection
+
+    def run(self):
+        mimetypes.init()
+        return asyncio.run(self.run_async())
+
+    async def on_connection(self, fn, *args):
+        """
+        Runs fn on a handler thread with a connection from the pool,
+        retrying it after transient database errors.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.with_retries, fn, *args)
+
+    async def run_async(self):
+        loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.connections,
+                                                              thread_name_prefix='database')
+        self.init_database(self.connections)
+        log.notice("Handling jobs on {n} database connections.", n=self.connections)
+
+        tweets_tube = self.config.get('beanstalk', 'tweets_tube')
+        log.info("Initiating beanstalk connection. Watching {watch}.", watch=tweets_tube)
+        self.beanstalk = await politwoops.aiobeanstalk.Connection(
+            host=self.config.get('beanstalk', 'host'),
+            port=int(self.config.get('beanstalk', 'port'))).connect()
+        await self.beanstalk.watch(tweets_tube)
+
+        self.users, self.politicians = await self.on_connection(self.get_users)
+        self.users_refreshed = time.time()
+        if self.config.getboolean('tweets-client', 'tweet_index', fallback=False):
+            # Jobs are handled one at a time, as upserts.
+            log.warning("The tweet index is not used with worker_mode=asyncio.")
+        refresh_interval = self.config.getint('tweets-client', 'refresh_interval', fallback=300)
+        self.init_metrics()
+        self.init_pipeline_latency()
+        housekeeping = asyncio.ensure_future(self.housekeeping())
+
+        # The job that was reserved last for each tweet in flight.
+        self.tails = {}
+        slots = asyncio.Semaphore(self.connections * 2)
+        in_flight = set()
+        try:
+            while True:
+                if refresh_interval and time.time() - self.users_refreshed >= refresh_interval:
+                    try:
+                        await self.on_connection(self.refresh_users)
+                    except MySQLdb.Error as e:
+                        self.database_unavailable(e, "keeping the politicians")
+                        self.users_refreshed = time.time()
+                await slots.acquire()
+                # Deletes wait behind a reserve, so it only blocks while
+                # nothing is in flight. Otherwise an empty tube is polled
+                # again as jobs finish.
+                if in_flight:
+                    reserve_timeout = 0
+                elif refresh_interval:
+                    reserve_timeout = max(int(self.users_refreshed + refresh_interval - time.time()), 1)
+                else:
+                    reserve_timeout = 60
+                job = await self.beanstalk.reserve(timeout=reserve_timeout)
+                if job is None:
+                    slots.release()
+                    if in_flight:
+                        await asyncio.wait(in_flight, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                job.reserved_at = time.monotonic()
+                tweet = politwoops.envelope.unpack(job.body)
+                tweet_id = politwoops.utils.message_tweet_id(tweet)
+                previous = self.tails.get(tweet_id)
+                done = self.tails[tweet_id] = loop.create_future()
+                task = asyncio.ensure_future(self.process(job, tweet, tweet_id, previous, done, slots))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                self.log_latency()
+        except asyncio.CancelledError:
+            if self.failure is None:
+                raise
+            raise self.failure
+        finally:
+            housekeeping.cancel()
+            if in_flight:
+                await asyncio.wait(in_flight)
+            self.beanstalk.close()
+            if self.metrics:
+                await self.on_connection(self.flush_metrics)
+            self.executor.shutdown(wait=False)
+
+    async def process(self, job, tweet, tweet_id, previous, done, slots):
+        try:
+            if previous is not None:
+                await previous
+            try:
+                await self.on_connection(self.handle_locked, tweet)
+            except MySQLdb.Error as e:
+                self.database_unavailable(e, "releasing job {0} for {1} s".format(job.job_id, self.retry_delay))
+                await job.release(delay=self.retry_delay)
+            else:
+                self.record_pipeline([job], [tweet])
+                await job.delete()
+                if self.on_jobs:
+                    self.on_jobs(1)
+        except Exception as e:
+            # Left reserved, the job is retried once its time to run is up.
+            log.error("Failed to handle job {0}: {1}", job.job_id, e)
+            if self.failure is None:
+                self.failure = e
+                self.main_task.cancel()
+        finally:
+            done.set_result(None)
+            if self.tails.get(tweet_id) is done:
+                del self.tails[tweet_id]
+            slots.release()
+
+    def handle_locked(self, tweet):
+        with self.holding([tweet]):
+            self.handle_tweet(tweet)
+
+    async def housekeeping(self):
+        """
+        Beats the heart, pings the idle database connections and writes
+        buffered metrics when they are due.
+        """
+        while True:
+            await asyncio.sleep(self.heart.interval.total_seconds() * 0.10)
+            if self.metrics_due():
+                try:
+                    await self.on_connection(self.flush_metrics)
+                except Exception as e:
+                    log.error("Writing twitter_metrics failed: {0}", e)
+            if self.heart.beat():
+                await asyncio.get_running_loop().run_in_executor(None, self.pool.ping_idle)
+                self.write_pipeline_latency()
+
+
+def create_worker(heart, images, **kwargs):
+    """
+    Returns the worker for the configured worker_mode.
+    """
+    config = tweetsclient.Config().get()
+    worker_mode = config.get('tweets-client', 'worker_mode', fallback='sync')
+    if worker_mode == 'asyncio':
+        return AsyncDeletedTweetsWorker(heart, images,
+                                        connections=config.getint('tweets-client', 'worker_connections', fallback=8),
+                                        **kwargs)
+    elif worker_mode == 'sync':
+        return DeletedTweetsWorker(heart, images, **kwargs)
+    raise ValueError("Unrecognized worker_mode: {0}".format(worker_mode))
+
+
+def run_pool(args):
+    """
+    Runs args.workers worker processes. The parent only supervises them and
+    keeps a heartbeat of its own; each child has the heartbeat file
+    politwoops-worker.py.N. On a restart the parent stops and reaps every
+    child before it is replaced.
+    """
+    config = tweetsclient.Config().get()
+    # Named after the heartbeat and kept between runs, so every pool of this
+    # script on the host locks the same file.
+    lock_path = os.path.join(tempfile.gettempdir(), '{0}.locks'.format(_script_))
+    tweet_locks = politwoops.pool.TweetLocks(lock_path)
+
+    def run_child(index):
+        # Threads, including a background log writer, do not survive the
+        # fork, so the child sets up logging afresh. A heartbeat failure
+        # ends the child, and the parent starts a new one.
+        signal.signal(signal.SIGHUP, lambda signum, frame: sys.exit(1))
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        log_handler = politwoops.utils.configure_log_handler(_script_, args.loglevel, args.output,
+                                                             loggers=[log])
+        with log_handler.applicationbound():
+            try:
+                with politwoops.utils.Heart('{0}.{1}'.format(_script_, index)) as heart:
+                    politwoops.utils.start_watchdog_thread(heart)
+                    app = create_worker(heart, args.images, tweet_locks=tweet_locks,
+                                        on_jobs=lambda n: pool.jobs_done(index, n), index=index)
+                    return app.run()
+            except Exception as e:
+                log.exception("Worker {0} failed: {1}", index, e)
+                return 1
+            finally:
+                log_handler.close()
+
+    pool = politwoops.pool.WorkerPool(args.workers, run_child,
+                                      stats_interval=config.getint('tweets-client', 'latency_interval', fallback=60))
+    log.notice("Running {n} worker processes.", n=args.workers)
+    with politwoops.utils.Heart() as heart:
+        politwoops.utils.start_heartbeat_thread(heart)
+        politwoops.utils.start_watchdog_thread(heart)
+        pool.run()
 
 
 if __name__ == "__main__":
@@ -308,6 +1002,10 @@ if __name__ == "__main__":
                              help='Whether to screenshot links or mirror images linked in tweets.')
     args_parser.add_argument('--restart', default=False, action='store_true',
                              help='Restart when an error cannot be handled.')
+    args_parser.add_argument('--workers', metavar='N', type=int, default=1,
+                             help='Number of worker processes (default: 1)')
+    args_parser.add_argument('--http-debug', default=False, action='store_true',
+                             help='Log HTTP traffic at the wire level.')
 
     args = args_parser.parse_args()
     sys.exit(main(args))
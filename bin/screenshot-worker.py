@@ -16,11 +16,8 @@ import subprocess
 import threading
 import argparse
 import signal
-import contextlib
 from tempfile import NamedTemporaryFile
 
-import anyjson
-import MySQLdb
 import requests
 import logbook
 from boto.s3.connection import S3Connection
@@ -140,33 +137,12 @@ def reduce_url_list(urls):
     return unique_urls
 
 
-@contextlib.contextmanager
-def database_cursor(**connect_params):
-    database = MySQLdb.connect(**connect_params)
-    log.debug("Connected to database.")
-    database.autocommit(True) # needed if you're using InnoDB
-    cursor = database.cursor()
-    cursor.execute('SET NAMES UTF8MB4')
-    yield cursor
-    cursor.close()
-    database.close()
-    log.debug("Disconnected from database.")
-
-
 class TweetEntityWorker(object):
     def __init__(self, heart):
         super(TweetEntityWorker, self).__init__()
         self.heart = heart
         self.config = tweetsclient.Config().get()
-        self.db_connect_params = {
-            'host': self.config.get('database', 'host'),
-            'port': int(self.config.get('database', 'port')),
-            'db': self.config.get('database', 'database'),
-            'user': self.config.get('database', 'username'),
-            'passwd': self.config.get('database', 'password'),
-            'charset': "utf8mb4",
-            'use_unicode': True
-        }
+        self.database = politwoops.database.shared_pool()
 
     def run(self):
         mimetypes.init()
@@ -179,14 +155,12 @@ class TweetEntityWorker(object):
             use=None)
         log.debug("Connected to queue.")
 
+        politwoops.utils.start_heartbeat_thread(self.heart)
         while True:
-            time.sleep(0.2)
-            self.heart.beat()
-            reserve_timeout = max(self.heart.interval.total_seconds() * 0.1, 2)
-            job = self.beanstalk.reserve(timeout=reserve_timeout)
+            job = self.beanstalk.reserve(timeout=60)
             if job:
                 try:
-                    tweet = anyjson.deserialize(job.body)
+                    tweet = politwoops.envelope.unpack(job.body)
                     self.process_entities(tweet)
                     job.delete()
                 except Exception as e:
@@ -236,10 +210,12 @@ class TweetEntityWorker(object):
                 break
 
     def record_tweet_image(self, tweet, url):
-        with database_cursor(**self.db_connect_params) as cursor:
+        def insert(database):
+            cursor = database.cursor()
             cursor.execute("""INSERT INTO `tweet_images` (`tweet_id`, `url`, `created_at`, `updated_at`) VALUES(%s, %s, NOW(), NOW())""", (tweet['id'], url))
-            log.info("Inserted image into database for tweet {tweet}: {url}",
-                      tweet=tweet.get('id'), url=url)
+        self.database.call(insert)
+        log.info("Inserted image into database for tweet {tweet}: {url}",
+                 tweet=tweet.get('id'), url=url)
 
 
     def screenshot_entity_url(self, tweet, entity_index, url):
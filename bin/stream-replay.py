@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Serves recordings made by tweets-client (see record_file) as a local
+streaming endpoint, so tweets-client can be pointed at it with stream_host
+and stream_verify=no. Every connection receives all of the recordings, one
+after the other.
+"""
+
+import os
+import sys
+import ssl
+import time
+import argparse
+import socketserver
+import http.server
+
+import logbook
+
+import politwoops
+from politwoops.recording import read_recording, paced
+
+_script_ = (os.path.basename(__file__)
+            if __name__ == "__main__"
+            else __name__)
+log = logbook.Logger(_script_)
+
+
+class StreamHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.info(format % args)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        server = self.server
+        log.notice("Replaying {paths} to {client} at {speed} speed",
+                   paths=', '.join(server.recordings), client=self.client_address[0],
+                   speed='{0:g}x'.format(server.speed) if server.speed else 'maximum')
+        start = time.time()
+        count = 0
+        try:
+            for _ in range(server.loops or sys.maxsize):
+                # Each recording is paced on its own, skipping the time
+                # between the runs that recorded them.
+                for path in server.recordings:
+                    for data in paced(read_recording(path), server.speed):
+                        # Twitter's delimited=length framing: the message
+                        # length on a line of its own, then the message.
+                        message = data + b'\r\n'
+                        frame = b'%d\r\n%s' % (len(message), message)
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(frame), frame))
+                        count += 1
+            self.wfile.write(b'0\r\n\r\n')
+        except (IOError, OSError) as e:
+            log.notice("Client {client} went away: {e}", client=self.client_address[0], e=e)
+        elapsed = time.time() - start
+        log.notice("Sent {count} messages in {elapsed:.1f} seconds ({rate:.0f}/s)",
+                   count=count, elapsed=elapsed, rate=count / elapsed if elapsed else 0)
+
+
+class ReplayServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def main(args):
+    log_handler = politwoops.utils.configure_log_handler(_script_, args.loglevel, args.output)
+    with logbook.NullHandler():
+        with log_handler.applicationbound():
+            server = ReplayServer((args.host, args.port), StreamHandler)
+            server.recordings = args.recordings
+            server.speed = args.speed
+            server.loops = args.loops
+
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(args.certfile, args.keyfile)
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+
+            log.notice("Serving {paths} on https://{host}:{port}/",
+                       paths=', '.join(args.recordings), host=args.host, port=args.port)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                log.notice("Killed by CTRL-C")
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser(description=__doc__)
+    args_parser.add_argument('recordings', metavar='FILE', type=str, nargs='+',
+                             help='Recordings to replay, in order')
+    args_parser.add_argument('--speed', metavar='N', type=float, default=1.0,
+                             help='Replay N times faster than recorded, or as fast as possible if 0 (default: 1)')
+    args_parser.add_argument('--loops', metavar='N', type=int, default=1,
+                             help='Replay the recordings N times per connection, or forever if 0 (default: 1)')
+    args_parser.add_argument('--host', type=str, default='localhost',
+                             help='Address to listen on (default: localhost)')
+    args_parser.add_argument('--port', type=int, default=8443,
+                             help='Port to listen on (default: 8443)')
+    args_parser.add_argument('--certfile', type=str, required=True,
+                             help='TLS certificate; tweepy only connects over HTTPS')
+    args_parser.add_argument('--keyfile', type=str, required=True,
+                             help='TLS private key')
+    args_parser.add_argument('--loglevel', metavar='LEVEL', type=str,
+                             help='Logging level (default: notice)',
+                             default='notice',
+                             choices=('debug', 'info', 'notice', 'warning',
+                                      'error', 'critical'))
+    args_parser.add_argument('--output', metavar='DEST', type=str,
+                             default='-',
+                             help='Destination for log output (-, syslog, or filename)')
+    args = args_parser.parse_args()
+    sys.exit(main(args))
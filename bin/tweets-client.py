@@ -8,7 +8,12 @@ Copyright (c) 2010 Back-End-Front Web Development. All rights reserved.
 """
 
 import os
+import re
 import sys
+import time
+import asyncio
+import threading
+import concurrent.futures
 import argparse
 import signal
 import configparser
@@ -18,17 +23,14 @@ import socket
 # disable buffering
 #socket._fileobject.default_bufsize = 0
 
-import http.client
-http.client.HTTPConnection.debuglevel = 1
-
-import anyjson
 import logbook
-import MySQLdb
 
 # this is for consuming the streaming API
 import tweepy
+from pystalkd.Beanstalkd import DEFAULT_PRIORITY
 import tweetsclient
 import politwoops
+from politwoops import codec
 
 
 _script_ = (os.path.basename(__file__)
@@ -59,65 +61,282 @@ def dict_mget(thedict, keylist, default=None):
     result = reduce(lambda d, k: None if d is None else d.get(k), keylist, thedict)
     return result if result is not None else default
 
+# Twitter serializes the top-level status fields before any nested status, so
+# the first match of each of these belongs to the outer message.
+_delete_re = re.compile(r'^\s*\{\s*"delete"\s*:')
+_user_re = re.compile(r'"user"\s*:\s*\{\s*"id"\s*:\s*(\d+)')
+_screen_name_re = re.compile(r'"screen_name"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_id_str_re = re.compile(r'"id_str"\s*:\s*"(\d+)"')
+_reply_re = re.compile(r'"in_reply_to_status_id"\s*:\s*(null|\d+)')
+_retweet_re = re.compile(r'"retweeted_status"\s*:\s*\{')
+
+def peek_status(data):
+    """
+    Extracts the fields needed to route a status message without decoding
+    the whole payload. Returns None if the message is not a status or does
+    not look the way Twitter normally serializes one.
+    """
+    if _delete_re.match(data):
+        return None
+    user_match = _user_re.search(data)
+    if user_match is None:
+        return None
+    id_match = _id_str_re.search(data, 0, user_match.start())
+    reply_match = _reply_re.search(data, 0, user_match.start())
+    if id_match is None or reply_match is None:
+        return None
+    screen_name_match = _screen_name_re.search(data, user_match.end())
+    return DataRecord(user_id=int(user_match.group(1)),
+                      id_str=id_match.group(1),
+                      screen_name=screen_name_match.group(1) if screen_name_match else None,
+                      is_retweet=_retweet_re.search(data) is not None,
+                      is_reply=reply_match.group(1) != 'null')
+
+# Fields the workers do not need, dropped under the strip policy.
+_optional_fields = ('user.description, user.entities, quoted_status, place, '
+                    'retweeted_status.user.description, retweeted_status.user.entities, '
+                    'retweeted_status.quoted_status, retweeted_status.place')
+
+# Beanstalk hands out the most urgent (lowest numbered) ready job first, so
+# delete notices overtake the statuses queued ahead of them, and replies
+# deferred under the defer_replies policy go after everything else.
+_deferred_priority = 2 ** 32 - 1
+
 class TweetListener(tweepy.streaming.StreamListener):
-    def __init__(self, queue, *args, **kwargs):
+    def __init__(self, queue, backpressure=None, *args, **kwargs):
         super(TweetListener, self).__init__(*args, **kwargs)
         self.queue = queue
+        self.backpressure = backpressure
         self.config = tweetsclient.Config().get()
-        self.database = MySQLdb.connect(
-            host=self.config.get('database', 'host'),
-            port=int(self.config.get('database', 'port')),
-            db=self.config.get('database', 'database'),
-            user=self.config.get('database', 'username'),
-            passwd=self.config.get('database', 'password'),
-            charset="utf8mb4",
-            use_unicode=True
-        )
-        self.database.autocommit(True) # needed if you're using InnoDB
-        self.database.cursor().execute('SET NAMES UTF8MB4')
+        self.database = politwoops.database.shared_pool()
+        self.raw_ingest = self.config.getboolean('tweets-client', 'raw_ingest', fallback=False)
+        self.recent_ids = politwoops.ingest.RecentIds(
+            capacity=self.config.getint('tweets-client', 'dedup_capacity', fallback=100000),
+            window=self.config.getint('tweets-client', 'dedup_window', fallback=600))
+        self.strip_paths = [tuple(field.strip().split('.')) for field in
+                            self.config.get('tweets-client', 'backpressure_strip_fields',
+                                            fallback=_optional_fields).split(',')
+                            if field.strip()]
+        self.defer_seconds = self.config.getint('tweets-client', 'backpressure_defer_seconds', fallback=600)
+        self.delete_priority = self.config.getint('tweets-client', 'delete_priority', fallback=1024)
+        self.stamp_jobs = self.config.getboolean('beanstalk', 'job_stamps', fallback=False)
+        self.recorder = None
+        record_file = self.config.get('tweets-client', 'record_file', fallback=None)
+        if record_file:
+            self.recorder = politwoops.recording.StreamRecorder(record_file)
+        self.projection = None
+        self.archive = None
+        projection = self.config.get('tweets-client', 'projection', fallback='')
+        if projection.strip():
+            self.projection = politwoops.ingest.Projection(
+                [field.strip() for field in projection.split(',') if field.strip()])
+            archive_file = self.config.get('tweets-client', 'raw_archive', fallback=None)
+            if archive_file:
+                self.archive = politwoops.recording.StreamRecorder(archive_file)
         self.users = self.get_users()
 
     def get_users(self):
-        cursor = self.database.cursor()
-        q = "SELECT `twitter_id`, `user_name`, `id` FROM `politicians` where status IN (1,2)"
-        cursor.execute(q)
+        rows = self.database.call(self._select_politicians)
         ids = {}
-        for t in cursor.fetchall():
+        for t in rows:
             ids[t[0]] = t[2]
         return ids
 
+    @staticmethod
+    def _select_politicians(database):
+        q = "SELECT `twitter_id`, `user_name`, `id` FROM `politicians` where status IN (1,2)"
+        cursor = database.cursor()
+        cursor.execute(q)
+        return cursor.fetchall()
+
+    def refresh_users(self):
+        """
+        Reloads the politicians and swaps in the new membership dict in a
+        single assignment, so the stream thread sees either the old or the
+        new set.
+        """
+        users = self.get_users()
+        added = set(users) - set(self.users)
+        removed = set(self.users) - set(users)
+        if added or removed:
+            log.notice("Politicians changed: {added} added, {removed} removed",
+                       added=sorted(added), removed=sorted(removed))
+        self.users = users
+
     def on_data(self, data):
+        received = time.monotonic()
+        if self.recorder is not None:
+            self.recorder.record(data)
+
+        policies = self.backpressure.active if self.backpressure is not None else ()
+        if self.raw_ingest and self.projection is None and 'strip' not in policies:
+            status = peek_status(data)
+            if status is not None:
+                return self.route_raw_status(data, status, received)
+
         try:
-            tweet = anyjson.deserialize(data)
+            tweet = codec.deserialize(data)
             if 'delete' in tweet:
                 status = dict_mget(tweet, ['delete', 'status'])
                 if status is not None:
-                    self.queue.put(anyjson.serialize(tweet))
-                    log.notice(u"Queued delete notification for user {0} for tweet {1}".format(status.get('user_id_str'), status.get('id_str')))
+                    if self.is_duplicate(status.get('id_str'), 'delete'):
+                        return
+                    self.put(codec.serialize(tweet), priority=self.delete_priority, received=received,
+                             message_id=status.get('id_str'), kind='delete')
+                    log.notice(u"Queued delete notification for user {0} for tweet {1}", status.get('user_id_str'), status.get('id_str'))
             elif 'user' in tweet:
+                if tweet['user']['id'] in self.users and self.is_duplicate(tweet.get('id_str')):
+                    return
+                if 'strip' in policies:
+                    politwoops.ingest.strip_fields(tweet, self.strip_paths)
                 if 'retweeted_status' in tweet and tweet['user']['id'] in self.users:
-                    self.queue.put(anyjson.serialize(tweet))
-                    log.notice(u"Queued RT for user {0} for tweet {1}".format(dict_mget(tweet, ['user', 'screen_name']), tweet.get('id_str')))
+                    self.put(self.job_body(data, tweet), received=received, message_id=tweet.get('id_str'))
+                    log.notice(u"Queued RT for user {0} for tweet {1}", dict_mget(tweet, ['user', 'screen_name']), tweet.get('id_str'))
                 elif tweet['in_reply_to_status_id'] == None and tweet['user']['id'] in self.users:
-                    self.queue.put(anyjson.serialize(tweet))
-                    log.notice(u"Queued tweet for user {0} for tweet {1}".format(dict_mget(tweet, ['user', 'screen_name']), tweet.get('id_str')))
+                    self.put(self.job_body(data, tweet), received=received, message_id=tweet.get('id_str'))
+                    log.notice(u"Queued tweet for user {0} for tweet {1}", dict_mget(tweet, ['user', 'screen_name']), tweet.get('id_str'))
                 elif tweet['in_reply_to_status_id'] != None and tweet['user']['id'] in self.users:
-                    self.queue.put(anyjson.serialize(tweet))
-                    log.notice(u"Queued reply tweet for user {0} for tweet {1}".format(dict_mget(tweet, ['user', 'screen_name']), tweet.get('id_str')))
+                    self.put(self.job_body(data, tweet), is_reply=True, received=received, message_id=tweet.get('id_str'))
+                    log.notice(u"Queued reply tweet for user {0} for tweet {1}", dict_mget(tweet, ['user', 'screen_name']), tweet.get('id_str'))
 
             else:
-                log.notice(u"Did not queue tweet: {0}".format(tweet))
+                log.notice(u"Did not queue tweet: {0}", tweet)
 
         except Exception as e:
             log.error(u"TweetListener.on_data() caught exception: {0}".format(e))
             return False  # Closes connection, stops streaming
 
+    def job_body(self, data, tweet):
+        """
+        Serializes a status of a followed account for its job. With a
+        projection configured, the message is archived as received and only
+        the projected fields are queued; routing and logging have already
+        used the full status.
+        """
+        if self.projection is not None:
+            if self.archive is not None:
+                self.archive.record(data)
+            tweet = self.projection.apply(tweet)
+        return codec.serialize(tweet)
+
+    def is_duplicate(self, id_str, kind='status'):
+        """
+        True if a message of this kind about this tweet id was already seen
+        recently, for instance before a reconnect or on another stream
+        connection.
+        """
+        return id_str is not None and self.recent_ids.seen(id_str, kind)
+
+    def put(self, body, priority=DEFAULT_PRIORITY, is_reply=False, received=None,
+            message_id=None, kind='status'):
+        """
+        Queues a job, at the lowest priority and with a delay if it is a
+        reply and replies are being deferred. With job_stamps on, the body
+        is stamped with the monotonic time the message was received.
+
+        If the job cannot be queued, message_id is forgotten by is_duplicate
+        so that the message is queued when it is delivered again.
+        """
+        if self.stamp_jobs:
+            body = politwoops.envelope.stamp(body, 'received', received)
+        try:
+            if is_reply and self.backpressure is not None and 'defer_replies' in self.backpressure.active:
+                self.queue.put(body, priority=_deferred_priority, delay=self.defer_seconds)
+            else:
+                self.queue.put(body, priority=priority)
+        except Exception:
+            if message_id is not None:
+                self.recent_ids.forget(message_id, kind)
+            raise
+
+    def stats(self):
+        return {
+            'recent_ids': len(self.recent_ids),
+            'duplicate_statuses': self.recent_ids.suppressed['status'],
+            'duplicate_deletes': self.recent_ids.suppressed['delete'],
+        }
+
+    def route_raw_status(self, data, status, received=None):
+        """
+        Queues the payload exactly as it came off the stream, using only the
+        fields picked out by peek_status.
+        """
+        if status.user_id not in self.users or self.is_duplicate(status.id_str):
+            return
+        try:
+            self.put(data, is_reply=status.is_reply and not status.is_retweet, received=received,
+                     message_id=status.id_str)
+        except Exception as e:
+            log.error(u"TweetListener.on_data() caught exception: {0}".format(e))
+            return False  # Closes connection, stops streaming
+        if status.is_retweet:
+            log.notice(u"Queued RT for user {0} for tweet {1}", status.screen_name, status.id_str)
+        elif status.is_reply:
+            log.notice(u"Queued reply tweet for user {0} for tweet {1}", status.screen_name, status.id_str)
+        else:
+            log.notice(u"Queued tweet for user {0} for tweet {1}", status.screen_name, status.id_str)
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.archive is not None:
+            self.archive.close()
+
     def on_timeout(self):
         log.error(u"TweetListener connection timed out.")
 
     def on_error(self, status_code):
         log.error(u"TweetListener got bad status code: {0}".format(status_code))
 
+class ConnectionListener(tweepy.streaming.StreamListener):
+    """
+    Passes the messages of one stream connection to a listener shared by
+    all connections and keeps track of the connection's health.
+    """
+    def __init__(self, listener, shard, *args, **kwargs):
+        super(ConnectionListener, self).__init__(*args, **kwargs)
+        self.listener = listener
+        self.shard = shard
+        self.connected = threading.Event()
+        self.connects = 0
+        self.messages = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_seen = time.time()
+
+    def on_connect(self):
+        self.connects += 1
+        self.last_seen = time.time()
+        self.connected.set()
+
+    def keep_alive(self):
+        self.last_seen = time.time()
+
+    def on_data(self, data):
+        self.messages += 1
+        self.last_seen = time.time()
+        return self.listener.on_data(data)
+
+    def on_timeout(self):
+        self.errors += 1
+        self.last_error = 'timeout'
+        return self.listener.on_timeout()
+
+    def on_error(self, status_code):
+        self.errors += 1
+        self.last_error = status_code
+        return self.listener.on_error(status_code)
+
+    def health(self):
+        return {
+            'shard': self.shard,
+            'connects': self.connects,
+            'messages': self.messages,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'idle': time.time() - self.last_seen,
+        }
+
 class TweetStreamClient(object):
     def __init__(self):
         self.config = tweetsclient.Config().get()
@@ -131,6 +350,7 @@ class TweetStreamClient(object):
         log.debug("Access credentials: {token}, {secret}",
                   token=access_token,
                   secret=access_token_secret)
+        self.credentials = (consumer_key, consumer_secret, access_token, access_token_secret)
         self.twitter_auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
         self.twitter_auth.set_access_token(access_token, access_token_secret)
         try:
@@ -158,12 +378,54 @@ class TweetStreamClient(object):
 
         log.info("Initiating beanstalk connection. Queueing tweets to {use}...", use=tweets_tube)
 
-        self.beanstalk = politwoops.utils.beanstalk(host=self.config.get('beanstalk', 'host'),
-                                                    port=int(self.config.get('beanstalk', 'port')),
-                                                    watch=None,
-                                                    use=tweets_tube)
-
-    def stream_forever(self):
+        def connect():
+            return politwoops.utils.beanstalk(host=self.config.get('beanstalk', 'host'),
+                                              port=int(self.config.get('beanstalk', 'port')),
+                                              watch=None,
+                                              use=tweets_tube)
+
+        spool = None
+        spool_directory = self.get_config_default('tweets-client', 'spool_directory')
+        if spool_directory:
+            log.info("Spooling to {0} when beanstalk is unavailable.", spool_directory)
+            spool = politwoops.spool.Spool(
+                spool_directory,
+                segment_bytes=self.config.getint('tweets-client', 'spool_segment_mb', fallback=64) * 1024 * 1024,
+                use_mmap=self.config.getboolean('tweets-client', 'spool_mmap', fallback=False))
+
+        self.queue_writer = politwoops.ingest.QueueWriter(
+            connect,
+            capacity=self.config.getint('tweets-client', 'buffer_size', fallback=10000),
+            batch_size=self.config.getint('tweets-client', 'writer_batch_size', fallback=100),
+            stats_interval=self.config.getint('tweets-client', 'buffer_stats_interval', fallback=60),
+            spool=spool,
+            dead_letter=self.get_config_default('tweets-client', 'dead_letter_file') or None,
+            encode=politwoops.envelope.encoder(
+                self.config.get('beanstalk', 'job_encoding', fallback='json'),
+                'queued' if self.config.getboolean('beanstalk', 'job_stamps', fallback=False) else None))
+        try:
+            self.queue_writer.beanstalk = connect()
+        except Exception as e:
+            if spool is None:
+                raise
+            log.error("Unable to connect to beanstalk, spooling until it is back: {0}", e)
+            self.queue_writer.failing = True
+        self.queue_writer.start()
+
+        self.backpressure = None
+        thresholds = politwoops.ingest.parse_thresholds(self.get_config_default('tweets-client', 'backpressure'))
+        if 'spool' in thresholds and spool is None:
+            log.warning("The spool backpressure policy needs a spool_directory, ignoring it.")
+            del thresholds['spool']
+        if thresholds:
+            self.backpressure = politwoops.ingest.Backpressure(
+                connect, tweets_tube, thresholds,
+                interval=self.config.getint('tweets-client', 'backpressure_interval', fallback=5),
+                resume_ratio=self.config.getfloat('tweets-client', 'backpressure_resume_ratio', fallback=0.8),
+                on_change=lambda policies: self.queue_writer.hold('spool' in policies))
+            self.backpressure.start()
+
+    def stream_forever(self, heart=None):
         track_module = self.get_config_default('tweets-client', 'track-module', 'tweetsclient.config_track')
         track_class = self.get_config_default('tweets-client', 'track-class', 'ConfigTrackPlugin')
         log.debug("Loading track plugin: {module} - {klass}",
@@ -176,30 +438,278 @@ class TweetStreamClient(object):
         track_items = self.track.get_items()
         log.debug(str(track_items))
 
-        stream = None
         if stream_type == 'users':
-            tweet_listener = TweetListener(self.beanstalk)
-            stream = tweepy.Stream(self.twitter_auth, tweet_listener, secure=True)
-            stream.filter(follow=track_items)
+            tweet_listener = TweetListener(self.queue_writer, self.backpressure)
+            try:
+                if self.use_asyncio():
+                    asyncio.run(self.follow_forever_async(tweet_listener, track_items, heart))
+                else:
+                    self.follow_forever(tweet_listener, track_items)
+            finally:
+                tweet_listener.close()
         elif stream_type == 'words':
             raise Exception('The words stream type is no longer supported.')
         else:
             raise Exception('Unrecognized stream type: {0}'.format(stream_type))
 
+    def open_stream(self, tweet_listener, track_items, shard=0):
+        stream = tweepy.Stream(self.twitter_auth,
+                               ConnectionListener(tweet_listener, shard),
+                               secure=True,
+                               host=self.get_config_default('tweets-client', 'stream_host', 'stream.twitter.com'),
+                               verify=self.config.getboolean('tweets-client', 'stream_verify', fallback=True))
+        stream.daemon = True
+        stream.filter(follow=track_items, is_async=True)
+        return stream
+
+    def shard_items(self, track_items):
+        """
+        Splits the follow list over as many connections as configured, or as
+        are needed to keep every connection within the per-connection limit.
+        Accounts are assigned by id modulo the number of shards, so an
+        account stays on the same shard as long as that number does not
+        change. Shards left empty are dropped.
+        """
+        per_stream = self.config.getint('tweets-client', 'follow_per_stream', fallback=5000)
+        num_shards = max(self.config.getint('tweets-client', 'stream_shards', fallback=1),
+                         -(-len(track_items) // per_stream), 1)
+        while True:
+            shards = [[] for _ in range(num_shards)]
+            for item in track_items:
+                shards[int(item) % num_shards].append(item)
+            # Ids that share a remainder overflow a shard; more shards spread them.
+            if max(len(shard) for shard in shards) <= per_stream:
+                return [shard for shard in shards if shard]
+            num_shards += 1
+
+    def start_following(self, track_items):
+        """
+        Splits track_items into shards for follow_forever or
+        follow_forever_async and starts the health and refresh intervals.
+        """
+        shards = self.shard_items(track_items)
+        log.notice("Following {n} accounts over {shards} connections.",
+                   n=len(track_items), shards=len(shards))
+        self.last_refresh = self.last_health = time.time()
+        return shards
+
+    def follow_tick(self, tweet_listener, healths):
+        """
+        Called every second while following. Reports the health of the
+        streams, given by the healths callable, every health_interval seconds
+        and returns True every refresh_interval seconds, when the follow list
+        is due to be reloaded.
+        """
+        refresh_interval = self.config.getint('tweets-client', 'refresh_interval', fallback=300)
+        health_interval = self.config.getint('tweets-client', 'health_interval', fallback=60)
+        if health_interval and time.time() - self.last_health >= health_interval:
+            self.last_health = time.time()
+            self.report_health(tweet_listener, healths())
+        if not refresh_interval or time.time() - self.last_refresh < refresh_interval:
+            return False
+        self.last_refresh = time.time()
+        return True
+
+    def follow_list_changed(self, track_items, new_items):
+        if set(new_items) == set(track_items):
+            return False
+        log.notice("Follow list changed from {old} to {new} accounts, reconnecting.",
+                   old=len(track_items), new=len(new_items))
+        return True
+
+    def changed_shards(self, shards, new_shards):
+        """
+        The indexes of the shards that need a new stream: all of them if the
+        number of shards changed, otherwise those whose follow list changed.
+        """
+        if len(new_shards) != len(shards):
+            return list(range(len(new_shards)))
+        return [i for i in range(len(shards)) if set(shards[i]) != set(new_shards[i])]
+
+    def swap_streams(self, streams, shards, new_streams, new_shards):
+        """
+        Drops the streams replaced by new_streams, a dict of connected
+        streams by shard index, and returns the streams and shards to follow
+        from now on.
+        """
+        if len(new_shards) != len(shards):
+            for stream in streams:
+                stream.disconnect()
+            return [new_streams[i] for i in sorted(new_streams)], new_shards
+
+        streams = list(streams)
+        for (i, stream) in new_streams.items():
+            streams[i].disconnect()
+            streams[i] = stream
+        return streams, new_shards
+
+    def replace_streams(self, tweet_listener, streams, shards, new_shards):
+        """
+        Opens streams for the shards whose follow list changed and drops the
+        streams they replace once the new ones have connected.
+        """
+        new_streams = dict((i, self.open_stream(tweet_listener, new_shards[i], i))
+                           for i in self.changed_shards(shards, new_shards))
+
+        for (i, stream) in new_streams.items():
+            if not stream.listener.connected.wait(60):
+                log.error("New stream for shard {0} did not connect, keeping the current streams.", i)
+                for new_stream in new_streams.values():
+                    new_stream.disconnect()
+                return streams, shards
+
+        return self.swap_streams(streams, shards, new_streams, new_shards)
+
+    def use_asyncio(self):
+        return self.get_config_default('tweets-client', 'stream_client', 'tweepy') == 'asyncio'
+
+    def report_health(self, tweet_listener, healths):
+        log.info("Suppressed {duplicate_statuses} duplicate statuses and {duplicate_deletes} "
+                 "duplicate delete notices; tracking {recent_ids} recent ids",
+                 **tweet_listener.stats())
+        stall_seconds = self.config.getint('tweets-client', 'stall_seconds', fallback=90)
+        for health in healths:
+            if health['idle'] > stall_seconds:
+                log.warning("Stream shard {shard} has been silent for {idle:.0f} seconds "
+                            "({connects} connects, {errors} errors, last error {last_error})",
+                            **health)
+            else:
+                log.info("Stream shard {shard}: {messages} messages, {connects} connects, "
+                         "{errors} errors, last error {last_error}", **health)
+
+    def follow_forever(self, tweet_listener, track_items):
+        """
+        Streams tweets for track_items until a stream stops, periodically
+        reloading the politicians. When the follow list of a shard changes a
+        stream for the new list is connected before the old one is dropped.
+        """
+        shards = self.start_following(track_items)
+        streams = [self.open_stream(tweet_listener, items, i) for (i, items) in enumerate(shards)]
+        try:
+            while all(stream.running for stream in streams):
+                time.sleep(1)
+                if not self.follow_tick(tweet_listener,
+                                        lambda: [stream.listener.health() for stream in streams]):
+                    continue
+
+                try:
+                    tweet_listener.refresh_users()
+                    new_items = self.track.get_items()
+                except Exception as e:
+                    log.error("Unable to refresh the follow list: {0}", e)
+                    continue
+                if not self.follow_list_changed(track_items, new_items):
+                    continue
+
+                streams, shards = self.replace_streams(tweet_listener, streams, shards,
+                                                       self.shard_items(new_items))
+                track_items = [item for items in shards for item in items]
+        finally:
+            for stream in streams:
+                stream.disconnect()
+
+    def open_async_stream(self, on_data, track_items, shard=0):
+        return politwoops.aiostream.AsyncStream(
+            self.credentials, on_data, track_items, shard,
+            host=self.get_config_default('tweets-client', 'stream_host', 'stream.twitter.com'),
+            verify=self.config.getboolean('tweets-client', 'stream_verify', fallback=True),
+            stall_seconds=self.config.getint('tweets-client', 'stall_seconds', fallback=90)).start()
+
+    async def replace_async_streams(self, on_data, streams, shards, new_shards):
+        """
+        replace_streams for streams opened by open_async_stream.
+        """
+        new_streams = dict((i, self.open_async_stream(on_data, new_shards[i], i))
+                           for i in self.changed_shards(shards, new_shards))
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*[stream.connected.wait()
+                                                    for stream in new_streams.values()]), 60)
+        except asyncio.TimeoutError:
+            log.error("New streams did not connect, keeping the current streams.")
+            for new_stream in new_streams.values():
+                new_stream.disconnect()
+            return streams, shards
+
+        return self.swap_streams(streams, shards, new_streams, new_shards)
+
+    async def follow_forever_async(self, tweet_listener, track_items, heart=None):
+        """
+        follow_forever on an asyncio event loop. The stream connections, the
+        heartbeat and the watchdog are all tasks on the loop. Messages are
+        handled by tweet_listener on a single ingest thread, so spooling,
+        recording and logging never block the loop; each stream waits for
+        its message to be handled before reading the next. Reloading the
+        follow list, which queries the database, also runs in a thread.
+        """
+        loop = asyncio.get_running_loop()
+        ingest = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest')
+
+        def on_data(data):
+            return loop.run_in_executor(ingest, tweet_listener.on_data, data)
+
+        tasks = []
+        if heart is not None:
+            tasks = [asyncio.ensure_future(politwoops.aiostream.heartbeat(heart)),
+                     asyncio.ensure_future(politwoops.aiostream.watchdog(heart))]
+
+        shards = self.start_following(track_items)
+        streams = [self.open_async_stream(on_data, items, i) for (i, items) in enumerate(shards)]
+        try:
+            while all(stream.running and not stream.task.done() for stream in streams):
+                await asyncio.sleep(1)
+                if not self.follow_tick(tweet_listener, lambda: [stream.health() for stream in streams]):
+                    continue
+
+                try:
+                    await loop.run_in_executor(None, tweet_listener.refresh_users)
+                    new_items = await loop.run_in_executor(None, self.track.get_items)
+                except Exception as e:
+                    log.error("Unable to refresh the follow list: {0}", e)
+                    continue
+                if not self.follow_list_changed(track_items, new_items):
+                    continue
+
+                streams, shards = await self.replace_async_streams(on_data, streams, shards,
+                                                                   self.shard_items(new_items))
+                track_items = [item for items in shards for item in items]
+
+            for stream in streams:
+                if stream.task.done() and not stream.task.cancelled():
+                    stream.task.result()
+        finally:
+            for stream in streams:
+                stream.disconnect()
+            for task in tasks:
+                task.cancel()
+            # Lets the message being handled finish before the listener and
+            # the queue writer are closed.
+            ingest.shutdown(wait=True)
+
     def run(self):
         self.init_beanstalk()
-        with politwoops.utils.Heart() as heart:
-            politwoops.utils.start_heartbeat_thread(heart)
-            politwoops.utils.start_watchdog_thread(heart)
-            self.stream_forever()
-
-        self.beanstalk.close()
+        try:
+            with politwoops.utils.Heart() as heart:
+                if self.use_asyncio():
+                    self.stream_forever(heart)
+                else:
+                    politwoops.utils.start_heartbeat_thread(heart)
+                    politwoops.utils.start_watchdog_thread(heart)
+                    self.stream_forever()
+        finally:
+            if self.backpressure is not None:
+                self.backpressure.stop()
+            self.queue_writer.close(timeout=30)
         return 0
 
 def main(args):
-    signal.signal(signal.SIGHUP, politwoops.utils.restart_process)
+    # Restarts unwind run() so that buffered jobs are written or spooled.
+    signal.signal(signal.SIGHUP, politwoops.utils.request_restart)
 
-    log_handler = politwoops.utils.configure_log_handler(_script_, args.loglevel, args.output)
+    log_handler = politwoops.utils.configure_log_handler(_script_, args.loglevel, args.output,
+                                                         http_debug=args.http_debug,
+                                                         loggers=[log])
+    restart = False
     with logbook.NullHandler():
         with log_handler.applicationbound():
             log.debug("Starting tweets-client.py")
@@ -213,6 +723,13 @@ def main(args):
                     return app.run()
             except KeyboardInterrupt:
                 log.notice("Killed by CTRL-C")
+            except politwoops.utils.Restart:
+                log.notice("Restarting on SIGHUP")
+                restart = True
+            finally:
+                log_handler.close()
+    if restart:
+        politwoops.utils.restart_process()
 
 if __name__ == "__main__":
     args_parser = argparse.ArgumentParser(description=__doc__)
@@ -226,6 +743,8 @@ if __name__ == "__main__":
                              help='Destination for log output (-, syslog, or filename)')
     args_parser.add_argument('--restart', default=False, action='store_true',
                              help='Restart when an error cannot be handled.')
+    args_parser.add_argument('--http-debug', default=False, action='store_true',
+                             help='Log HTTP traffic at the wire level.')
     args_parser.add_argument('--authtest', default=False, action='store_true',
                              help='Authenticate against Twitter and exit.')
     args = args_parser.parse_args()
@@ -1 +1,12 @@
+import politwoops.codec
+import politwoops.envelope
 import politwoops.utils
+import politwoops.spool
+import politwoops.ingest
+import politwoops.recording
+import politwoops.aiostream
+import politwoops.pool
+import politwoops.aiobeanstalk
+import politwoops.tweetindex
+import politwoops.database
+import politwoops.latency
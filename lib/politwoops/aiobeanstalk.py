@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+A minimal beanstalk client for asyncio: the commands the workers need to
+consume a tube. Commands on a connection are sent one at a time, in the
+order they are made.
+
+Jobs can only be deleted or released on the connection that reserved them,
+so a blocking reserve would hold up the deletes of jobs that are done.
+Callers keep reserve timeouts short while they have jobs in flight.
+"""
+
+import asyncio
+
+from pystalkd.Beanstalkd import CommandFailed, DEFAULT_PRIORITY
+
+
+class Job(object):
+    def __init__(self, connection, job_id, body, priority=DEFAULT_PRIORITY):
+        self.connection = connection
+        self.job_id = job_id
+        self.body = body
+        self.priority = priority
+
+    async def delete(self):
+        await self.connection.delete(self.job_id)
+
+    async def release(self, priority=None, delay=0):
+        """
+        Puts the job back in the ready queue after delay seconds, at the
+        priority it was reserved with unless another is given.
+        """
+        if priority is None:
+            priority = self.priority
+        await self.connection.release(self.job_id, priority, delay)
+
+
+class Connection(object):
+    def __init__(self, host='localhost', port=11300):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        return self
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _command(self, line, ok_status):
+        async with self._lock:
+            return await self._exchange(line, ok_status)
+
+    async def _exchange(self, line, ok_status):
+        # Callers hold the lock.
+        self._writer.write(line.encode('utf-8') + b'\r\n')
+        response = await self._reader.readline()
+        if not response:
+            raise ConnectionError("Connection closed by beanstalkd")
+        status, _, rest = response.rstrip(b'\r\n').decode('utf-8').partition(' ')
+        if status not in ok_status:
+            raise CommandFailed(line.split(' ', 1)[0], status, rest)
+        body = None
+        if status == 'RESERVED':
+            (job_id, size) = rest.split()
+            body = (await self._reader.readexactly(int(size) + 2))[:-2]
+            rest = job_id
+        elif status == 'OK':
+            body = (await self._reader.readexactly(int(rest) + 2))[:-2]
+        return (status, rest, body)
+
+    async def watch(self, tube):
+        await self._command('watch {0}'.format(tube), ['WATCHING'])
+
+    async def use(self, tube):
+        await self._command('use {0}'.format(tube), ['USING'])
+
+    async def reserve(self, timeout=0):
+        """
+        Returns the next job, or None if none is ready within timeout
+        seconds or one of this connection's jobs is about to time out.
+
+        beanstalkd does not say which priority a reserved job has, so it is
+        asked for right away, before another reserve can take the
+        connection, and kept for Job.release.
+        """
+        async with self._lock:
+            (status, job_id, body) = await self._exchange(
+                'reserve-with-timeout {0}'.format(int(timeout)),
+                ['RESERVED', 'TIMED_OUT', 'DEADLINE_SOON'])
+            if status != 'RESERVED':
+                return None
+            (_, _, stats) = await self._exchange('stats-job {0}'.format(job_id), ['OK'])
+        priority = parse_stats(stats).get('pri', DEFAULT_PRIORITY)
+        return Job(self, int(job_id), body.decode('utf-8'), int(priority))
+
+    async def delete(self, job_id):
+        await self._command('delete {0}'.format(job_id), ['DELETED'])
+
+    async def release(self, job_id, priority=DEFAULT_PRIORITY, delay=0):
+        await self._command('release {0} {1} {2}'.format(job_id, priority, int(delay)), ['RELEASED'])
+
+    async def stats_job(self, job_id):
+        """
+        Returns the job's statistics, such as its priority ('pri'), as a
+        dict of strings.
+        """
+        (status, _, body) = await self._command('stats-job {0}'.format(job_id), ['OK'])
+        return parse_stats(body)
+
+
+def parse_stats(body):
+    """
+    Parses the YAML dictionary of a stats reply into a dict of strings.
+    """
+    stats = {}
+    for line in body.decode('utf-8').splitlines():
+        (key, sep, value) = line.partition(':')
+        if sep:
+            stats[key.strip()] = value.strip()
+    return stats
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+A streaming API client that runs on an asyncio event loop, as an alternative
+to tweepy's thread-per-connection Stream. Every connection, the heartbeat and
+the watchdog are tasks on the same loop.
+
+Reconnects follow Twitter's guidelines: linear backoff from 250 ms up to 16
+seconds for network errors, exponential backoff from 5 seconds up to 320
+seconds for HTTP errors, starting at a minute for 420 (rate limited).
+"""
+
+import ssl
+import time
+import asyncio
+import inspect
+import urllib.parse
+
+import logbook
+import oauthlib.oauth1
+
+import politwoops.utils
+
+log = logbook.Logger(__name__)
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, status, reason):
+        super(HTTPStatusError, self).__init__('{0} {1}'.format(status, reason))
+        self.status = status
+
+
+class StreamStalled(Exception):
+    pass
+
+
+class AsyncStream(object):
+    """
+    One connection to statuses/filter, following `follow`. Each message is
+    passed to on_data as a str; the stream stops if on_data returns False.
+    on_data may instead return an awaitable, for instance the future of a
+    call run in an executor, whose result is awaited before the next
+    message is read.
+    """
+    path = '/1.1/statuses/filter.json'
+
+    def __init__(self, credentials, on_data, follow, shard=0,
+                 host='stream.twitter.com', verify=True, stall_seconds=90):
+        self.oauth = oauthlib.oauth1.Client(*credentials)
+        self.on_data = on_data
+        self.follow = follow
+        self.shard = shard
+        # Like tweepy, host may include a port.
+        self.host = host
+        address = urllib.parse.urlsplit('//' + host)
+        self.hostname, self.port = address.hostname, address.port or 443
+        self.ssl = ssl.create_default_context()
+        if not verify:
+            self.ssl.check_hostname = False
+            self.ssl.verify_mode = ssl.CERT_NONE
+        self.stall_seconds = stall_seconds
+        self.running = True
+        self.connected = asyncio.Event()
+        self.task = None
+        self._writer = None
+
+        self.connects = 0
+        self.messages = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_seen = time.time()
+        self.network_delay = 0
+        self.http_delay = 0
+
+    def health(self):
+        return {
+            'shard': self.shard,
+            'connects': self.connects,
+            'messages': self.messages,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'idle': time.time() - self.last_seen,
+        }
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+        return self
+
+    def disconnect(self):
+        self.running = False
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        """
+        Streams until disconnect() is called or on_data returns False,
+        reconnecting after errors.
+        """
+        while self.running:
+            try:
+                await self.stream()
+                if not self.running:
+                    break
+                raise ConnectionError('stream closed by the server')
+            except HTTPStatusError as e:
+                self.errors += 1
+                self.last_error = e.status
+                self.http_delay = min(self.http_delay * 2 or (60 if e.status == 420 else 5), 320)
+                delay = self.http_delay
+            except (OSError, EOFError, ValueError, StreamStalled, asyncio.TimeoutError) as e:
+                if not self.running:
+                    break
+                self.errors += 1
+                if isinstance(e, (StreamStalled, asyncio.TimeoutError)):
+                    self.last_error = 'timeout'
+                else:
+                    self.last_error = type(e).__name__
+                self.network_delay = min(self.network_delay + 0.25, 16)
+                delay = self.network_delay
+            finally:
+                self.connected.clear()
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+            log.warning("Stream shard {shard} failed ({error}), reconnecting in {delay:g} seconds.",
+                        shard=self.shard, error=self.last_error, delay=delay)
+            await asyncio.sleep(delay)
+
+    async def _read(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.stall_seconds)
+        except asyncio.TimeoutError:
+            raise StreamStalled("No data for {0} seconds".format(self.stall_seconds))
+
+    def request(self):
+        url = 'https://{0}{1}?delimited=length'.format(self.host, self.path)
+        body = urllib.parse.urlencode({'follow': ','.join(str(item) for item in self.follow)})
+        _, headers, body = self.oauth.sign(url, 'POST', body,
+                                           {'Content-Type': 'application/x-www-form-urlencoded'})
+        lines = ['POST {0}?delimited=length HTTP/1.1'.format(self.path),
+                 'Host: {0}'.format(self.host),
+                 'Accept-Encoding: identity',
+                 'Content-Length: {0}'.format(len(body))]
+        lines.extend('{0}: {1}'.format(key, value) for (key, value) in headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n' + body).encode('utf-8')
+
+    async def stream(self):
+        reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.hostname, self.port, ssl=self.ssl,
+                                    server_hostname=self.hostname),
+            self.stall_seconds)
+        self._writer.write(self.request())
+
+        status_line = await self._read(reader.readline())
+        parts = status_line.decode('latin-1').split(None, 2)
+        if len(parts) < 2:
+            raise ValueError("Malformed status line: {0!r}".format(status_line))
+        headers = {}
+        while True:
+            line = await self._read(reader.readline())
+            if line in (b'\r\n', b'\n', b''):
+                break
+            (key, _, value) = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        status = int(parts[1])
+        if status != 200:
+            raise HTTPStatusError(status, parts[2].strip() if len(parts) > 2 else '')
+
+        self.connects += 1
+        self.last_seen = time.time()
+        self.network_delay = self.http_delay = 0
+        self.connected.set()
+        log.notice("Stream shard {shard} connected to {host}, following {n} accounts.",
+                   shard=self.shard, host=self.host, n=len(self.follow))
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = self._chunks(reader)
+        else:
+            chunks = self._raw(reader)
+        async for message in self._messages(chunks):
+            self.messages += 1
+            result = self.on_data(message.decode('utf-8'))
+            if inspect.isawaitable(result):
+                result = await result
+            if result is False:
+                self.running = False
+                return
+
+    async def _chunks(self, reader):
+        while True:
+            size_line = await self._read(reader.readline())
+            if not size_line:
+                return
+            size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                return
+            data = await self._read(reader.readexactly(size + 2))
+            yield data[:-2]
+
+    async def _raw(self, reader):
+        while True:
+            data = await self._read(reader.read(65536))
+            if not data:
+                return
+            yield data
+
+    async def _messages(self, chunks):
+        """
+        Splits the body into messages framed with delimited=length: the
+        length of the message on a line of its own, then the message. Blank
+        lines are keep-alives.
+        """
+        buf = bytearray()
+        length = None
+        async for chunk in chunks:
+            self.last_seen = time.time()
+            buf += chunk
+            while True:
+                if length is None:
+                    end = buf.find(b'\n')
+                    if end < 0:
+                        break
+                    line = bytes(buf[:end]).strip()
+                    del buf[:end + 1]
+                    if not line:
+                        continue
+                    if not line.isdigit():
+                        raise ValueError("Expected a message length, got {0!r}".format(line[:40]))
+                    length = int(line)
+                if len(buf) < length:
+                    break
+                message = bytes(buf[:length])
+                del buf[:length]
+                length = None
+                yield message
+
+
+async def heartbeat(heart):
+    """
+    Asyncio counterpart of politwoops.utils.start_heartbeat_thread.
+    """
+    while True:
+        await asyncio.sleep(heart.interval.total_seconds() * 0.10)
+        heart.beat()
+
+
+async def watchdog(heart):
+    """
+    Asyncio counterpart of politwoops.utils.start_watchdog_thread.
+    """
+    while True:
+        await asyncio.sleep(heart.interval.total_seconds() * 0.10)
+        if not politwoops.utils.check_heartbeat_file(heart):
+            return
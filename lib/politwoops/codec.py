@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+JSON encoding and decoding for queue jobs, heartbeat files and stored tweets.
+
+The fastest installed backend is used for each direction: orjson, then
+ujson, then the standard library json module for decoding, and ujson, then
+the json module for encoding, since orjson cannot write ASCII-only JSON.
+Whichever are picked, output is the same:
+
+* serialize() returns compact, ASCII-only JSON text. Non-ASCII characters are
+  written as \\u escapes, astral characters as escaped surrogate pairs, which
+  is what anyjson produced.
+* Unpaired surrogates, which Twitter occasionally sends when it truncates text
+  in the middle of an emoji, are replaced with U+FFFD both when decoding and
+  when encoding instead of failing the whole document.
+"""
+
+import re
+import json
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+# An escaped high surrogate not followed by an escaped low one, or an escaped
+# low surrogate not preceded by an escaped high one.
+_lone_surrogate_re = re.compile(
+    r'\\u[dD](?:[89abAB][0-9a-fA-F]{2}(?!\\u[dD][c-fC-F])'
+    r'|[c-fC-F][0-9a-fA-F]{2}(?<!\\u[dD][89abAB][0-9a-fA-F]{2}\\u[dD][c-fC-F][0-9a-fA-F]{2}))')
+_lone_surrogate_bytes_re = re.compile(_lone_surrogate_re.pattern.encode('ascii'))
+
+
+def has_lone_surrogate(text):
+    """
+    True if JSON text, str or bytes, escapes a surrogate that is not part
+    of a pair. Most text has no escaped surrogates at all, which is checked
+    first.
+    """
+    if isinstance(text, str):
+        (lower, upper, lone) = ('\\ud', '\\uD', _lone_surrogate_re)
+    else:
+        text = bytes(text)
+        (lower, upper, lone) = (b'\\ud', b'\\uD', _lone_surrogate_bytes_re)
+    if lower not in text and upper not in text:
+        return False
+    return lone.search(text) is not None
+
+
+def scrub_surrogates(obj):
+    """
+    Returns a copy of obj with unpaired surrogates in every string replaced
+    by U+FFFD. Properly paired surrogates are combined.
+    """
+    if isinstance(obj, str):
+        return obj.encode('utf-16', 'surrogatepass').decode('utf-16', 'replace')
+    elif isinstance(obj, dict):
+        return dict((scrub_surrogates(k), scrub_surrogates(v)) for (k, v) in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return [scrub_surrogates(v) for v in obj]
+    return obj
+
+
+class _Backend(object):
+    name = None
+
+    # Whether the backend can hand back unpaired surrogates instead of
+    # raising, so results have to be checked.
+    passes_surrogates = True
+
+    # Whether dumps writes ASCII-only JSON; if not, another backend encodes.
+    ascii_dumps = True
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+
+class _StdlibBackend(_Backend):
+    name = 'json'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj, ensure_ascii=True, separators=(',', ':'))
+
+
+class _UJSONBackend(_Backend):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def loads(self, data):
+        return self.ujson.loads(data)
+
+    def dumps(self, obj):
+        return self.ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
+
+
+class _ORJSONBackend(_Backend):
+    name = 'orjson'
+    passes_surrogates = False
+    # orjson only writes UTF-8. Re-encoding its output as ASCII took longer
+    # than encoding with the json module in the first place.
+    ascii_dumps = False
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+
+_backends = (_ORJSONBackend, _UJSONBackend, _StdlibBackend)
+_stdlib = _StdlibBackend()
+_loader = None
+_dumper = None
+
+
+def _installed(name=None):
+    for cls in _backends:
+        if name is not None and cls.name != name:
+            continue
+        try:
+            yield cls()
+        except ImportError:
+            if name is not None:
+                raise
+    if name is not None and name not in [cls.name for cls in _backends]:
+        raise ValueError("Unknown JSON backend: {0!r}".format(name))
+
+
+def use(name=None):
+    """
+    Selects the backend by name ('orjson', 'ujson' or 'json'), or the
+    fastest one installed if no name is given. A backend that cannot write
+    ASCII-only JSON is only used for decoding, and the fastest installed
+    backend that can does the encoding.
+    """
+    global _loader, _dumper
+    _loader = next(_installed(name))
+    if _loader.ascii_dumps:
+        _dumper = _loader
+    else:
+        _dumper = next(backend for backend in _installed() if backend.ascii_dumps)
+    log.debug("Using {0} for JSON.", backend_name())
+    return backend_name()
+
+
+def backend_name():
+    """
+    The name of the backend in use, or of the decoding and the encoding
+    backend separated by a slash if they differ.
+    """
+    if _loader is _dumper:
+        return _loader.name
+    return '{0}/{1}'.format(_loader.name, _dumper.name)
+
+
+def deserialize(data):
+    """
+    Decodes JSON from a str or UTF-8 bytes.
+    """
+    try:
+        obj = _loader.loads(data)
+    except (ValueError, TypeError):
+        # orjson rejects escaped lone surrogates outright; the stdlib
+        # decoder keeps them so they can be scrubbed.
+        if isinstance(_loader, _StdlibBackend):
+            raise
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode('utf-8', 'replace')
+        obj = _stdlib.loads(data)
+        return scrub_surrogates(obj)
+
+    if _loader.passes_surrogates and has_lone_surrogate(data):
+        obj = scrub_surrogates(obj)
+    return obj
+
+
+def serialize(obj):
+    """
+    Encodes obj as ASCII-only JSON text.
+    """
+    try:
+        text = _dumper.dumps(obj)
+    except (ValueError, TypeError, UnicodeError):
+        return _dumper.dumps(scrub_surrogates(obj))
+
+    if _dumper.passes_surrogates and has_lone_surrogate(text):
+        return _dumper.dumps(scrub_surrogates(obj))
+    return text
+
+
+use()
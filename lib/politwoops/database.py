@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+MySQL connections for every daemon, made from the [database] section of the
+configuration.
+
+ConnectionPool hands out connections one user at a time. A connection that
+has been idle for ping_interval seconds is pinged before it is handed out,
+and replaced if the server has closed it. A connection that fails with a
+lost-connection error while in use is dropped when it is given back, so the
+next user gets a new one. ConnectionPool.call goes one step further and runs
+its function again on that new connection. The time spent waiting for a
+free connection is logged every stats_interval seconds.
+
+transient() tells the errors worth retrying, because the same statements
+may well succeed on a new connection or a moment later, from the ones that
+would fail again.
+"""
+
+import os
+import time
+import threading
+import contextlib
+
+import logbook
+import MySQLdb
+
+import tweetsclient
+
+log = logbook.Logger(__name__)
+
+# Server has gone away, lost connection during query, lost connection to
+# server at handshake, server shutdown in progress.
+CONNECTION_LOST = (2006, 2013, 2055, 1053)
+
+# Lost connections, plus can't connect through the socket or over TCP, too
+# many connections, lock wait timeout and deadlock.
+TRANSIENT = CONNECTION_LOST + (2002, 2003, 1040, 1205, 1213)
+
+
+def _error_code(error):
+    if isinstance(error, MySQLdb.Error) and error.args and isinstance(error.args[0], int):
+        return error.args[0]
+    return None
+
+
+def connection_lost(error):
+    return _error_code(error) in CONNECTION_LOST
+
+
+def transient(error):
+    return _error_code(error) in TRANSIENT
+
+
+def connect(config=None):
+    """
+    Opens an autocommitting utf8mb4 connection to the configured database.
+    """
+    config = config or tweetsclient.Config().get()
+    log.debug("Making DB connection")
+    database = MySQLdb.connect(
+        host=config.get('database', 'host'),
+        port=int(config.get('database', 'port')),
+        db=config.get('database', 'database'),
+        user=config.get('database', 'username'),
+        passwd=config.get('database', 'password'),
+        charset="utf8mb4",
+        use_unicode=True
+    )
+    database.autocommit(True) # needed if you're using InnoDB
+    database.cursor().execute('SET NAMES UTF8MB4')
+    return database
+
+
+class ConnectionPool(object):
+    """
+    Up to `size` connections, opened as they are needed.
+    """
+    def __init__(self, size=1, config=None):
+        config = config or tweetsclient.Config().get()
+        self.size = size
+        self.config = config
+        self.ping_interval = config.getint('database', 'ping_interval', fallback=60)
+        self.stats_interval = config.getint('database', 'stats_interval', fallback=300)
+
+        self.condition = threading.Condition()
+        # Idle connections and the time each was last used, most recent last.
+        self.idle = []
+        self.opened = 0
+
+        self.acquires = 0
+        self.reconnects = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.last_report = time.time()
+
+    def _open(self):
+        try:
+            return connect(self.config)
+        except:
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify()
+            raise
+
+    def acquire(self):
+        """
+        Returns a live connection, waiting for one to be released if all of
+        them are in use.
+        """
+        started = time.time()
+        with self.condition:
+            while not self.idle and self.opened >= self.size:
+                self.condition.wait()
+            if self.idle:
+                (database, last_used) = self.idle.pop()
+            else:
+                (database, last_used) = (None, None)
+                self.opened += 1
+            waited = time.time() - started
+            self.acquires += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+        if database is None:
+            return self._open()
+        if time.time() - last_used >= self.ping_interval:
+            try:
+                database.ping()
+            except MySQLdb.Error as e:
+                log.warning("Database connection failed its health check ({0}), reconnecting.", e)
+                with self.condition:
+                    self.reconnects += 1
+                self._close(database)
+                return self._open()
+        return database
+
+    def release(self, database, broken=False):
+        """
+        Returns a connection to the pool, or closes it if it is broken.
+        """
+        if broken:
+            self._close(database)
+            with self.condition:
+                self.reconnects += 1
+                self.opened -= 1
+                self.condition.notify()
+        else:
+            with self.condition:
+                self.idle.append((database, time.time()))
+                self.condition.notify()
+        self.report()
+
+    @staticmethod
+    def _close(database):
+        try:
+            database.close()
+        except MySQLdb.Error:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        database = self.acquire()
+        try:
+            yield database
+        except Exception as e:
+            self.release(database, broken=connection_lost(e))
+            raise
+        except BaseException:
+            # Interrupted mid-statement, the connection may be out of step.
+            self.release(database, broken=True)
+            raise
+        else:
+            self.release(database)
+
+    def call(self, fn, *args):
+        """
+        Returns fn(database, *args) for a connection from the pool. If the
+        connection turns out to have been lost, fn is called once more on a
+        new one, so it must be safe to repeat: queries, or statements that
+        autocommit.
+        """
+        try:
+            with self.connection() as database:
+                return fn(database, *args)
+        except MySQLdb.Error as e:
+            if not connection_lost(e):
+                raise
+            log.warning("Lost the database connection in {fn}, retrying on a new one: {error}",
+                        fn=fn.__name__, error=e)
+        with self.connection() as database:
+            return fn(database, *args)
+
+    @contextlib.contextmanager
+    def cursor(self):
+        with self.connection() as database:
+            cursor = database.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def ping_idle(self):
+        """
+        Pings the connections that have been idle for ping_interval seconds,
+        keeping them open, and drops the ones the server has closed.
+        """
+        now = time.time()
+        with self.condition:
+            due = [item for item in self.idle if now - item[1] >= self.ping_interval]
+            self.idle = [item for item in self.idle if now - item[1] < self.ping_interval]
+        for (database, last_used) in due:
+            try:
+                database.ping()
+            except MySQLdb.Error as e:
+                log.warning("Dropping a database connection that failed its health check: {0}", e)
+                self.release(database, broken=True)
+            else:
+                self.release(database)
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.stats_interval:
+            return
+        with self.condition:
+            (acquires, wait_total, wait_max, reconnects) = (self.acquires, self.wait_total,
+                                                            self.wait_max, self.reconnects)
+            self.acquires = self.reconnects = 0
+            self.wait_total = self.wait_max = 0.0
+            self.last_report = now
+        if acquires:
+            log.notice("Database pool: {n} acquires, mean wait {mean:.1f} ms, max wait {max:.1f} ms, {reconnects} reconnects",
+                       n=acquires, mean=wait_total / acquires * 1000, max=wait_max * 1000,
+                       reconnects=reconnects)
+
+
+_shared_pool = None
+_shared_pool_pid = None
+_shared_pool_lock = threading.Lock()
+
+
+def shared_pool():
+    """
+    Returns the process's pool of [database] pool_size connections, for the
+    code that needs a connection now and then. A forked child gets a pool
+    of its own.
+    """
+    global _shared_pool, _shared_pool_pid
+    with _shared_pool_lock:
+        if _shared_pool is None or _shared_pool_pid != os.getpid():
+            config = tweetsclient.Config().get()
+            _shared_pool = ConnectionPool(config.getint('database', 'pool_size', fallback=2), config)
+            _shared_pool_pid = os.getpid()
+        return _shared_pool
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Versioned envelope for the bodies of beanstalk jobs.
+
+A job body is either plain JSON, as queued by earlier versions, or an
+envelope: 'PW', the version number, ':' and the payload. A version 1 payload
+is the JSON deflated against a dictionary of text that recurs in every
+tweet, then base64 encoded. pystalkd strips whitespace from job bodies and
+stops reading at a CRLF that happens to end a read, so bodies have to stay
+printable.
+
+Readers understand every version and plain JSON, so they can be upgraded
+before the writers are switched over with job_encoding in [beanstalk].
+
+Either kind of body may be preceded by a stamp header, added when job_stamps
+is on: 'PS', an id of the clock, ';', the monotonic time at which each stage
+of the pipeline handled the job as stage=seconds pairs separated by commas,
+and ';'. The clock id is the host's boot id, so a reader can tell whether
+the times are comparable with its own clock.
+"""
+
+import re
+import time
+import zlib
+import base64
+import socket
+
+from politwoops import codec
+
+VERSION = 1
+
+_prefix = 'PW%d:' % VERSION
+_prefix_bytes = _prefix.encode('ascii')
+
+# Deflate back-references reach 32 KB, so the whole dictionary is usable.
+# The most frequent text goes last, where references to it are shortest.
+_dictionary = (
+    '"profile_background_color":"F5F8FA","profile_background_image_url":"",'
+    '"profile_background_image_url_https":"","profile_background_tile":false,'
+    '"profile_link_color":"1DA1F2","profile_sidebar_border_color":"C0DEED",'
+    '"profile_sidebar_fill_color":"DDEEF6","profile_text_color":"333333",'
+    '"profile_use_background_image":true,"profile_image_url":"http:\\/\\/pbs.twimg.com\\/profile_images\\/",'
+    '"profile_image_url_https":"https:\\/\\/pbs.twimg.com\\/profile_images\\/",'
+    '"profile_banner_url":"https:\\/\\/pbs.twimg.com\\/profile_banners\\/",'
+    '"default_profile":false,"default_profile_image":false,"following":null,'
+    '"follow_request_sent":null,"notifications":null,"translator_type":"none",'
+    '"utc_offset":null,"time_zone":null,"geo_enabled":false,"lang":null,'
+    '"contributors_enabled":false,"is_translator":false,'
+    '"geo":null,"coordinates":null,"place":null,"contributors":null,'
+    '"is_quote_status":false,"quote_count":0,"reply_count":0,"retweet_count":0,"favorite_count":0,'
+    '"entities":{"hashtags":[],"urls":[],"user_mentions":[],"symbols":[]},'
+    '"favorited":false,"retweeted":false,"filter_level":"low","lang":"en",'
+    '"extended_tweet":{"full_text":"","display_text_range":[0,'
+    '"media":[{"id":,"id_str":"","indices":[,"media_url":"http:\\/\\/pbs.twimg.com\\/media\\/",'
+    '"media_url_https":"https:\\/\\/pbs.twimg.com\\/media\\/","url":"https:\\/\\/t.co\\/",'
+    '"display_url":"pic.twitter.com\\/","expanded_url":"https:\\/\\/twitter.com\\/","type":"photo",'
+    '"sizes":{"thumb":{"w":150,"h":150,"resize":"crop"},"medium":{"w":1200,"h":,"resize":"fit"},'
+    '"small":{"w":680,"h":,"resize":"fit"},"large":{"w":2048,"h":,"resize":"fit"}}}],'
+    '"urls":[{"url":"https:\\/\\/t.co\\/","expanded_url":"https:\\/\\/","display_url":"","indices":[,'
+    '"user_mentions":[{"screen_name":"","name":"","id":,"id_str":"","indices":[,'
+    '"retweeted_status":{"created_at":"'
+    '"user":{"id":,"id_str":"","name":"","screen_name":"","location":"","url":"https:\\/\\/t.co\\/",'
+    '"description":"","protected":false,"verified":true,"followers_count":,"friends_count":,'
+    '"listed_count":,"favourites_count":,"statuses_count":,"created_at":"'
+    '"source":"\\u003ca href=\\"http:\\/\\/twitter.com\\/download\\/iphone\\" rel=\\"nofollow\\"\\u003eTwitter for iPhone\\u003c\\/a\\u003e",'
+    '"source":"\\u003ca href=\\"https:\\/\\/mobile.twitter.com\\" rel=\\"nofollow\\"\\u003eTwitter Web App\\u003c\\/a\\u003e",'
+    '"truncated":false,"in_reply_to_status_id":null,"in_reply_to_status_id_str":null,'
+    '"in_reply_to_user_id":null,"in_reply_to_user_id_str":null,"in_reply_to_screen_name":null,'
+    '{"delete":{"status":{"id":,"id_str":"","user_id":,"user_id_str":""},"timestamp_ms":""}}'
+    '{"created_at":"Mon Jan 01 00:00:00 +0000 2018","id":,"id_str":"","text":"RT @: https:\\/\\/t.co\\/",'
+    '"display_text_range":[0,140],"timestamp_ms":"'
+).encode('ascii')
+
+
+_stamp_prefix = 'PS'
+
+
+def _clock_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as boot_id:
+            return boot_id.read().strip().replace('-', '')[:16]
+    except (IOError, OSError):
+        # Monotonic clocks elsewhere also count from boot, so the host name
+        # will do.
+        return re.sub(r'[^A-Za-z0-9.-]', '', socket.gethostname())
+
+CLOCK = _clock_id()
+
+
+def split_stamps(body):
+    """
+    Returns the clock id and the stamps, a dict of stage names and times, of
+    a job body, and the body without its stamp header. The clock id is None
+    if the body has no stamp header.
+    """
+    if isinstance(body, bytes):
+        (prefix, separator) = (_stamp_prefix.encode('ascii'), b';')
+    else:
+        (prefix, separator) = (_stamp_prefix, ';')
+    if not body.startswith(prefix):
+        return (None, {}, body)
+    end = body.index(separator, body.index(separator) + 1)
+    header = body[len(prefix):end]
+    if isinstance(header, bytes):
+        header = header.decode('ascii')
+    (clock, _, pairs) = header.partition(';')
+    stamps = {}
+    for pair in pairs.split(','):
+        (stage, sep, seconds) = pair.partition('=')
+        if sep:
+            stamps[stage] = float(seconds)
+    return (clock, stamps, body[end + 1:])
+
+
+def join_stamps(clock, stamps, body):
+    header = '{0}{1};{2};'.format(_stamp_prefix, clock, ','.join(
+        '{0}={1:.6f}'.format(stage, seconds) for (stage, seconds) in sorted(stamps.items())))
+    if isinstance(body, bytes):
+        return header.encode('ascii') + body
+    return header + body
+
+
+def stamp(body, stage, at=None):
+    """
+    Adds the time a stage handled the job, by default now, to a job body's
+    stamp header. Stamps taken on another clock, before a reboot for
+    instance, are dropped.
+    """
+    (clock, stamps, inner) = split_stamps(body)
+    if clock != CLOCK:
+        stamps = {}
+    stamps[stage] = time.monotonic() if at is None else at
+    return join_stamps(CLOCK, stamps, inner)
+
+
+def encode(body):
+    """
+    Wraps a JSON job body, str or bytes, in a version 1 envelope.
+    """
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, _dictionary)
+    payload = compressor.compress(body) + compressor.flush()
+    return _prefix + base64.b64encode(payload).decode('ascii')
+
+
+def decode(body):
+    """
+    Returns the JSON in a job body, unwrapping it if it is an envelope.
+    """
+    if body[:2] in (_stamp_prefix, _stamp_prefix.encode('ascii')):
+        body = split_stamps(body)[2]
+    prefix = _prefix_bytes if isinstance(body, bytes) else _prefix
+    if not body.startswith(prefix):
+        if body[:2] in ('PW', b'PW'):
+            raise ValueError("Unsupported job envelope: {0!r}".format(body[:8]))
+        return body
+    decompressor = zlib.decompressobj(-15, zdict=_dictionary)
+    return decompressor.decompress(base64.b64decode(body[len(prefix):])) + decompressor.flush()
+
+
+def encoder(encoding, stage=None):
+    """
+    Returns the function that turns JSON job bodies into bodies in the
+    given job_encoding. With a stage, the function also stamps the time it
+    is called at, keeping any stamps the body already has outside the
+    encoding.
+    """
+    if encoding == 'zlib':
+        encode_body = encode
+    elif encoding == 'json':
+        encode_body = lambda body: body
+    else:
+        raise ValueError("Unrecognized job encoding: {0}".format(encoding))
+    if stage is None:
+        return encode_body
+
+    def encode_stamped(body):
+        (clock, stamps, inner) = split_stamps(body)
+        if clock != CLOCK:
+            stamps = {}
+        stamps[stage] = time.monotonic()
+        return join_stamps(CLOCK, stamps, encode_body(inner))
+    return encode_stamped
+
+
+def pack(obj, encoding='zlib'):
+    return encoder(encoding)(codec.serialize(obj))
+
+
+def unpack(body):
+    return codec.deserialize(decode(body))
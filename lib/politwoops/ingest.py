@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Moves stream messages from the thread reading the Twitter stream to
+beanstalk without making the reader wait on the queue.
+"""
+
+import time
+import threading
+import collections
+
+import logbook
+from pystalkd.Beanstalkd import DEFAULT_PRIORITY, CommandFailed
+
+import politwoops.utils
+from politwoops import codec
+
+log = logbook.Logger(__name__)
+
+
+class BufferFull(Exception):
+    pass
+
+
+class RingBuffer(object):
+    """
+    Bounded FIFO shared by a single producer and a single consumer.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.high_water = 0
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def offer(self, item):
+        """
+        Appends item unless the buffer is full. Never blocks.
+        """
+        with self._cond:
+            if len(self._items) >= self.capacity:
+                return False
+            self._items.append(item)
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            self._cond.notify()
+        return True
+
+    def take(self, max_items, timeout=None):
+        """
+        Removes and returns up to max_items items, waiting up to timeout
+        seconds for the first one to arrive.
+        """
+        with self._cond:
+            if not self._items:
+                self._cond.wait(timeout)
+            batch = []
+            while self._items and len(batch) < max_items:
+                batch.append(self._items.popleft())
+            return batch
+
+    def push_front(self, items):
+        """
+        Returns items taken by take() to the head of the buffer, in order.
+        The buffer may briefly exceed its capacity.
+        """
+        with self._cond:
+            self._items.extendleft(reversed(items))
+            self._cond.notify()
+
+    def reset_high_water(self):
+        with self._cond:
+            self.high_water = len(self._items)
+
+
+class RecentIds(object):
+    """
+    Remembers the ids seen in the last `window` seconds, up to `capacity` of
+    them, so that a message delivered more than once, by a reconnect or by
+    several stream connections, is only queued once.
+    """
+    def __init__(self, capacity=100000, window=600):
+        self.capacity = capacity
+        self.window = window
+        self.suppressed = collections.Counter()
+        self._order = collections.deque()
+        self._ids = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def seen(self, message_id, kind='status'):
+        """
+        Records message_id, returning True if it had already been recorded.
+        Suppressed duplicates are counted per kind.
+        """
+        key = (kind, message_id)
+        now = time.time()
+        with self._lock:
+            if key in self._ids:
+                self.suppressed[kind] += 1
+                return True
+            self._ids.add(key)
+            self._order.append((now, key))
+            expired = now - self.window
+            while self._order and (len(self._order) > self.capacity or self._order[0][0] < expired):
+                self._ids.discard(self._order.popleft()[1])
+            return False
+
+    def forget(self, message_id, kind='status'):
+        """
+        Removes a recorded message_id, for a message that could not be
+        queued after all, so that a redelivery of it is not suppressed.
+        """
+        with self._lock:
+            self._ids.discard((kind, message_id))
+
+
+class QueueWriter(threading.Thread):
+    """
+    Accepts jobs through put() into a ring buffer and writes them to
+    beanstalk in pipelined batches from its own thread.
+
+    `connect` is called to open, and after a failure reopen, the beanstalk
+    connection. `encode`, if given, is applied to each job body just before
+    it is written, off the thread calling put().
+
+    If a politwoops.spool.Spool is given, jobs that arrive while the buffer
+    is full, beanstalk is failing or the writer is held are appended to it
+    instead, as is everything after them until the spool has been replayed,
+    so jobs reach beanstalk in the order they arrived.
+
+    When the connection fails part way through a batch, only the jobs
+    beanstalkd had not yet answered for are written again. Jobs it rejects,
+    for instance for being too big, are logged and skipped, and appended to
+    the `dead_letter` file if one is given.
+    """
+    def __init__(self, connect, capacity=10000, batch_size=100,
+                 high_water_ratio=0.8, stats_interval=60, spool=None, encode=None,
+                 dead_letter=None):
+        super(QueueWriter, self).__init__(name='queue-writer')
+        self.daemon = True
+        self.connect = connect
+        self.encode = encode
+        self.buffer = RingBuffer(capacity)
+        self.spool = spool
+        self.spool_lock = threading.Lock()
+        self.spooling = spool is not None and not spool.empty()
+        self.failing = False
+        self.held = False
+        self.batch_size = batch_size
+        self.high_water_mark = int(capacity * high_water_ratio)
+        self.stats_interval = stats_interval
+        self.dead_letter = dead_letter
+        self.beanstalk = None
+        self.closing = False
+        self.stopping = threading.Event()
+
+        self.jobs_written = 0
+        self.jobs_spooled = 0
+        self.jobs_replayed = 0
+        self.jobs_rejected = 0
+        self.batches_written = 0
+        self.put_seconds = 0.0
+        self.max_put_seconds = 0.0
+        self.last_stats = time.time()
+        self.above_high_water = False
+
+    def put(self, body, priority=DEFAULT_PRIORITY, delay=0):
+        job = (body, priority, delay)
+        if self.spool is not None:
+            with self.spool_lock:
+                if self.spooling or self.failing or self.held or not self.buffer.offer(job):
+                    self.spool_job(job)
+                    return
+        elif not self.buffer.offer(job):
+            raise BufferFull("Ingest buffer is full ({0} jobs)".format(self.buffer.capacity))
+        if not self.above_high_water and len(self.buffer) >= self.high_water_mark:
+            self.above_high_water = True
+            log.warning("Ingest buffer above high-water mark: {depth}/{capacity} jobs",
+                        depth=len(self.buffer), capacity=self.buffer.capacity)
+
+    def spool_job(self, job):
+        if not self.spooling:
+            self.spooling = True
+            if self.failing:
+                reason = 'beanstalk is failing'
+            elif self.held:
+                reason = 'the queue is backed up'
+            else:
+                reason = 'the ingest buffer is full'
+            log.warning("Spooling jobs to {directory} because {reason}.",
+                        directory=self.spool.directory, reason=reason)
+        self.spool.append(*job)
+        self.jobs_spooled += 1
+
+    def hold(self, held):
+        """
+        While held, new jobs go to the spool and the spool is not replayed.
+        Without a spool this does nothing.
+        """
+        if self.spool is None:
+            return
+        with self.spool_lock:
+            self.held = held
+
+    def stats(self):
+        return {
+            'depth': len(self.buffer),
+            'capacity': self.buffer.capacity,
+            'high_water': self.buffer.high_water,
+            'jobs_written': self.jobs_written,
+            'jobs_spooled': self.jobs_spooled,
+            'jobs_replayed': self.jobs_replayed,
+            'jobs_rejected': self.jobs_rejected,
+            'batches_written': self.batches_written,
+            'mean_put_ms': (1000.0 * self.put_seconds / self.batches_written
+                            if self.batches_written else 0.0),
+            'max_put_ms': 1000.0 * self.max_put_seconds,
+        }
+
+    def run(self):
+        delay = 0
+        while not (self.closing and len(self.buffer) == 0) and not self.stopping.is_set():
+            replaying = self.spooling and not self.closing and not self.held
+            batch = self.buffer.take(self.batch_size, timeout=0 if replaying else 1.0)
+            self.report_stats()
+            try:
+                if batch:
+                    self.write(batch)
+                elif replaying:
+                    self.replay()
+                else:
+                    continue
+                self.failing = False
+                delay = 0
+            except Exception as e:
+                if batch:
+                    written = len(e.results) if isinstance(e, politwoops.utils.PutInterrupted) else 0
+                    self.buffer.push_front(batch[written:])
+                self.failing = True
+                delay = min(delay * 2 or 1, 30)
+                log.error("Failed to write to beanstalk, retrying in {delay} seconds: {e}",
+                          delay=delay, e=e)
+                self.disconnect()
+                self.stopping.wait(delay)
+
+    def write(self, batch):
+        """
+        Writes a batch of jobs to beanstalk. Raises PutInterrupted if the
+        connection fails part way, once the jobs before the failure have
+        been accounted for.
+        """
+        if self.beanstalk is None:
+            self.beanstalk = self.connect()
+        jobs = batch
+        if self.encode is not None:
+            jobs = [(self.encode(body), priority, delay) for (body, priority, delay) in batch]
+        start = time.time()
+        try:
+            results = politwoops.utils.put_many(self.beanstalk, jobs)
+        except politwoops.utils.PutInterrupted as e:
+            self.account(batch, e.results)
+            raise
+        elapsed = time.time() - start
+
+        self.account(batch, results)
+        self.batches_written += 1
+        self.put_seconds += elapsed
+        self.max_put_seconds = max(self.max_put_seconds, elapsed)
+        if self.above_high_water and len(self.buffer) < self.high_water_mark:
+            self.above_high_water = False
+            log.notice("Ingest buffer back below high-water mark: {depth}/{capacity} jobs",
+                       depth=len(self.buffer), capacity=self.buffer.capacity)
+
+    def account(self, batch, results):
+        """
+        Counts the jobs of a batch beanstalkd answered for and dead-letters
+        those it rejected.
+        """
+        for (job, (status, job_id)) in zip(batch, results):
+            if job_id is None:
+                self.reject(job, status)
+                continue
+            if status == 'BURIED':
+                log.warning("beanstalkd is out of memory and buried job {0}.", job_id)
+            self.jobs_written += 1
+
+    def reject(self, job, status):
+        (body, priority, delay) = job
+        self.jobs_rejected += 1
+        log.error("A {size} byte job was rejected with {status}, skipping it.",
+                  size=len(body), status=status)
+        if self.dead_letter is None:
+            return
+        if not isinstance(body, str):
+            body = bytes(body).decode('utf-8', 'replace')
+        try:
+            with open(self.dead_letter, 'a') as fil:
+                fil.write(codec.serialize({'status': status, 'priority': priority,
+                                           'delay': delay, 'body': body}) + '\n')
+        except (IOError, OSError) as e:
+            log.error("Unable to write to the dead letter file {0}: {1}", self.dead_letter, e)
+
+    def replay(self):
+        """
+        Writes the oldest batch of spooled jobs to beanstalk.
+        """
+        jobs, position = self.spool.read(self.batch_size)
+        if jobs:
+            try:
+                self.write(jobs)
+            except politwoops.utils.PutInterrupted as e:
+                if e.results:
+                    # Reading the jobs that were written again finds where
+                    # they end.
+                    (_, position) = self.spool.read(len(e.results))
+                    self.spool.commit(position)
+                    self.jobs_replayed += len(e.results)
+                raise
+            self.jobs_replayed += len(jobs)
+        self.spool.commit(position)
+        with self.spool_lock:
+            if self.spool.empty():
+                self.spooling = False
+                log.notice("Spool drained after replaying {n} jobs.", n=self.jobs_replayed)
+
+    def report_stats(self):
+        now = time.time()
+        if now - self.last_stats < self.stats_interval:
+            return
+        log.notice("Ingest buffer depth {depth}/{capacity}, high water {high_water}, "
+                   "{jobs_written} jobs in {batches_written} batches "
+                   "({jobs_spooled} spooled, {jobs_replayed} replayed, {jobs_rejected} rejected), "
+                   "put latency mean {mean_put_ms:.1f} ms max {max_put_ms:.1f} ms",
+                   **self.stats())
+        self.buffer.reset_high_water()
+        self.max_put_seconds = 0.0
+        self.last_stats = now
+
+    def disconnect(self):
+        if self.beanstalk is not None:
+            self.beanstalk.close()
+            self.beanstalk = None
+
+    def close(self, timeout=None):
+        """
+        Writes out whatever is still buffered and closes the connection.
+        Jobs that could not be written within timeout seconds are spooled,
+        or without a spool logged as lost.
+        """
+        self.closing = True
+        self.join(timeout)
+        if self.is_alive():
+            self.stopping.set()
+            # Give a write in progress the chance to finish.
+            self.join(5)
+
+        left = self.buffer.take(len(self.buffer), timeout=0)
+        if left and self.spool is not None:
+            with self.spool_lock:
+                for job in left:
+                    self.spool.append(*job)
+            log.warning("Spooled {n} jobs that could not be written to beanstalk.", n=len(left))
+        elif left:
+            log.error("Lost {n} jobs that could not be written to beanstalk.", n=len(left))
+
+        if not self.is_alive():
+            self.disconnect()
+        if self.spool is not None:
+            self.spool.close()
+
+
+def strip_fields(message, paths):
+    """
+    Removes the fields named by paths, tuples of keys into nested dicts,
+    from message in place. Missing fields are ignored.
+    """
+    for path in paths:
+        parent = message
+        for key in path[:-1]:
+            parent = parent.get(key)
+            if not isinstance(parent, dict):
+                break
+        else:
+            parent.pop(path[-1], None)
+    return message
+
+
+class Projection(object):
+    """
+    Keeps only the declared fields of a message. Fields are dotted paths
+    into nested objects, applied to every element of a list along the way;
+    naming an object keeps all of it.
+    """
+    def __init__(self, fields):
+        self.tree = {}
+        for field in fields:
+            node = self.tree
+            keys = field.split('.')
+            for key in keys[:-1]:
+                child = node.setdefault(key, {})
+                if child is True:
+                    break
+                node = child
+            else:
+                node[keys[-1]] = True
+
+    def apply(self, message, tree=None):
+        """
+        Returns a copy of message with only the declared fields.
+        """
+        if tree is None:
+            tree = self.tree
+        if isinstance(message, list):
+            return [self.apply(item, tree) for item in message]
+        if not isinstance(message, dict):
+            return message
+        projected = {}
+        for (key, subtree) in tree.items():
+            if key in message:
+                value = message[key]
+                projected[key] = value if subtree is True else self.apply(value, subtree)
+        return projected
+
+
+POLICIES = ('spool', 'strip', 'defer_replies')
+
+
+def parse_thresholds(value):
+    """
+    Parses 'policy:depth, policy:depth' into a dict of Backpressure
+    thresholds. Raises ValueError for an unknown or repeated policy or a
+    depth that is not a positive whole number.
+    """
+    thresholds = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        (policy, sep, depth) = item.partition(':')
+        policy = policy.strip()
+        if not sep or not depth.strip().isdigit() or int(depth) <= 0:
+            raise ValueError("Expected policy:depth with a positive depth, not {0!r}".format(item.strip()))
+        if policy not in POLICIES:
+            raise ValueError("Unrecognized backpressure policy {0!r}, expected one of {1}".format(
+                policy, ', '.join(POLICIES)))
+        if policy in thresholds:
+            raise ValueError("Backpressure policy {0} is given more than once".format(policy))
+        thresholds[policy] = int(depth)
+    return thresholds
+
+
+class Backpressure(threading.Thread):
+    """
+    Polls the depth of a beanstalk tube, the number of ready plus reserved
+    jobs, every `interval` seconds and switches load-shedding policies on
+    and off as it goes.
+
+    `thresholds` maps policy names to the depth at which they are switched
+    on. A policy is switched off again once the depth falls below
+    `resume_ratio` of its threshold. `on_change` is called with the set of
+    active policies every time it changes.
+    """
+    def __init__(self, connect, tube, thresholds, interval=5, resume_ratio=0.8, on_change=None):
+        super(Backpressure, self).__init__(name='backpressure')
+        self.daemon = True
+        self.connect = connect
+        self.tube = tube
+        self.thresholds = thresholds
+        self.interval = interval
+        self.resume_ratio = resume_ratio
+        self.on_change = on_change
+        self.beanstalk = None
+        self.active = frozenset()
+        self.depth = None
+        self.polling = True
+        self.stopped = threading.Event()
+
+    def poll(self):
+        if self.beanstalk is None:
+            self.beanstalk = self.connect()
+        try:
+            stats = politwoops.utils.beanstalk_stats(self.beanstalk, 'stats-tube', self.tube)
+        except CommandFailed:
+            # The tube does not exist until something uses it.
+            return 0
+        return int(stats['current-jobs-ready']) + int(stats['current-jobs-reserved'])
+
+    def update(self, depth):
+        self.depth = depth
+        active = set()
+        for (policy, threshold) in self.thresholds.items():
+            if depth >= threshold or (policy in self.active and depth >= threshold * self.resume_ratio):
+                active.add(policy)
+        active = frozenset(active)
+        if active == self.active:
+            return
+
+        for policy in sorted(active - self.active):
+            log.warning("Tube {tube} holds {depth} jobs, at or above {threshold}: applying {policy}.",
+                        tube=self.tube, depth=depth, threshold=self.thresholds[policy], policy=policy)
+        for policy in sorted(self.active - active):
+            log.notice("Tube {tube} down to {depth} jobs: no longer applying {policy}.",
+                       tube=self.tube, depth=depth, policy=policy)
+        self.active = active
+        if self.on_change is not None:
+            self.on_change(active)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                depth = self.poll()
+            except Exception as e:
+                if self.polling:
+                    log.error("Unable to poll the depth of tube {tube}, keeping {policies}: {e}",
+                              tube=self.tube, policies=sorted(self.active) or 'no policies', e=e)
+                    self.polling = False
+                if self.beanstalk is not None:
+                    self.beanstalk.close()
+                    self.beanstalk = None
+                continue
+            if not self.polling:
+                log.notice("Polling the depth of tube {0} again.", self.tube)
+                self.polling = True
+            self.update(depth)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Latency histograms for each stage of the pipeline from Twitter to the
+database, per message class.
+
+Histogram keeps counts in buckets laid out like an HdrHistogram's: each
+power of two is split into the same number of linear sub-buckets, so every
+recorded value is kept to within 1%, from a microsecond to about 19 hours,
+in a fixed 30 KB per histogram.
+
+The stages come from the stamps in job bodies (see envelope.py):
+
+* stream - from Twitter's timestamp_ms to tweets-client receiving the message
+* ingest - from receiving the message to writing the job to beanstalk
+* tube - from writing the job to a worker reserving it
+* worker - from reserving the job to committing it to the database
+* total - from Twitter's timestamp_ms to committing it to the database
+
+Stages that span processes are only measured when the job was stamped on
+this host since it last booted, and total only when the message has a
+timestamp_ms.
+"""
+
+import os
+import time
+import array
+import datetime
+import threading
+import http.server
+
+import logbook
+
+import politwoops.utils
+from politwoops import envelope
+
+log = logbook.Logger(__name__)
+
+STAGES = ('stream', 'ingest', 'tube', 'worker', 'total')
+CLASSES = ('tweet', 'retweet', 'reply', 'delete')
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def message_class(message):
+    if 'delete' in message:
+        return 'delete'
+    elif 'retweeted_status' in message:
+        return 'retweet'
+    elif message.get('in_reply_to_status_id') is not None:
+        return 'reply'
+    return 'tweet'
+
+
+class Histogram(object):
+    """
+    Counts latencies in seconds. 2 ** sub_bucket_bits sub-buckets per power
+    of two keep values to within 2 ** (1 - sub_bucket_bits) of themselves.
+    """
+    def __init__(self, highest_seconds=2 ** 36 / 1e6, sub_bucket_bits=8):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.half_count = 2 ** (sub_bucket_bits - 1)
+        self.highest = int(highest_seconds * 1e6)
+        self.counts = array.array('Q', [0]) * (self._index(self.highest) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _index(self, micros):
+        bucket = max(micros.bit_length() - self.sub_bucket_bits, 0)
+        return bucket * self.half_count + (micros >> bucket)
+
+    def _highest_equivalent(self, index):
+        bucket = max(index // self.half_count - 1, 0)
+        sub_bucket = index - bucket * self.half_count
+        return ((sub_bucket + 1) << bucket) - 1
+
+    def record(self, seconds):
+        # Clock steps can make a latency negative; count it as zero.
+        micros = min(max(int(seconds * 1e6), 0), self.highest)
+        self.counts[self._index(micros)] += 1
+        self.count += 1
+        self.total += micros
+        self.max = max(self.max, micros)
+
+    def percentile(self, percent):
+        """
+        Returns the latency, in seconds, that `percent` of the recorded
+        latencies are at or below.
+        """
+        if not self.count:
+            return 0.0
+        target = max(int(round(self.count * percent / 100.0)), 1)
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._highest_equivalent(index), self.max) / 1e6
+        return self.max / 1e6
+
+    def mean(self):
+        return self.total / 1e6 / self.count if self.count else 0.0
+
+
+class PipelineLatency(object):
+    """
+    A Histogram for each stage and message class that has been recorded,
+    since the worker started, and of the total latency of each message class
+    since the last log_summary. Jobs can be recorded from any thread.
+    """
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.histograms = {}
+        self.recent = {}
+        self.lock = threading.Lock()
+
+    def record(self, message, body, reserved, committed=None):
+        """
+        Records a job that was handled, given its message, its job body and
+        the monotonic times at which it was reserved and committed.
+        """
+        committed = time.monotonic() if committed is None else committed
+        now = time.time()
+        latencies = {'worker': committed - reserved}
+        (clock, stamps, _) = envelope.split_stamps(body)
+        if clock == envelope.CLOCK:
+            if 'queued' in stamps:
+                latencies['tube'] = reserved - stamps['queued']
+            if 'received' in stamps and 'queued' in stamps:
+                latencies['ingest'] = stamps['queued'] - stamps['received']
+        sent = politwoops.utils.message_timestamp(message)
+        if sent is not None:
+            latencies['total'] = now - (time.monotonic() - committed) - sent
+            if clock == envelope.CLOCK and 'received' in stamps:
+                latencies['stream'] = now - (time.monotonic() - stamps['received']) - sent
+
+        kind = message_class(message)
+        with self.lock:
+            for (stage, seconds) in latencies.items():
+                histogram = self.histograms.get((stage, kind))
+                if histogram is None:
+                    histogram = self.histograms[(stage, kind)] = Histogram()
+                histogram.record(seconds)
+            if 'total' in latencies:
+                histogram = self.recent.get(kind)
+                if histogram is None:
+                    histogram = self.recent[kind] = Histogram()
+                histogram.record(latencies['total'])
+
+    def log_summary(self, logger):
+        """
+        Logs the count, median, 99th percentile and maximum of the latency
+        from Twitter to the database of each message class since the last
+        summary.
+        """
+        with self.lock:
+            (recent, self.recent) = (self.recent, {})
+        for kind in CLASSES:
+            histogram = recent.get(kind)
+            if histogram is None:
+                continue
+            logger.notice("{kind} latency over {n} jobs: median {p50:.3f} s, 99% {p99:.3f} s, max {max:.3f} s",
+                          kind=kind.capitalize(), n=histogram.count, p50=histogram.percentile(50),
+                          p99=histogram.percentile(99), max=histogram.max / 1e6)
+
+    def render(self):
+        """
+        Returns the percentiles of each histogram as a text table.
+        """
+        columns = ['mean'] + ['p{0:g}'.format(p) for p in PERCENTILES] + ['max']
+        lines = ['# Pipeline latency in seconds since {0}, by stage and message class.'.format(
+                     self.started.isoformat(' ', 'seconds')),
+                 '# stage  class        count ' + ' '.join('{0:>9}'.format(c) for c in columns)]
+        with self.lock:
+            for stage in STAGES:
+                for kind in CLASSES:
+                    histogram = self.histograms.get((stage, kind))
+                    if histogram is None:
+                        continue
+                    values = ([histogram.mean()] + [histogram.percentile(p) for p in PERCENTILES] +
+                              [histogram.max / 1e6])
+                    lines.append('{0:<8} {1:<8} {2:>9} '.format(stage, kind, histogram.count) +
+                                 ' '.join('{0:>9.3f}'.format(v) for v in values))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Replaces the file at path with the rendered table.
+        """
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as table:
+            table.write(self.render())
+        os.replace(temporary, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serves the rendered table over HTTP from a background thread.
+        """
+        latency = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = latency.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug("{0} - {1}", self.address_string(), format % args)
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name='latency-http')
+        thread.daemon = True
+        thread.start()
+        log.notice("Serving pipeline latency at http://{host}:{port}/", host=host, port=server.server_port)
+        return server
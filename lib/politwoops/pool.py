@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Runs several copies of a daemon's main loop in forked child processes.
+
+Each child makes its own connections after the fork. The parent restarts
+children that exit, waiting longer after each quick failure of the same
+child, and logs the throughput of the pool from counters the children keep
+in shared memory.
+
+Children reserve jobs from the same tube, so TweetLocks keeps two of them
+from handling jobs for the same tweet at the same time.
+"""
+
+import os
+import sys
+import time
+import fcntl
+import struct
+import signal
+import threading
+import contextlib
+import multiprocessing
+import traceback
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+
+class TweetLocks(object):
+    """
+    Exclusive locks on tweet ids shared by the processes and threads that
+    open the same file. Ids are hashed onto `stripes` byte-range locks of the
+    file, so unrelated tweets occasionally wait for each other. The kernel
+    releases the locks of a process that dies, so a crashed child never
+    leaves a tweet locked.
+
+    Each thread opens the file for itself. Where the kernel has open file
+    description locks (Linux), threads of one process exclude each other as
+    well; elsewhere record locks belong to the whole process, so only one
+    thread per process may hold locks.
+    """
+    def __init__(self, path, stripes=1024):
+        self.path = path
+        self.stripes = stripes
+        self._local = threading.local()
+
+    def _file(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._local.pid = os.getpid()
+        return self._local.fd
+
+    @staticmethod
+    def _lock(fd, operation, stripe):
+        if hasattr(fcntl, 'F_OFD_SETLKW'):
+            # struct flock: type, whence, start, length and a pid that must
+            # be 0 for these locks.
+            lock_type = fcntl.F_WRLCK if operation == fcntl.LOCK_EX else fcntl.F_UNLCK
+            fcntl.fcntl(fd, fcntl.F_OFD_SETLKW, struct.pack('hhqqi', lock_type, os.SEEK_SET, stripe, 1, 0))
+        else:
+            fcntl.lockf(fd, operation, 1, stripe, os.SEEK_SET)
+
+    @contextlib.contextmanager
+    def holding(self, tweet_ids):
+        """
+        Holds the locks of all of `tweet_ids`, taken in a fixed order so
+        that two holders locking overlapping batches cannot deadlock.
+        """
+        fd = self._file()
+        stripes = sorted(set(int(tweet_id) % self.stripes
+                             for tweet_id in tweet_ids if tweet_id is not None))
+        locked = []
+        try:
+            for stripe in stripes:
+                self._lock(fd, fcntl.LOCK_EX, stripe)
+                locked.append(stripe)
+            yield
+        finally:
+            for stripe in locked:
+                self._lock(fd, fcntl.LOCK_UN, stripe)
+
+
+class WorkerPool(object):
+    """
+    Forks `size` children that each call target(index) and exit with its
+    return value. A child is restarted when it exits; after each exit within
+    `stable_seconds` of starting, the restart waits twice as long, up to
+    `max_backoff` seconds.
+
+    Children report the jobs they finish through jobs_done(index, n), and
+    the pool's throughput is logged every `stats_interval` seconds.
+    """
+    def __init__(self, size, target, stats_interval=60,
+                 stable_seconds=60, max_backoff=300):
+        self.size = size
+        self.target = target
+        self.stats_interval = stats_interval
+        self.stable_seconds = stable_seconds
+        self.max_backoff = max_backoff
+        self.running = False
+
+        # Shared with the children through the fork. Each child only writes
+        # its own counter.
+        self.counts = multiprocessing.Array('Q', size, lock=False)
+        self.children = {}
+        self.started = [0] * size
+        self.failures = [0] * size
+        self.restart_at = {}
+
+        self.last_report = time.time()
+        self.last_counts = [0] * size
+
+    def jobs_done(self, index, n=1):
+        self.counts[index] += n
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                code = self.target(index)
+            except SystemExit as e:
+                code = e.code
+            except KeyboardInterrupt:
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code if isinstance(code, int) else (0 if code is None else 1))
+
+        log.notice("Started worker {index} as pid {pid}.", index=index, pid=pid)
+        self.children[pid] = index
+        self.started[index] = time.time()
+        return pid
+
+    def reap(self):
+        """
+        Collects exited children and schedules their restarts.
+        """
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            if os.WIFSIGNALED(status):
+                how = "killed by signal {0}".format(os.WTERMSIG(status))
+            else:
+                how = "exited with status {0}".format(os.WEXITSTATUS(status))
+            if not self.running:
+                log.info("Worker {index} (pid {pid}) {how}.", index=index, pid=pid, how=how)
+                continue
+
+            if time.time() - self.started[index] >= self.stable_seconds:
+                self.failures[index] = 0
+            delay = min(2 ** self.failures[index], self.max_backoff)
+            self.failures[index] += 1
+            log.warning("Worker {index} (pid {pid}) {how}, restarting in {delay} seconds.",
+                        index=index, pid=pid, how=how, delay=delay)
+            self.restart_at[index] = time.time() + delay
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.stats_interval:
+            return
+        counts = list(self.counts)
+        done = [count - last for (count, last) in zip(counts, self.last_counts)]
+        elapsed = max(now - self.last_report, 1e-6)
+        log.notice("Pool of {size} handled {n} jobs in {sec:.0f} s ({rate:.1f}/s); per worker: {per_worker}",
+                   size=self.size, n=sum(done), sec=elapsed, rate=sum(done) / elapsed,
+                   per_worker=', '.join(str(n) for n in done))
+        self.last_counts = counts
+        self.last_report = now
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def run(self):
+        """
+        Supervises the children until SIGTERM or SIGINT, or until an
+        exception such as a restart unwinds it, then stops them.
+        """
+        self.running = True
+        previous_handler = signal.signal(signal.SIGTERM, self.stop)
+        try:
+            for index in range(self.size):
+                self.spawn(index)
+            while self.running:
+                self.reap()
+                now = time.time()
+                for (index, when) in list(self.restart_at.items()):
+                    if when <= now:
+                        del self.restart_at[index]
+                        self.spawn(index)
+                self.report()
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            self.running = False
+        finally:
+            self.running = False
+            signal.signal(signal.SIGTERM, previous_handler)
+            self.shutdown()
+        self.report(force=True)
+
+    def shutdown(self, timeout=30):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + timeout
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            log.warning("Worker {index} (pid {pid}) did not stop, killing it.",
+                        index=self.children[pid], pid=pid)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            del self.children[pid]
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Recordings of the raw Twitter stream, used to replay production traffic
+against tweets-client and the workers without connecting to Twitter.
+
+A recording is a gzip file with one message per line: the time it was
+received, a tab, and the message exactly as it came off the stream. Each
+run of tweets-client starts a new recording, named after the configured
+path with the time it started before the extension.
+"""
+
+import os
+import gzip
+import time
+import queue
+import itertools
+import threading
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+# Tells the writer thread to close the recording.
+_close = object()
+
+
+def run_path(path, started=None, attempt=0):
+    """
+    Returns the path of the recording of a run started at `started`, for
+    instance stream.20180101-120000.gz for stream.gz, or with a -1, -2 ...
+    suffix on the time for further attempts.
+    """
+    (root, ext) = os.path.splitext(path)
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(started))
+    if attempt:
+        stamp = '{0}-{1}'.format(stamp, attempt)
+    return '{0}.{1}{2}'.format(root, stamp, ext)
+
+
+class StreamRecorder(object):
+    """
+    Writes a recording from a background thread, so recording a message
+    costs the stream reader a queue append; the compression happens on the
+    writer thread. The file is flushed every `flush_interval` seconds, so a
+    crash loses at most that much of the recording and leaves the rest
+    readable by read_recording.
+    """
+    def __init__(self, path, flush_interval=5):
+        started = time.time()
+        for attempt in itertools.count():
+            self.path = run_path(path, started, attempt)
+            try:
+                self._file = gzip.open(self.path, 'xb')
+                break
+            except FileExistsError:
+                continue
+        self.flush_interval = flush_interval
+        self.messages = 0
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write, name='stream-recorder')
+        self._writer.daemon = True
+        self._writer.start()
+        log.notice("Recording the stream to {0}", self.path)
+
+    def record(self, data):
+        self._queue.put((time.time(), data))
+
+    def _write(self):
+        last_flush = time.time()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            if item is _close:
+                break
+            if item is not None:
+                (received, data) = item
+                if not isinstance(data, bytes):
+                    data = data.encode('utf-8')
+                self._file.write(b'%.6f\t%s\n' % (received, data.strip()))
+                self.messages += 1
+            if time.time() - last_flush >= self.flush_interval:
+                # A sync flush ends the compressed data written so far on a
+                # byte boundary, so it can be decompressed without the rest.
+                self._file.flush()
+                last_flush = time.time()
+        self._file.close()
+
+    def close(self):
+        """
+        Writes out the messages still queued and closes the recording.
+        """
+        self._queue.put(_close)
+        self._writer.join()
+        log.notice("Recorded {n} messages to {path}", n=self.messages, path=self.path)
+
+
+def read_recording(path):
+    """
+    Yields (timestamp, message) pairs from a recording, with the message as
+    bytes. A recording cut short by a crash is read up to its last complete
+    message.
+    """
+    with gzip.open(path, 'rb') as fil:
+        try:
+            for line in fil:
+                if not line.endswith(b'\n'):
+                    break
+                timestamp, _, data = line.rstrip(b'\n').partition(b'\t')
+                if data:
+                    yield float(timestamp), data
+        except EOFError:
+            log.warning("{0} was not closed properly, it ends with the last message flushed.", path)
+
+
+def paced(messages, speed=1.0):
+    """
+    Yields the messages of a recording no faster than they were recorded,
+    sped up `speed` times. A speed of 0 yields them as fast as possible.
+    """
+    start = None
+    for (timestamp, data) in messages:
+        if speed > 0:
+            if start is None:
+                start = (timestamp, time.time())
+            due = start[1] + (timestamp - start[0]) / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        yield data
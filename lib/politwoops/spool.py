@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Append-only spool of queue jobs on local disk, used by tweets-client to hold
+messages while beanstalk is unreachable or falling behind.
+
+The spool is a directory of numbered segment files. Each record is a header
+of three 4-byte big-endian integers, the length of the job body, its
+priority and its delay, followed by the body. The position up to which jobs
+have been replayed into beanstalk is kept in a `cursor` file, and segments
+are removed once they have been replayed completely. A fresh segment is
+started every time the spool is opened, so a record torn by a crash can only
+ever be at the end of a segment that is no longer written to.
+"""
+
+import os
+import mmap
+import struct
+import threading
+
+import logbook
+
+from pystalkd.Beanstalkd import DEFAULT_PRIORITY
+
+from politwoops import codec
+
+log = logbook.Logger(__name__)
+
+_header = struct.Struct('>III')
+
+
+class Spool(object):
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, use_mmap=False):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.use_mmap = use_mmap
+        self.lock = threading.Lock()
+
+        segments = self.segments()
+        self.read_segment, self.read_offset = self._load_cursor(segments)
+        self.write_segment = (segments[-1] + 1) if segments else 1
+        self.write_offset = 0
+        self._writer = open(self._segment_path(self.write_segment), 'ab')
+        self._reader = None
+        self._reader_segment = None
+        self._mapped = b''
+        if segments:
+            log.notice("Found {n} spool segments in {directory} to replay.",
+                       n=len(segments), directory=directory)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, '%012d.seg' % segment)
+
+    def _cursor_path(self):
+        return os.path.join(self.directory, 'cursor')
+
+    def segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith('.seg'))
+
+    def _load_cursor(self, segments):
+        try:
+            with open(self._cursor_path()) as fil:
+                cursor = codec.deserialize(fil.read())
+            if cursor['segment'] in segments:
+                return cursor['segment'], cursor['offset']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return (segments[0] if segments else 1), 0
+
+    def empty(self):
+        with self.lock:
+            return (self.read_segment, self.read_offset) >= (self.write_segment, self.write_offset)
+
+    def append(self, body, priority=DEFAULT_PRIORITY, delay=0):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        with self.lock:
+            if self.write_offset >= self.segment_bytes:
+                self._rotate()
+            self._writer.write(_header.pack(len(body), priority, delay))
+            self._writer.write(body)
+            self._writer.flush()
+            self.write_offset += _header.size + len(body)
+
+    def _rotate(self):
+        os.fsync(self._writer.fileno())
+        self._writer.close()
+        self.write_segment += 1
+        self.write_offset = 0
+        self._writer = open(self._segment_path(self.write_segment), 'ab')
+
+    def read(self, max_items):
+        """
+        Returns up to max_items (body, priority, delay) jobs, oldest first,
+        and the position to pass to commit() once they have been written to
+        beanstalk.
+        """
+        segment, offset = self.read_segment, self.read_offset
+        with self.lock:
+            write_segment, write_offset = self.write_segment, self.write_offset
+
+        jobs = []
+        while len(jobs) < max_items and (segment, offset) < (write_segment, write_offset):
+            limit = write_offset if segment == write_segment else None
+            try:
+                offset, size = self._read_records(segment, offset, limit, max_items, jobs)
+            except (IOError, OSError):
+                segment, offset = segment + 1, 0
+                continue
+            if len(jobs) >= max_items or segment == write_segment:
+                break
+            if offset < size:
+                log.warning("Skipping {n} bytes of a torn record at the end of spool segment {segment}.",
+                            n=size - offset, segment=segment)
+            segment, offset = segment + 1, 0
+        return jobs, (segment, offset)
+
+    def _read_records(self, segment, offset, limit, max_items, jobs):
+        """
+        Appends complete records of a segment, starting at offset and ending
+        no later than limit, to jobs until it holds max_items. Returns the offset
+        after the last record read and the readable size of the segment.
+        """
+        if self._reader_segment != segment:
+            self._close_reader()
+            self._reader = open(self._segment_path(segment), 'rb')
+            self._reader_segment = segment
+            self._mapped = b''
+
+        if self.use_mmap:
+            size = os.fstat(self._reader.fileno()).st_size
+            if len(self._mapped) < size:
+                if isinstance(self._mapped, mmap.mmap):
+                    self._mapped.close()
+                self._mapped = mmap.mmap(self._reader.fileno(), 0, access=mmap.ACCESS_READ)
+            data = self._mapped
+            size = len(data) if limit is None else min(limit, len(data))
+            while len(jobs) < max_items and offset + _header.size <= size:
+                (length, priority, delay) = _header.unpack_from(data, offset)
+                end = offset + _header.size + length
+                if end > size:
+                    break
+                jobs.append((data[offset + _header.size:end], priority, delay))
+                offset = end
+            return offset, size
+
+        fil = self._reader
+        size = os.fstat(fil.fileno()).st_size if limit is None else limit
+        if fil.tell() != offset:
+            fil.seek(offset)
+        while len(jobs) < max_items and offset + _header.size <= size:
+            (length, priority, delay) = _header.unpack(fil.read(_header.size))
+            end = offset + _header.size + length
+            if end > size:
+                fil.seek(offset)
+                break
+            jobs.append((fil.read(length), priority, delay))
+            offset = end
+        return offset, size
+
+    def _close_reader(self):
+        if isinstance(self._mapped, mmap.mmap):
+            self._mapped.close()
+        self._mapped = b''
+        if self._reader is not None:
+            self._reader.close()
+        self._reader = None
+        self._reader_segment = None
+
+    def commit(self, position):
+        """
+        Records that everything before position has been replayed, and
+        removes segments that are no longer needed.
+        """
+        segment, offset = position
+        tmp_path = self._cursor_path() + '.tmp'
+        with open(tmp_path, 'w') as fil:
+            fil.write(codec.serialize({'segment': segment, 'offset': offset}))
+        os.rename(tmp_path, self._cursor_path())
+
+        for old in range(self.read_segment, segment):
+            if self._reader_segment == old:
+                self._close_reader()
+            try:
+                os.unlink(self._segment_path(old))
+            except OSError:
+                pass
+        self.read_segment, self.read_offset = segment, offset
+
+    def close(self):
+        with self.lock:
+            self._writer.close()
+        self._close_reader()
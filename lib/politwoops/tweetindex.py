@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+An in-memory index of the ids in the tweets table and their deleted flags,
+so that a worker can tell whether a tweet has been stored, and whether it
+was deleted, without asking the database.
+
+Ids loaded from the table are kept in a sorted array of 64-bit integers with
+a parallel array of flags, 9 bytes per tweet. Tweets written since go into a
+dict, which is merged into the arrays once it holds `merge_threshold` ids.
+
+The index is only accurate while this process is the only writer of the
+tweets table.
+"""
+
+import array
+import bisect
+import threading
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+
+class TweetIndex(object):
+    def __init__(self, merge_threshold=100000):
+        self.merge_threshold = merge_threshold
+        self.ids = array.array('q')
+        self.flags = bytearray()
+        self.recent = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids) + len(self.recent)
+
+    def __contains__(self, tweet_id):
+        return self.get(tweet_id) is not None
+
+    def load(self, rows):
+        """
+        Replaces the contents of the index with (id, deleted) rows, which
+        must be in ascending order of id.
+        """
+        ids = array.array('q')
+        flags = bytearray()
+        for (tweet_id, deleted) in rows:
+            ids.append(tweet_id)
+            flags.append(1 if deleted else 0)
+        with self.lock:
+            self.ids, self.flags, self.recent = ids, flags, {}
+
+    def _find(self, tweet_id):
+        position = bisect.bisect_left(self.ids, tweet_id)
+        if position < len(self.ids) and self.ids[position] == tweet_id:
+            return position
+        return None
+
+    def get(self, tweet_id):
+        """
+        Returns the deleted flag of a stored tweet, 0 or 1, or None if the
+        tweet has not been stored.
+        """
+        with self.lock:
+            deleted = self.recent.get(tweet_id)
+            if deleted is None:
+                position = self._find(tweet_id)
+                if position is not None:
+                    deleted = self.flags[position]
+            return deleted
+
+    def lookup(self, tweet_ids):
+        """
+        Returns the deleted flags of the stored tweets among tweet_ids.
+        """
+        found = {}
+        for tweet_id in tweet_ids:
+            deleted = self.get(tweet_id)
+            if deleted is not None:
+                found[tweet_id] = deleted
+        return found
+
+    def set(self, tweet_id, deleted):
+        """
+        Records that a tweet has been stored with the given deleted flag.
+        """
+        deleted = 1 if deleted else 0
+        with self.lock:
+            position = self._find(tweet_id)
+            if position is not None:
+                self.flags[position] = deleted
+                return
+            self.recent[tweet_id] = deleted
+            if len(self.recent) >= self.merge_threshold:
+                self._merge()
+
+    def _merge(self):
+        # Recent ids are never in the arrays, so each is inserted between
+        # two runs of stored ids, which are copied a slice at a time.
+        recent = sorted(self.recent.items())
+        ids = array.array('q')
+        flags = bytearray()
+        start = 0
+        for (tweet_id, deleted) in recent:
+            position = bisect.bisect_left(self.ids, tweet_id, start)
+            ids.extend(self.ids[start:position])
+            flags.extend(self.flags[start:position])
+            ids.append(tweet_id)
+            flags.append(deleted)
+            start = position
+        ids.extend(self.ids[start:])
+        flags.extend(self.flags[start:])
+        self.ids, self.flags, self.recent = ids, flags, {}
+        log.info("Merged {n} recent tweets into the index of {total}.",
+                 n=len(recent), total=len(ids))
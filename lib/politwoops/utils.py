@@ -8,14 +8,18 @@ import os
 import re
 import signal
 import copy
+import math
+import collections
+import http.client
 import six
 from traceback import print_exception
 
 import logbook
-from pystalkd.Beanstalkd import Connection
-import anyjson
+import logbook.queues
+from pystalkd.Beanstalkd import Connection, SocketError
 
 import tweetsclient
+from politwoops import codec
 
 
 def dict_mget(subject, *keys, **kwargs):
@@ -31,11 +35,30 @@ def dict_mget(subject, *keys, **kwargs):
     return curr
 
 
+_highpoints_re = re.compile(u'[\U00010000-\U0010ffff]')
+
+
 def replace_highpoints(subject, replacement=u'\ufffd'):
-    try:
-        return re.sub(u'[\U00010000-\U0010ffff]', replacement, subject, re.U)
-    except re.error:
-        return re.sub(u'[\uD800-\uDBFF][\uDC00-\uDFFF]', replacement, subject, re.U)
+    """
+    Replaces every character outside the Basic Multilingual Plane, such as
+    emoji, with `replacement`. Given a dict or list, replaces them in every
+    string value inside it instead, returning a copy; anything else is
+    returned as is.
+
+    ASCII strings, which include everything codec.serialize produces, are
+    returned without a scan for such characters.
+    """
+    if isinstance(subject, str):
+        if subject.isascii():
+            return subject
+        # A backslash in the replacement would start an escape or group
+        # reference.
+        return _highpoints_re.sub(replacement.replace('\\', '\\\\'), subject)
+    elif isinstance(subject, dict):
+        return dict((key, replace_highpoints(value, replacement)) for (key, value) in subject.items())
+    elif isinstance(subject, list):
+        return [replace_highpoints(value, replacement) for value in subject]
+    return subject
 
 
 def beanstalk(host='localhost', port=11300, watch=None, use=None):
@@ -47,29 +70,218 @@ def beanstalk(host='localhost', port=11300, watch=None, use=None):
     return beanstalk
 
 
-def configure_log_handler(application_name, loglevel, output):
+def beanstalk_stats(beanstalk, command, argument):
+    """
+    Sends a stats-job or stats-tube command and returns the statistics as a
+    dict of strings. pystalkd's own stats methods parse them with yaml.load,
+    which PyYAML 6 refuses to call without a Loader. Raises CommandFailed
+    if the job or tube does not exist.
+    """
+    (_, body) = beanstalk.send_command(command, argument, ok_status=['OK'], error_status=['NOT_FOUND'])
+    # The body is preceded by its length.
+    (_, body) = body.split(maxsplit=1)
+    stats = {}
+    for line in body.decode('utf-8').splitlines():
+        (key, sep, value) = line.partition(':')
+        if sep:
+            stats[key.strip()] = value.strip()
+    return stats
+
+
+def job_priority(job):
+    """
+    Returns the priority of a job reserved through pystalkd.
+    """
+    return int(beanstalk_stats(job.connection, 'stats-job', job.job_id)['pri'])
+
+
+class PutInterrupted(SocketError):
+    """
+    Raised by put_many when the connection fails part way through a batch.
+    `results` holds the results for the jobs before the failure.
+    """
+    def __init__(self, message, results):
+        super(PutInterrupted, self).__init__(message)
+        self.results = results
+
+
+# Replies to put that reject the job but leave the connection usable.
+_rejected_put_statuses = ('JOB_TOO_BIG', 'DRAINING')
+
+
+def put_many(beanstalk, jobs, ttr=120):
+    """
+    Puts several jobs, given as (body, priority, delay) tuples, into the
+    tube in use with a single write, then reads the responses back.
+
+    Returns a (status, job id) pair for each job: INSERTED, BURIED if
+    beanstalkd was out of memory, or JOB_TOO_BIG or DRAINING with no job id
+    if it rejected the job. A job with a priority or delay beanstalkd would
+    not accept is not sent and gets BAD_FORMAT. If the connection fails, or
+    beanstalkd answers anything else, part way through, raises
+    PutInterrupted and the connection must be reconnected.
+    """
+    results = [None] * len(jobs)
+    chunks = []
+    sent = []
+    for (i, (body, priority, delay)) in enumerate(jobs):
+        if not (0 <= priority < 2 ** 32 and 0 <= delay < 2 ** 32):
+            results[i] = ('BAD_FORMAT', None)
+            continue
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        chunks.append(b'put %d %d %d %d\r\n' % (priority, delay, ttr, len(body)))
+        chunks.append(body)
+        chunks.append(b'\r\n')
+        sent.append(i)
+    if not sent:
+        return results
+
+    # pystalkd reads one response per command, so talk to its socket directly.
+    sock = beanstalk._socket
+    try:
+        SocketError.wrap(sock.sendall, b''.join(chunks))
+    except SocketError as e:
+        raise PutInterrupted(e, [])
+
+    pending = b''
+    for i in sent:
+        while b'\r\n' not in pending:
+            try:
+                received = SocketError.wrap(sock.recv, 4096)
+            except SocketError as e:
+                raise PutInterrupted(e, results[:i])
+            if not received:
+                raise PutInterrupted("Connection closed by beanstalkd", results[:i])
+            pending += received
+        line, pending = pending.split(b'\r\n', 1)
+        status, _, job_id = line.decode('ascii', 'replace').partition(' ')
+        if status in ('INSERTED', 'BURIED'):
+            results[i] = (status, int(job_id))
+        elif status in _rejected_put_statuses:
+            results[i] = (status, None)
+        else:
+            raise PutInterrupted("Unexpected reply to put: {0}".format(status), results[:i])
+    return results
+
+
+class SamplingFilter(object):
+    """
+    Log handler filter that keeps a fraction of the records of each event
+    type and at most `rate_limit` records per second of each. The event type
+    of a record is its message template, so hot-path messages have to be
+    logged with arguments instead of being formatted up front. Warnings and
+    worse are always kept.
+
+    `sample_rates` maps message template prefixes to the fraction to keep.
+    """
+    def __init__(self, sample_rates=None, rate_limit=0):
+        self.sample_rates = sample_rates or {}
+        self.rate_limit = rate_limit
+        self.suppressed = collections.Counter()
+        self._rates = {}
+        self._seen = collections.Counter()
+        self._windows = {}
+
+    def rate_for(self, event):
+        if event not in self._rates:
+            matches = [prefix for prefix in self.sample_rates if event.startswith(prefix)]
+            self._rates[event] = (self.sample_rates[max(matches, key=len)]
+                                  if matches else 1.0)
+        return self._rates[event]
+
+    def __call__(self, record, handler):
+        if record.level >= logbook.WARNING:
+            return True
+        event = record.msg
+
+        rate = self.rate_for(event)
+        if rate < 1.0:
+            self._seen[event] += 1
+            n = self._seen[event]
+            # Keeps every (1/rate)th record, starting with the first.
+            if rate <= 0 or math.floor((n - 1) * rate) == math.floor((n - 2) * rate):
+                self.suppressed[event] += 1
+                return False
+
+        if self.rate_limit:
+            second = int(time.time())
+            window = self._windows.get(event)
+            if window is None or window[0] != second:
+                window = self._windows[event] = [second, 0]
+            window[1] += 1
+            if window[1] > self.rate_limit:
+                self.suppressed[event] += 1
+                return False
+        return True
+
+
+def parse_sample_rates(value):
+    """
+    Parses 'Template prefix:rate, Other prefix:rate' into a dict.
+    """
+    rates = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            prefix, _, rate = item.rpartition(':')
+            rates[prefix.strip()] = float(rate)
+    return rates
+
+
+def configure_log_handler(application_name, loglevel, output, http_debug=False, loggers=()):
+    """
+    Creates the handler for a daemon's log output.
+
+    The [logging] section of the configuration can make the handler write
+    from a background thread (background), keep only a fraction of some
+    messages (sample, see parse_sample_rates) and limit how many of each
+    message are written per second (rate_limit).
+
+    The level of each logger in `loggers` is set as well, so records below
+    it are never created. `http_debug` turns on wire-level logging of HTTP
+    connections.
+    """
     if isinstance(loglevel, (str, six.string_types)):
         loglevel = getattr(logbook, loglevel.upper())
 
     if not isinstance(loglevel, int):
         raise TypeError("configure_log_handler expects loglevel to be either an integer or a string corresponding to an integer attribute of the logbook module.")
 
+    http.client.HTTPConnection.debuglevel = 1 if http_debug else 0
+    for logger in loggers:
+        logger.level = loglevel
+
+    config = tweetsclient.Config().get()
+    sample_rates = parse_sample_rates(config.get('logging', 'sample', fallback=None))
+    rate_limit = config.getint('logging', 'rate_limit', fallback=0)
+    log_filter = (SamplingFilter(sample_rates, rate_limit)
+                  if sample_rates or rate_limit else None)
+
     if output == 'syslog':
         log_handler = logbook.SyslogHandler(
             application_name=application_name,
             facility='user',
             bubble=False,
-            level=loglevel)
+            level=loglevel,
+            filter=log_filter)
     elif output == '-' or not output:
         log_handler = logbook.StderrHandler(
             level=loglevel,
-            bubble=False)
+            bubble=False,
+            filter=log_filter)
     else:
         log_handler = logbook.FileHandler(
             filename=output,
             encoding='utf-8',
             level=loglevel,
-            bubble=False)
+            bubble=False,
+            filter=log_filter)
+
+    if config.getboolean('logging', 'background', fallback=False):
+        # Records are queued to a thread that formats and writes them. The
+        # wrapper exposes the wrapped handler's level and filter, so records
+        # are dropped before they are queued.
+        log_handler = logbook.queues.ThreadedWrapperHandler(log_handler)
 
     return log_handler
 
@@ -99,7 +311,7 @@ def run_with_restart(fn, max_restart=0, args=(), kwargs={}):
                 time.sleep(delay)
 
 
-def restart_process(signum, frame):
+def restart_process(signum=None, frame=None):
     """
     Replaces the current process with a new process invoked
     using the same command line.
@@ -107,6 +319,23 @@ def restart_process(signum, frame):
     os.execl(sys.executable, sys.executable, *sys.argv)
 
 
+class Restart(SystemExit):
+    """
+    Raised in the main thread by request_restart. It unwinds the main
+    thread, running finally clauses on the way, so main() can call
+    restart_process once everything has been flushed and closed.
+    """
+
+
+def request_restart(signum, frame):
+    """
+    SIGHUP handler for daemons that have to clean up before they restart.
+    Further SIGHUPs are ignored until the new process installs its handler.
+    """
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    raise Restart()
+
+
 def start_heartbeat_thread(heart):
     """
     Triggers a regular heartbeat from a background thread
@@ -124,6 +353,30 @@ def start_heartbeat_thread(heart):
     heartbeat.start()
 
 
+def check_heartbeat_file(heart):
+    """
+    Restarts the process via SIGHUP if the heartbeat file has disappeared
+    or its mtime is in the future. Returns False once it has done so.
+    """
+    try:
+        stat = os.stat(heart.filepath)
+        mtime = datetime.datetime.fromtimestamp(stat.st_mtime)
+    except OSError as e:
+        if e.errno == 2: # No such file or directory
+            logbook.warning("Heartbeat file disappeared, restarting via SIGHUP.")
+            os.kill(heart.pid, signal.SIGHUP)
+            return False
+        else:
+            raise
+
+    now = datetime.datetime.now()
+    if mtime >= now:
+        logbook.warning("Heartbeat file mtime is in the future, restarting via SIGHUP.")
+        os.kill(heart.pid, signal.SIGHUP)
+        return False
+    return True
+
+
 def start_watchdog_thread(heart):
     """
     Watch a heartbeat file and restart when the file mtime is either
@@ -133,21 +386,7 @@ def start_watchdog_thread(heart):
     def _watchdog():
         while True:
             time.sleep(heart.interval.total_seconds() * 0.10)
-            try:
-                stat = os.stat(heart.filepath)
-                mtime = datetime.datetime.fromtimestamp(stat.st_mtime)
-            except OSError as e:
-                if e.errno == 2: # No such file or directory
-                    logbook.warning("Heartbeat file disappeared, restarting via SIGHUP.")
-                    os.kill(heart.pid, signal.SIGHUP)
-                    return
-                else:
-                    raise
-
-            now = datetime.datetime.now()
-            if mtime >= now:
-                logbook.warning("Heartbeat file mtime is in the future, restarting via SIGHUP.")
-                os.kill(heart.pid, signal.SIGHUP)
+            if not check_heartbeat_file(heart):
                 return
 
     watchdog = threading.Thread(target=_watchdog)
@@ -159,9 +398,10 @@ def start_watchdog_thread(heart):
 class Heart(object):
     """
     Updates the access and modification timestamp of a
-    file every `interval` seconds.
+    file every `interval` seconds. The file is named after
+    the script unless a `name` is given.
     """
-    def __init__(self):
+    def __init__(self, name=None):
         self.last_beat = datetime.datetime.now()
 
         config = tweetsclient.Config().get()
@@ -182,13 +422,13 @@ class Heart(object):
                              directory)
             raise StopIteration
 
-        scriptname = os.path.basename(sys.argv[0])
+        scriptname = name or os.path.basename(sys.argv[0])
         self.filepath = os.path.join(directory, scriptname)
 
         start_time = datetime.datetime.now().isoformat()
         self.pid = os.getpid()
         with open(self.filepath, 'w') as fil:
-            fil.write(anyjson.serialize({
+            fil.write(codec.serialize({
                 'pid': self.pid,
                 'started': start_time
             }))
@@ -221,3 +461,22 @@ class Heart(object):
             return True
         else:
             return False
+
+
+def message_timestamp(message):
+    """
+    Returns the time, in seconds since the epoch, at which Twitter sent a
+    status or delete notice, or None if it carries no timestamp_ms.
+    """
+    timestamp_ms = message.get('timestamp_ms') or dict_mget(message, 'delete', 'timestamp_ms')
+    try:
+        return int(timestamp_ms) / 1000.0
+    except (TypeError, ValueError):
+        return None
+
+
+def message_tweet_id(message):
+    """
+    Returns the id of the tweet a status or delete notice is about.
+    """
+    return dict_mget(message, 'delete', 'status', 'id') or message.get('id')
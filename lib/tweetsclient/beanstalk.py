@@ -11,11 +11,11 @@ import sys
 import os
 import unittest
 
-import anyjson
 from pystalkd.Beanstalkd import Connection
 import logbook
 
 import tweetsclient
+from politwoops import envelope
 
 log = logbook.Logger(__name__)
 
@@ -24,6 +24,7 @@ class BeanstalkPlugin(tweetsclient.QueuePlugin):
         tweetsclient.QueuePlugin.__init__(self, options)
         self.beanstalk = None
         self.tube = options['tube']
+        self.job_encoding = self.config.get('beanstalk', 'job_encoding', fallback='json')
 
     def _connect(self, host='localhost', port=11300, tube='politwoops'):
         beanstalk = Connection(host=host, port=port)
@@ -44,7 +45,7 @@ class BeanstalkPlugin(tweetsclient.QueuePlugin):
         self.beanstalk.close()
 
     def add(self, tweet):
-        json_obj = anyjson.serialize(tweet)
-        result = self.beanstalk.put(json_obj)
+        body = envelope.pack(tweet, self.job_encoding)
+        result = self.beanstalk.put(body)
         log.debug(result)
-        log.debug(json_obj.encode('utf-8'))
+        log.debug(body.encode('utf-8'))
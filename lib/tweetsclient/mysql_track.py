@@ -11,30 +11,15 @@ import sys
 import os
 import unittest
 import configparser
-import MySQLdb
 
-import anyjson
 import logbook
 
 import tweetsclient
+import politwoops.database
 
 log = logbook.Logger(__name__)
 
 class MySQLTrackPlugin(tweetsclient.TrackPlugin):
-    def _get_database(self):
-        log.debug("Making DB connection")
-        conn = MySQLdb.connect(
-            host=self.config.get('database', 'host'),
-            port=int(self.config.get('database', 'port')),
-            db=self.config.get('database', 'database'),
-            user=self.config.get('database', 'username'),
-            passwd=self.config.get('database', 'password'),
-            charset="utf8mb4",
-            use_unicode=True
-        )
-        conn.cursor().execute('SET NAMES UTF8MB4')
-        return conn
-
     def _query(self, connection, table_name, field_name, conditions = None):
         cursor = connection.cursor()
         q = "SELECT `%s` FROM `%s`" % (field_name, table_name)
@@ -48,8 +33,7 @@ class MySQLTrackPlugin(tweetsclient.TrackPlugin):
         tbl = self.config.get('database', 'table')
         fld = self.config.get('database', 'field')
         cnd = self.config.get('database', 'conditions')
-        conn = self._get_database()
-        return self._query(conn, tbl, fld, cnd)
+        return politwoops.database.shared_pool().call(self._query, tbl, fld, cnd)
 
     def get_type(self):
         return self.config.get('tweets-client', 'type')
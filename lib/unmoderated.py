@@ -1,8 +1,8 @@
 #Script to check the number of unreviewed tweets and email the admins if there are some
 
 
-import MySQLdb
 import tweetsclient
+import politwoops.database
 import smtplib
 from email.mime.text import MIMEText
 import configparser
@@ -19,15 +19,7 @@ sender = smtpconfig.get('moderation-alerts', 'sender')
 max_tweets = smtpconfig.getint('moderation-alerts', 'max_tweets')
 
 config = tweetsclient.Config().get()
-conn = MySQLdb.connect(
-            host=config.get('database', 'host'),
-            port=int(config.get('database', 'port')),
-            db=config.get('database', 'database'),
-            user=config.get('database', 'username'),
-            passwd=config.get('database', 'password'),
-            charset="utf8mb4",
-            use_unicode=True
-        )
+conn = politwoops.database.connect(config)
 cur = conn.cursor()
 cur.execute("""SELECT * FROM `deleted_tweets` WHERE reviewed=0 """)
 tweets = cur.fetchall()
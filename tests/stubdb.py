@@ -0,0 +1,229 @@
+# encoding: utf-8
+"""
+A stand-in for MySQL connections to the politwoops database, backed by an
+in-memory SQLite database, for the tests and the benchmarks. It runs the
+statements politwoops-worker.py sends, with the MySQL behaviour the worker
+relies on: INSERT ... ON DUPLICATE KEY UPDATE reports one affected row for
+an insert and two for an update, and LAST_INSERT_ID(expr) sets the insert
+id of the connection.
+
+All the connections of a Database share its tables. Statements run one at
+a time, and a transaction holds the database until it ends, in place of
+MySQL's row locks. Each statement, commit and rollback first sleeps for
+`latency` seconds, outside any lock, so the round trips of connections used
+from different threads overlap as they would over a network. Like MySQLdb,
+executemany sends an INSERT or REPLACE in one round trip and anything else
+one row at a time.
+
+load_worker() loads bin/politwoops-worker.py. It needs MySQLdb; if that is
+not installed, a module with the names the worker uses is put in its place.
+"""
+
+import os
+import re
+import sys
+import time
+import types
+import sqlite3
+import threading
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The columns of the production tables that the worker reads and writes.
+# deleted_tweets is filled with SELECT * FROM tweets, so its columns are in
+# the same order.
+SCHEMA = """
+CREATE TABLE `politicians` (`id` INTEGER PRIMARY KEY, `twitter_id` INTEGER, `user_name` TEXT,
+                            `status` INTEGER);
+CREATE TABLE `tweets` (`id` INTEGER PRIMARY KEY, `user_name` TEXT, `politician_id` INTEGER,
+                       `content` TEXT, `deleted` INTEGER NOT NULL DEFAULT 0, `created` TEXT,
+                       `modified` TEXT, `tweet` TEXT, `retweeted_id` INTEGER,
+                       `retweeted_content` TEXT, `retweeted_user_name` TEXT);
+CREATE TABLE `deleted_tweets` (`id` INTEGER PRIMARY KEY, `user_name` TEXT, `politician_id` INTEGER,
+                               `content` TEXT, `deleted` INTEGER NOT NULL DEFAULT 0, `created` TEXT,
+                               `modified` TEXT, `tweet` TEXT, `retweeted_id` INTEGER,
+                               `retweeted_content` TEXT, `retweeted_user_name` TEXT);
+CREATE TABLE `twitter_metrics` (`politician_id` INTEGER, `date` TEXT, `followers_count` INTEGER,
+                                `tweets_count` INTEGER, `created_at` TEXT, `updated_at` TEXT,
+                                UNIQUE (`politician_id`, `date`));
+"""
+
+_insert_re = re.compile(r'\s*INSERT INTO `(\w+)`')
+
+
+def _translate(sql):
+    """
+    Rewrites a MySQL statement as SQLite.
+    """
+    sql = sql.replace('%s', '?').replace('NOW()', "DATETIME('now')").replace('CURDATE()', "DATE('now')")
+    (insert, duplicate, update) = sql.partition(' ON DUPLICATE KEY UPDATE ')
+    if duplicate:
+        sql = insert + ' ON CONFLICT DO UPDATE SET ' + re.sub(r'VALUES\((`?\w+`?)\)', r'excluded.\1', update)
+    return sql
+
+
+class Database(object):
+    """
+    The tables shared by every connection made with connect().
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.db = sqlite3.connect(':memory:', isolation_level=None, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.RLock()
+        self.insert_id = None
+        self.db.create_function('LAST_INSERT_ID', 1, self._last_insert_id)
+
+    def _last_insert_id(self, value):
+        self.insert_id = value
+        return value
+
+    def connect(self, *args, **kwargs):
+        return Connection(self)
+
+    def add_politician(self, politician_id, twitter_id, user_name):
+        with self.lock:
+            self.db.execute("INSERT INTO `politicians` VALUES (?, ?, ?, 1)",
+                            (politician_id, twitter_id, user_name))
+
+    def query(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+
+class Connection(object):
+    def __init__(self, database):
+        self.database = database
+        self.in_transaction = False
+
+    def round_trip(self):
+        if self.database.latency:
+            time.sleep(self.database.latency)
+
+    def cursor(self, *args):
+        return Cursor(self)
+
+    def autocommit(self, flag):
+        pass
+
+    def ping(self, *args):
+        self.round_trip()
+
+    def begin(self):
+        self.database.lock.acquire()
+        self.database.db.execute('BEGIN')
+        self.in_transaction = True
+
+    def commit(self):
+        self.round_trip()
+        self._end('COMMIT')
+
+    def rollback(self):
+        self.round_trip()
+        self._end('ROLLBACK')
+
+    def _end(self, statement):
+        if self.in_transaction:
+            self.in_transaction = False
+            try:
+                self.database.db.execute(statement)
+            finally:
+                self.database.lock.release()
+
+    def close(self):
+        self._end('ROLLBACK')
+
+
+class Cursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self.lastrowid = None
+        self.rows = []
+
+    def execute(self, sql, args=()):
+        self.connection.round_trip()
+        if sql.strip() == 'START TRANSACTION':
+            self.connection.begin()
+            return 0
+        with self.connection.database.lock:
+            return self._execute(sql, tuple(args or ()))
+
+    def _execute(self, sql, args):
+        database = self.connection.database
+        db = database.db
+        insert = _insert_re.match(sql)
+        existed = None
+        if insert and ' ON DUPLICATE KEY UPDATE ' in sql and insert.group(1) in ('tweets', 'deleted_tweets'):
+            # The tweet id is the first value of every upsert the worker sends.
+            existed = db.execute('SELECT 1 FROM `{0}` WHERE `id` = ?'.format(insert.group(1)),
+                                 args[:1]).fetchone() is not None
+        database.insert_id = None
+        cursor = db.execute(_translate(sql), args)
+        self.rows = cursor.fetchall() if cursor.description else []
+        self.rowcount = cursor.rowcount
+        if existed is not None:
+            self.rowcount = 2 if existed else 1
+            self.lastrowid = database.insert_id if existed else args[0]
+        return self.rowcount
+
+    def executemany(self, sql, rows):
+        rows = [tuple(row) for row in rows]
+        if re.match(r'\s*(INSERT|REPLACE)\b', sql):
+            self.connection.round_trip()
+            with self.connection.database.lock:
+                self.rowcount = self.connection.database.db.executemany(_translate(sql), rows).rowcount
+            return self.rowcount
+        total = 0
+        for row in rows:
+            total += self.execute(sql, row)
+        self.rowcount = total
+        return total
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        (rows, self.rows) = (self.rows, [])
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+def _mysqldb_module():
+    """
+    The parts of MySQLdb the worker uses, for when it is not installed.
+    """
+    mysqldb = types.ModuleType('MySQLdb')
+    mysqldb.cursors = types.ModuleType('MySQLdb.cursors')
+    mysqldb.cursors.SSCursor = object
+    mysqldb.Error = type('Error', (Exception,), {})
+    mysqldb.DatabaseError = type('DatabaseError', (mysqldb.Error,), {})
+    mysqldb.OperationalError = type('OperationalError', (mysqldb.DatabaseError,), {})
+
+    def connect(**kwargs):
+        raise mysqldb.OperationalError(2003, "MySQLdb is not installed")
+    mysqldb.connect = connect
+    return mysqldb
+
+
+def load_worker():
+    """
+    Returns bin/politwoops-worker.py as a module.
+    """
+    try:
+        import MySQLdb
+    except ImportError:
+        mysqldb = _mysqldb_module()
+        sys.modules['MySQLdb'] = mysqldb
+        sys.modules['MySQLdb.cursors'] = mysqldb.cursors
+    spec = importlib.util.spec_from_file_location('politwoops_worker',
+                                                  os.path.join(ROOT, 'bin', 'politwoops-worker.py'))
+    worker = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(worker)
+    return worker
@@ -0,0 +1,141 @@
+# encoding: utf-8
+"""
+Checks that politwoops-worker.py leaves the same tweets and deleted_tweets
+rows whatever order a tweet, a resend of it and its deletion arrive in,
+handled one job at a time and in batches.
+
+PYTHONPATH=$PYTHONPATH:`pwd`/lib python -m unittest discover tests
+"""
+
+import itertools
+import unittest
+
+import logbook
+
+import stubdb
+
+worker_module = stubdb.load_worker()
+
+import politwoops
+from politwoops import codec
+
+TWEET_ID = 950000000000000001
+TWITTER_ID = 1001
+POLITICIAN_ID = 10
+
+
+def status(text):
+    return {'id': TWEET_ID, 'id_str': str(TWEET_ID), 'text': text, 'in_reply_to_status_id': None,
+            'user': {'id': TWITTER_ID, 'screen_name': 'RepPerson', 'followers_count': 5,
+                     'statuses_count': 6}}
+
+
+def delete():
+    return {'delete': {'status': {'id': TWEET_ID, 'id_str': str(TWEET_ID), 'user_id': TWITTER_ID,
+                                  'user_id_str': str(TWITTER_ID)}}}
+
+
+MESSAGES = {'new': status('Voted today'), 'resend': status('Voted today, edited'), 'delete': delete()}
+
+
+def orderings():
+    """
+    Every ordering of every non-empty subset of the messages.
+    """
+    for size in range(1, len(MESSAGES) + 1):
+        for names in itertools.permutations(sorted(MESSAGES), size):
+            yield names
+
+
+def expected(names):
+    """
+    The (id, content, deleted) rows of tweets and of deleted_tweets after
+    the messages named are handled, in that order.
+    """
+    texts = [MESSAGES[name]['text'] for name in names if name != 'delete']
+    content = texts[-1] if texts else None
+    deleted = 1 if 'delete' in names else 0
+    tweets = [(TWEET_ID, content, deleted)]
+    deleted_tweets = [(TWEET_ID, content, 1)] if deleted and content is not None else []
+    return (tweets, deleted_tweets)
+
+
+class OrderingTest(unittest.TestCase):
+    def setUp(self):
+        self.log_handler = logbook.NullHandler()
+        self.log_handler.push_application()
+
+    def tearDown(self):
+        self.log_handler.pop_application()
+
+    def worker(self, metrics=False, tweet_index=False):
+        """
+        A worker on a new, empty database.
+        """
+        self.database = stubdb.Database()
+        self.database.add_politician(POLITICIAN_ID, TWITTER_ID, 'RepPerson')
+        worker = worker_module.DeletedTweetsWorker.__new__(worker_module.DeletedTweetsWorker)
+        worker.images = False
+        worker.tweet_locks = None
+        worker.users = {TWITTER_ID: POLITICIAN_ID}
+        worker.politicians = {TWITTER_ID: 'RepPerson'}
+        worker.database = self.database.connect()
+        if metrics:
+            worker.metrics = worker_module.MetricsBuffer()
+        if tweet_index:
+            worker.tweet_index = politwoops.tweetindex.TweetIndex()
+        return worker
+
+    def jobs(self, names):
+        # Decoded as the worker decodes job bodies, so each job is a copy.
+        return [codec.deserialize(codec.serialize(MESSAGES[name])) for name in names]
+
+    def state(self):
+        return (self.database.query("SELECT `id`, `content`, `deleted` FROM `tweets`"),
+                self.database.query("SELECT `id`, `content`, `deleted` FROM `deleted_tweets`"))
+
+    def check(self, handle, names, **options):
+        with self.subTest(names=names, **options):
+            handle(self.worker(**options), names)
+            self.assertEqual(self.state(), expected(names))
+
+    def test_single_jobs(self):
+        def handle(worker, names):
+            for tweet in self.jobs(names):
+                worker.handle_tweet(tweet)
+
+        for names in orderings():
+            for metrics in (False, True):
+                self.check(handle, names, metrics=metrics)
+
+    def test_one_batch(self):
+        def handle(worker, names):
+            worker.handle_batch(self.jobs(names))
+
+        for names in orderings():
+            for tweet_index in (False, True):
+                self.check(handle, names, tweet_index=tweet_index)
+
+    def test_split_batches(self):
+        for names in orderings():
+            for split in range(1, len(names)):
+                def handle(worker, names):
+                    worker.handle_batch(self.jobs(names[:split]))
+                    worker.handle_batch(self.jobs(names[split:]))
+
+                with self.subTest(split=split):
+                    for tweet_index in (False, True):
+                        self.check(handle, names, tweet_index=tweet_index)
+
+    def test_batches_then_single_jobs(self):
+        def handle(worker, names):
+            worker.handle_batch(self.jobs(names[:1]))
+            for tweet in self.jobs(names[1:]):
+                worker.handle_tweet(tweet)
+
+        for names in orderings():
+            self.check(handle, names)
+
+
+if __name__ == '__main__':
+    unittest.main()